@@ -1,23 +1,52 @@
 from flask import Flask
 from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
 
 from app.config import config
+from app.cache import cache
+from app.sqlstats import sql_stats
+from app.metrics import metrics
+from app.profiling import profiling
+from app.slowlog import slow_query_log
+from app.replicas import replicas, RoutingSession
+from app.transactions import read_only_transactions
 
 
-db = SQLAlchemy()
+class SiteSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        # 只读接口的查询路由到从库
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# 请求内使用db.session  app context结束时由flask-sqlalchemy关闭并移除
+db = SiteSQLAlchemy(session_options={"autocommit": False, "autoflush": False})
 
 
 def register_site_api(api):
     # from app.building import building_api
     # app.register_blueprint(cms_bp)
     # api.add_resource(someView, '/some/route')
-    from app.views import SiteView, SitesView, BuildingView, UnitsView, FacilityBindView
+    from app.views import (
+        SiteView,
+        SitesView,
+        BuildingView,
+        BuildingChangesView,
+        ElevatorFloorsView,
+        FacilityAddressView,
+        UnitsView,
+        UnitsResolveView,
+        FacilityBindView,
+    )
 
     api.add_resource(SiteView, "/site")
     api.add_resource(SitesView, "/sites")
     api.add_resource(BuildingView, "/building")
+    api.add_resource(BuildingChangesView, "/building/changes")
+    api.add_resource(ElevatorFloorsView, "/elevator/floors")
     api.add_resource(UnitsView, "/units")
+    api.add_resource(UnitsResolveView, "/units/resolve")
+    api.add_resource(FacilityAddressView, "/facility/address")
     api.add_resource(FacilityBindView, "/bind")
 
 
@@ -32,6 +61,8 @@ def import_migrate_models():
         Elevator,
         ElevatorFloor,
         Robot,
+        SiteSidCounter,
+        SiteChangeLog,
     )
 
 
@@ -46,6 +77,13 @@ class CreateApp(object):
         import_migrate_models()
         api = Api(app)
         self.db.init_app(app)
+        cache.init_app(app)
+        sql_stats.init_app(app)
+        metrics.init_app(app)
+        profiling.init_app(app)
+        slow_query_log.init_app(app)
+        replicas.init_app(app)
+        read_only_transactions.init_app(app)
         register_site_api(api)
         return app
 
@@ -57,5 +95,12 @@ def create_app(config_name: str):
     import_migrate_models()
     api = Api(app)
     db.init_app(app)
+    cache.init_app(app)
+    sql_stats.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    slow_query_log.init_app(app)
+    replicas.init_app(app)
+    read_only_transactions.init_app(app)
     register_site_api(api)
     return app
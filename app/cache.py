@@ -0,0 +1,272 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+site api 缓存
+
+backend 由config中的CACHE_BACKEND决定
+    memory  进程内LRU  单进程部署或测试时使用
+    redis   多进程/多实例部署时共享缓存
+
+缓存只是加速手段  backend出错时按未命中处理  不影响接口正常返回
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend(object):
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expire_at, value = item
+            if expire_at and expire_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int = 0):
+        expire_at = time.time() + ttl if ttl else 0
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_many(self, keys: list) -> list:
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping: dict, ttl: int = 0):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete(self, keys: list):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class RedisBackend(object):
+    def __init__(self, url: str, socket_timeout: float = None):
+        # redis不可用时请求最多等待socket_timeout秒  按未命中处理
+        self.client = redis.Redis.from_url(
+            url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int = 0):
+        self.client.set(key, value, ex=ttl or None)
+
+    def get_many(self, keys: list) -> list:
+        return self.client.mget(keys)
+
+    def set_many(self, mapping: dict, ttl: int = 0):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=ttl or None)
+        pipe.execute()
+
+    def delete(self, keys: list):
+        self.client.delete(*keys)
+
+
+class Cache(object):
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        self.key_prefix = "site"
+        self.default_ttl = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get("CACHE_BACKEND", "memory")
+        if backend == "redis":
+            self.backend = RedisBackend(
+                app.config["CACHE_REDIS_URL"],
+                app.config.get("CACHE_REDIS_SOCKET_TIMEOUT"),
+            )
+        elif backend == "memory":
+            self.backend = MemoryBackend(app.config.get("CACHE_MAX_ENTRIES", 256))
+        else:
+            raise ValueError(f"unknown CACHE_BACKEND: {backend}")
+        self.key_prefix = app.config.get("CACHE_KEY_PREFIX", "site")
+        self.default_ttl = app.config.get("CACHE_DEFAULT_TTL", 0)
+        app.extensions["site_cache"] = self
+
+    def key(self, *parts) -> str:
+        return ":".join([self.key_prefix] + [str(i) for i in parts])
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.backend.get(key)
+        except redis.RedisError as e:
+            logger.error(f"cache get {key} failed: {e}")
+            return None
+
+    def set(self, key: str, value, ttl: int = None):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        try:
+            self.backend.set(key, value, self.default_ttl if ttl is None else ttl)
+        except redis.RedisError as e:
+            logger.error(f"cache set {key} failed: {e}")
+
+    def get_many(self, keys: list) -> dict:
+        # 只返回命中的key
+        if not keys:
+            return {}
+        try:
+            values = self.backend.get_many(keys)
+        except redis.RedisError as e:
+            logger.error(f"cache get_many {len(keys)} keys failed: {e}")
+            return {}
+        return {k: v for k, v in zip(keys, values) if v is not None}
+
+    def set_many(self, mapping: dict, ttl: int = None):
+        if not mapping:
+            return
+        mapping = {
+            k: v.encode("utf-8") if isinstance(v, str) else v
+            for k, v in mapping.items()
+        }
+        try:
+            self.backend.set_many(mapping, self.default_ttl if ttl is None else ttl)
+        except redis.RedisError as e:
+            logger.error(f"cache set_many {len(mapping)} keys failed: {e}")
+
+    def delete(self, keys: list):
+        if not keys:
+            return
+        try:
+            self.backend.delete(keys)
+        except redis.RedisError as e:
+            logger.error(f"cache delete {len(keys)} keys failed: {e}")
+
+
+cache = Cache()
+
+
+class TieredCache(object):
+    """
+    两级缓存  进程内LRU(L1)在前  共享cache(L2  redis)在后
+    L1命中不访问redis  L2命中时回填L1
+    delete只能清除本进程的L1  其他进程的L1由较短的l1_ttl过期兜底
+    """
+
+    def __init__(self, namespace: str, max_entries: int = 10000, l1_ttl: int = 5):
+        self.namespace = namespace
+        self.l1 = MemoryBackend(max_entries)
+        self.l1_ttl = l1_ttl
+
+    def _key(self, key: str) -> str:
+        return cache.key(self.namespace, key)
+
+    def get_many(self, keys: Iterable[str]) -> dict:
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.l1.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+        if missing:
+            found = cache.get_many([self._key(i) for i in missing])
+            for key in missing:
+                value = found.get(self._key(key))
+                if value is not None:
+                    result[key] = value
+                    self.l1.set(key, value, self.l1_ttl)
+        return result
+
+    def set_many(self, mapping: dict, ttl: int):
+        mapping = {
+            k: v.encode("utf-8") if isinstance(v, str) else v
+            for k, v in mapping.items()
+        }
+        self.l1.set_many(mapping, min(ttl, self.l1_ttl))
+        cache.set_many({self._key(k): v for k, v in mapping.items()}, ttl)
+
+    def delete(self, keys: Iterable[str]):
+        keys = list(keys)
+        self.l1.delete(keys)
+        cache.delete([self._key(i) for i in keys])
+
+
+class SingleFlight(object):
+    """
+    合并并发的相同未命中  同一key同一时刻只有一个调用方执行load  其他调用方等待其结果
+    等待超时或load出错时  等待方自己再执行一次load
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.ok = False
+            self.value = None
+
+    def __init__(self, timeout: float = 5):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do_many(self, keys: list, load: Callable[[list], dict]) -> dict:
+        # load(keys) -> {key: value}  返回所有key的结果
+        owned, waiting = [], {}
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    self._calls[key] = self._Call()
+                    owned.append(key)
+                else:
+                    waiting[key] = call
+
+        result = {}
+        if owned:
+            loaded = None
+            try:
+                loaded = load(owned)
+                result.update(loaded)
+            finally:
+                with self._lock:
+                    for key in owned:
+                        call = self._calls.pop(key)
+                        if loaded is not None:
+                            call.ok = True
+                            call.value = loaded.get(key)
+                        call.event.set()
+
+        retry = []
+        for key, call in waiting.items():
+            if call.event.wait(self.timeout) and call.ok:
+                result[key] = call.value
+            else:
+                retry.append(key)
+        if retry:
+            result.update(load(retry))
+        return result
+
+
+def site_building_key(site_uuid, version_id: int, scope: str = "") -> str:
+    # site building文档缓存  key由site uuid和版本号组成
+    # 写操作都会增加site.version_id  版本号变化即失效  无需删除  旧版本的key由ttl过期
+    # 按fields/expand裁剪过的文档在后面加上范围
+    if scope:
+        return cache.key("building", site_uuid, version_id, scope)
+    return cache.key("building", site_uuid, version_id)
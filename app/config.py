@@ -17,9 +17,54 @@ class BaseDevConfig(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_POOL_SIZE = 50
     SQLALCHEMY_POOL_TIMEOUT = 10
+    # bulk insert 使用 psycopg2 execute_values 多行VALUES一次写入
+    SQLALCHEMY_ENGINE_OPTIONS = {"executemany_mode": "values"}
+    # GET请求使用只读事务  隔离级别为None时使用数据库默认
+    SQL_READ_ONLY_GET = True
+    SQL_READ_ONLY_ISOLATION = "REPEATABLE READ"
+
+    # 从库  只读接口轮流使用健康的从库  多个地址以逗号分隔
+    SQLALCHEMY_REPLICA_URIS = [
+        i for i in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if i
+    ]
+    # 写请求后同一客户端读主库的秒数  健康检查间隔  允许的复制延迟(0为不检查)
+    REPLICA_STICKY_SECONDS = 5
+    REPLICA_HEALTH_INTERVAL = 10
+    REPLICA_MAX_LAG_SECONDS = 0
+    # wsgi.py生产入口  同时处理的请求数  连接池大小与之相同  另加溢出连接数
+    SERVER_CONCURRENCY = int(os.environ.get("SERVER_CONCURRENCY", "100"))
+    SERVER_POOL_OVERFLOW = 5
     TOKEN_TTL = 3600
     TOKEN_PREFIX = "site:token"
 
+    # Cache  memory or redis
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+    CACHE_REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+    CACHE_KEY_PREFIX = "site"
+    CACHE_DEFAULT_TTL = 3600
+    # redis读写超时秒数
+    CACHE_REDIS_SOCKET_TIMEOUT = 0.5
+    CACHE_MAX_ENTRIES = 256
+
+    # 每个请求的sql统计  开发测试时写入响应头  生产环境写日志
+    SQL_STATS_HEADERS = True
+    # 每个请求的语句数上限 超出时记warning  {endpoint: 上限}单独配置
+    SQL_QUERY_BUDGET = 100
+    SQL_QUERY_BUDGETS = {}
+
+    # 按需profiling  请求头X-Profile带上PROFILE_TOKEN  或匹配PROFILE_ALLOWLIST中的规则
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/site-profiles")
+    PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+    PROFILE_ALLOWLIST = []
+
+    # 慢sql  超过SLOW_QUERY_MS毫秒的语句连同EXPLAIN结果写入SLOW_QUERY_LOG  0为关闭
+    SLOW_QUERY_MS = int(os.environ.get("SLOW_QUERY_MS", "200"))
+    SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", "/tmp/site-slow-queries.log")
+    # EXPLAIN限流  每分钟次数  同一语句的间隔秒数  EXPLAIN ANALYZE的超时
+    SLOW_QUERY_EXPLAIN_PER_MINUTE = 6
+    SLOW_QUERY_EXPLAIN_COOLDOWN = 600
+    SLOW_QUERY_EXPLAIN_TIMEOUT_MS = 5000
+
     # DB Url
     user = os.environ.get("DB_USER", "postgres")
     pwd = os.environ.get("DB_PASSWORD", "123456")
@@ -41,14 +86,19 @@ class DevConfig(BaseDevConfig):
 
 class ProConfig(BaseDevConfig):
     # 系统正式部署时根据自己的需要的一些配置,例如mysql配置，redis配置等等，
-    pass
+    DEBUG = False
+    SQL_STATS_HEADERS = False
 
 
 class TestingConfig(BaseDevConfig):
     # 测试环境setting
     db = os.environ.get("DB_NAME", "site")
 
-    SQLALCHEMY_ENGINE_OPTIONS = {"pool_timeout": 10, "pool_size": 50}
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_timeout": 10,
+        "pool_size": 50,
+        "executemany_mode": "values",
+    }
 
     TESTING = True
     s = BaseDevConfig
@@ -0,0 +1,131 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+robot近场握手时按 (site_uid, facility_group_sid, facility_group_index) 定位设施
+
+API
+
+    GET `/facility/address?site_uid=&group_sid=&group_index=`
+    Response => 与SiteFacilityUnit.get_site_info一致  另加facility_uuid  找不到时为{}
+
+    POST `/facility/address`  批量
+    Request => [{"site_uid": 1, "group_sid": 2, "group_index": 1}, ...]
+    Response => 与请求顺序一致的列表  找不到的位置为null
+
+进程内按site缓存  每次查询只用site_uid索引查一次site版本号  版本号变化或flush_group_index后重建
+分组按需加载  走site_group(site_uuid, facility_group_sid)与site_facility_unit(group_uuid, facility_group_index)索引
+"""
+import threading
+from typing import Iterable, Optional
+from uuid import UUID
+
+from app.models import Site, SiteGroup, SiteFacilityUnit, session
+
+
+class SiteAddressMap(object):
+    # 一个site的寻址表  group_sid => {group_index: facility}
+    def __init__(self, site_uuid: UUID, version_id: int):
+        self.site_uuid = site_uuid
+        self.version_id = version_id
+        self.groups = {}
+
+
+class FacilityAddressIndex(object):
+    def __init__(self):
+        # site_uid => SiteAddressMap
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, site_uuid: UUID):
+        # 组内编号变化后调用  下次查询时重建
+        with self._lock:
+            for site_uid, site_map in list(self._sites.items()):
+                if str(site_map.site_uuid) == str(site_uuid):
+                    del self._sites[site_uid]
+
+    def resolve(self, triples: Iterable[tuple]) -> list:
+        """
+        triples: [(site_uid, group_sid, group_index)]
+        返回与triples顺序一致的列表  找不到的位置为None
+        site版本号一次查询  每个site缺失的分组一次查询
+        """
+        triples = [tuple(int(i) for i in t) for t in triples]
+        site_maps = self._site_maps({t[0] for t in triples})
+
+        missing = {}
+        for site_uid, group_sid, _ in triples:
+            site_map = site_maps.get(site_uid)
+            if site_map is not None and group_sid not in site_map.groups:
+                missing.setdefault(site_uid, set()).add(group_sid)
+        for site_uid, group_sids in missing.items():
+            self._load_groups(site_maps[site_uid], site_uid, group_sids)
+
+        result = []
+        for site_uid, group_sid, group_index in triples:
+            site_map = site_maps.get(site_uid)
+            if site_map is None:
+                result.append(None)
+                continue
+            result.append(site_map.groups.get(group_sid, {}).get(group_index))
+        return result
+
+    def _site_maps(self, site_uids: set) -> dict:
+        rows = session.query(Site.site_uid, Site.uuid, Site.version_id).filter(
+            Site.site_uid.in_(site_uids)
+        )
+        site_maps = {}
+        with self._lock:
+            for site_uid, site_uuid, version_id in rows:
+                site_map = self._sites.get(site_uid)
+                if site_map is None or site_map.version_id != version_id:
+                    site_map = SiteAddressMap(site_uuid, version_id)
+                    self._sites[site_uid] = site_map
+                site_maps[site_uid] = site_map
+        return site_maps
+
+    @staticmethod
+    def _load_groups(site_map: SiteAddressMap, site_uid: int, group_sids: set):
+        rows = (
+            session.query(
+                SiteGroup.facility_group_sid,
+                SiteFacilityUnit.facility_group_index,
+                SiteFacilityUnit.facility_uuid,
+                SiteFacilityUnit.facility_sid,
+                SiteFacilityUnit.unit_type,
+                SiteFacilityUnit.unit_uuid,
+                SiteFacilityUnit.unit_uid,
+                SiteFacilityUnit.unit_name,
+            )
+            .join(SiteFacilityUnit, SiteFacilityUnit.group_uuid == SiteGroup.uuid)
+            .filter(
+                SiteGroup.site_uuid == site_map.site_uuid,
+                SiteGroup.facility_group_sid.in_(group_sids),
+            )
+        )
+        # 不存在的分组也记下  避免重复查询
+        groups = {i: {} for i in group_sids}
+        for row in rows:
+            groups[row.facility_group_sid][row.facility_group_index] = {
+                "site_uid": site_uid,
+                "site_uuid": str(site_map.site_uuid),
+                "facility_uuid": str(row.facility_uuid),
+                "unit_type": row.unit_type,
+                "unit_uuid": str(row.unit_uuid) if row.unit_uuid else None,
+                "unit_uid": row.unit_uid,
+                "unit_sid": row.facility_sid,
+                "unit_group_sid": row.facility_group_sid,
+                "unit_group_index": row.facility_group_index,
+                "unit_name": row.unit_name,
+            }
+        site_map.groups.update(groups)
+
+
+address_index = FacilityAddressIndex()
+
+
+def resolve_facility(site_uid: int, group_sid: int, group_index: int) -> Optional[dict]:
+    return address_index.resolve([(site_uid, group_sid, group_index)])[0]
+
+
+def resolve_facilities(triples: Iterable[tuple]) -> list:
+    return address_index.resolve(triples)
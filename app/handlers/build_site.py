@@ -26,10 +26,14 @@ API
     }
 
 """
+import datetime
 import logging
+import uuid
 from uuid import UUID
-from typing import Optional
-from sqlalchemy import func
+from typing import Iterable, Optional
+from sqlalchemy import func, select
+from app.handlers.addressing import address_index
+from app.handlers.units import unit_resolver
 from app.models import (
     Site,
     Building,
@@ -41,6 +45,8 @@ from app.models import (
     FloorFacility,
     SiteGroup,
     SiteFacilityUnit,
+    SiteSidCounter,
+    SiteChangeLog,
     Robot,
     Unit,
     session,
@@ -49,21 +55,13 @@ from app.models import (
 logger = logging.getLogger(__name__)
 
 
-def _gen_site_uid():
-    """
-    site uid  全局递增唯一
-    """
-    max_uid = session.query(func.max(Site.site_uid)).scalar() or 0
-    return max_uid + 1
-
-
 def create_site(request: dict):
 
     # 校验前端数据
     create_site_json_sanity_check(request)
     site = Site(
         name=request["name"],
-        site_uid=_gen_site_uid(),
+        site_uid=Site.gen_site_uid(),
         address=request["address"],
         status=request["status"],
         has_building_connector=request["has_building_connector"],
@@ -98,6 +96,7 @@ def update_site(request: dict):
     site.business_types = request["business_types"]
     site.location = request["location"]
     site.meta_info = request["meta_info"]
+    site.version_id = (site.version_id or 0) + 1
 
     # flush to get site uuid
     session.flush()
@@ -134,6 +133,7 @@ def bootstrap_site(site: Site):
                                "station_count": 9, "gate_count": 9, "auto_door_count": 9,
                                "charger_count": 9}],
         }
+    所有新增数据先在BootstrapPlan中规划好  最后每张表一次批量写入
     """
 
     logger.info(
@@ -141,10 +141,10 @@ def bootstrap_site(site: Site):
     )
     meta_info = site.meta_info
     assert meta_info["building_count"] == len(meta_info["building_info"])
-    _bootstrap_robot(site, meta_info.get("robot_count") or 0)
-    current_building_count = (
-        session.query(Building).filter(Building.site_uuid == site.uuid).count()
-    )
+
+    plan = BootstrapPlan(site)
+    _plan_robot(plan, meta_info.get("robot_count") or 0)
+    current_building_count = len(plan.buildings)
     # site缓存
     site_building_info = []
     for idx, building_info in enumerate(meta_info["building_info"]):
@@ -152,132 +152,39 @@ def bootstrap_site(site: Site):
         building_uuid = building_info.get("uuid")
         if building_uuid:
             # 更新
-            building = session.query(Building).get(building_uuid)
+            building = plan.buildings.get(str(building_uuid))
             if building and building_info.get("name"):
-                building.name = building_info.get("name")
+                plan.update(Building, building, name=building_info.get("name"))
         if building is None:
             # 创建building
             index = current_building_count + idx + 1
-            building = Building(
+            building = plan.add(
+                Building,
                 name=building_info.get("name") or f"{site.name}#{index}号楼",
                 site_uuid=site.uuid,
+                address="",
+                building_floors=[],
+                elevators=[],
+                chargers=[],
+                stations=[],
+                auto_doors=[],
+                gates=[],
             )
-            session.add(building)
-            session.flush()
-
-        # building 内是否需要扩展楼层
-        # 羃等 创建时 building_floor_count 为0  更新时不为0
-        should_extend_floor = building_info.get("floor_count") - len(
-            building.building_floors
-        )
+            plan.buildings[str(building["uuid"])] = building
 
-        new_building_floors = []
-        if should_extend_floor > 0:
-            for idx in range(should_extend_floor):
-                building_floor_name = f"{len(building.building_floors) + idx + 1} 楼"
-                b_f = _bootstrap_building_floor(
-                    site.uuid,
-                    building.uuid,
-                    building_floor_name,
-                    len(building.building_floors) + idx + 1,
-                )
-                new_building_floors.append(str(b_f.uuid))
-
-            """
-            扩展了floor  同时同步扩展elevator floor  
-            elevator floor和 building floor层数相同
-            区别是 building floor  每幢楼内只有一个系列
-            但是elevator floor是 每个 电梯井内都有  elevator floor
-            """
-            elevators = (
-                session.query(Elevator)
-                .filter(Elevator.building_uuid == building.uuid)
-                .all()
-            )
-
-            for ele in elevators:
-                new_ele_floors = []
-                for idx1 in range(should_extend_floor):
-                    # elevator floor 默认名字为- 表示不可达
-                    # 由前端更新name时修改 is reachable状态
-                    elevator_floor_name = "-"
-                    building_floor_uuid = new_building_floors[idx1]
-                    elevator_floor = _bootstrap_elevator_floor(
-                        site.uuid,
-                        building.uuid,
-                        ele.uuid,
-                        UUID(building_floor_uuid),
-                        elevator_floor_name,
-                        len(building.building_floors) + idx1 + 1,
-                    )
-                    new_ele_floors.append(str(elevator_floor.uuid))
-
-                ele.elevator_floors = ele.elevator_floors + new_ele_floors
-                session.flush()
-
-        building.building_floors = building.building_floors + new_building_floors
-        session.flush()
-
-        # 是否需要扩展电梯
-        should_extend_elevator = building_info.get("elevator_count") - len(
-            building.elevators
-        )
-        # 新增电梯略复杂  需要创建电梯组  如果此前已经有电梯组  是否新建或沿用旧的电梯组
-        # 这里的策略是创建新的电梯组
-        if should_extend_elevator > 0:
-            # 此前电梯组count
-            ele_group_count = (
-                session.query(SiteGroup)
-                .filter(
-                    SiteGroup.building_uuid == building.uuid,
-                    SiteGroup.unit_type == Unit.UNIT_TYPE_ELEVATOR,
-                )
-                .count()
-            )
-            new_elevators = []
-            ele_name = building.name + f"默认电梯组[{ele_group_count+1}]"
-            ele_group = _bootstrap_group(
-                site.uuid, building.uuid, None, ele_name, Unit.UNIT_TYPE_ELEVATOR, 0
-            )
-            # building floor count
-            # elevator floor count == building floor count
-            floor_count = len(building.building_floors)
-            for idx2 in range(should_extend_elevator):
-                name = f"{building.name}-{ele_name}-{idx2+1}号梯"
-                ele = _bootstrap_elevator(
-                    site.uuid, building.uuid, ele_group.uuid, "", name
-                )
-                new_elevators.append(str(ele.uuid))
-                # bootstrap elevator floor
-                new_ele_floors = []
-                for idx3 in range(floor_count):
-                    building_floor_uuid = building.building_floors[idx3]
-                    elevator_floor = _bootstrap_elevator_floor(
-                        site.uuid,
-                        building.uuid,
-                        ele.uuid,
-                        UUID(building_floor_uuid),
-                        "-",
-                        idx3 + 1,
-                    )
-                    new_ele_floors.append(str(elevator_floor.uuid))
-                ele.elevator_floors = new_ele_floors
-
-            ele_group.members = new_elevators
-            building.elevators = building.elevators + new_elevators
-            session.flush()
-
-        _bootstrap_floor_facility(site.uuid, building, building_info)
+        _plan_building_floor(plan, building, building_info.get("floor_count"))
+        _plan_elevator(plan, building, building_info.get("elevator_count"))
+        _plan_floor_facility(plan, building, building_info)
         site_building_info.append(
             {
-                "name": building.name,
-                "uuid": str(building.uuid),
-                "floor_count": len(building.building_floors),
-                "elevator_count": len(building.elevators),
-                "station_count": len(building.stations),
-                "gate_count": len(building.gates),
-                "auto_door_count": len(building.auto_doors),
-                "charger_count": len(building.chargers),
+                "name": building["name"],
+                "uuid": str(building["uuid"]),
+                "floor_count": len(building["building_floors"]),
+                "elevator_count": len(building["elevators"]),
+                "station_count": len(building["stations"]),
+                "gate_count": len(building["gates"]),
+                "auto_door_count": len(building["auto_doors"]),
+                "charger_count": len(building["chargers"]),
             }
         )
 
@@ -287,95 +194,306 @@ def bootstrap_site(site: Site):
         "building_info": site_building_info,
     }
     # 最后创建unit数据
+    _plan_facility_unit(plan)
+    plan.execute()
+    SiteChangeLog.record(site.uuid, site.version_id, plan.inserts, plan.updates)
     session.flush()
-    _bootstrap_facility_unit(site)
-    flush_group_index(site.uuid)
+    # 只有新增facility unit的组需要重新编号
+    flush_group_index(
+        site.uuid, {i["group_uuid"] for i in plan.inserts[SiteFacilityUnit]}
+    )
 
 
-def _bootstrap_building_floor(
-    site_uuid: UUID, building_uuid: UUID, name: str, index: int
-):
-    building_floor = BuildingFloor(
-        name=name, site_uuid=site_uuid, building_uuid=building_uuid, floor_index=index
-    )
-    session.add(building_floor)
-    session.flush()
-    return building_floor
-
-
-def _bootstrap_elevator_floor(
-    site_uuid: UUID,
-    building_uuid: UUID,
-    elevator_uuid: UUID,
-    building_floor_uuid: UUID,
-    name: str,
-    index: int,
-):
-    elevator_floor = ElevatorFloor(
-        name=name,
-        site_uuid=site_uuid,
-        building_uuid=building_uuid,
-        building_floor_uuid=building_floor_uuid,
-        elevator_uuid=elevator_uuid,
-        floor_index=index,
+class BootstrapPlan(object):
+    """
+    bootstrap_site的执行计划
+    一次性加载site下已有的数据  新增的行在内存中规划(uuid在客户端生成)
+    execute时每张表一次bulk insert  已有行的变更每张表一次bulk update
+    """
+
+    # 按此顺序写入
+    TABLES = (
+        Building,
+        BuildingFloor,
+        Elevator,
+        ElevatorFloor,
+        SiteGroup,
+        FloorFacility,
+        Robot,
+        SiteFacilityUnit,
     )
-    session.add(elevator_floor)
-    session.flush()
-    return elevator_floor
 
+    def __init__(self, site: Site):
+        self.site = site
+        self.inserts = {cls: [] for cls in self.TABLES}
+        self.inserted_uuids = set()
+        self.updates = {cls: {} for cls in self.TABLES}
+        # 新增行的create_time严格递增  保证按create_time排序的查询与规划顺序一致
+        self._now = datetime.datetime.now()
+        self._tick = 0
+        self._load()
+
+    def _load(self):
+        site_uuid = self.site.uuid
+
+        buildings = (
+            session.query(
+                Building.uuid,
+                Building.name,
+                Building.building_floors,
+                Building.elevators,
+                Building.chargers,
+                Building.stations,
+                Building.auto_doors,
+                Building.gates,
+            )
+            .filter(Building.site_uuid == site_uuid)
+            .order_by(Building.create_time)
+            .all()
+        )
+        self.buildings = {str(i.uuid): i._asdict() for i in buildings}
+
+        self.elevators = {}
+        for ele in (
+            session.query(
+                Elevator.uuid,
+                Elevator.building_uuid,
+                Elevator.group_uuid,
+                Elevator.elevator_floors,
+            )
+            .filter(Elevator.site_uuid == site_uuid)
+            .order_by(Elevator.create_time)
+        ):
+            self.elevators.setdefault(str(ele.building_uuid), []).append(ele._asdict())
+
+        # (building uuid, unit type) => 分组数量
+        self.group_count = {}
+        for building_uuid, unit_type, count in (
+            session.query(
+                SiteGroup.building_uuid, SiteGroup.unit_type, func.count(SiteGroup.uuid)
+            )
+            .filter(SiteGroup.site_uuid == site_uuid)
+            .group_by(SiteGroup.building_uuid, SiteGroup.unit_type)
+        ):
+            self.group_count[(str(building_uuid), unit_type)] = count
+
+        self.robots = (
+            session.query(Robot.uuid, Robot.group_uuid)
+            .filter(Robot.site_uuid == site_uuid)
+            .order_by(Robot.create_time)
+            .all()
+        )
+        self.facilities = (
+            session.query(
+                FloorFacility.uuid,
+                FloorFacility.building_uuid,
+                FloorFacility.unit_type,
+                FloorFacility.group_uuid,
+            )
+            .filter(FloorFacility.site_uuid == site_uuid)
+            .order_by(FloorFacility.create_time)
+            .all()
+        )
+        # (building uuid, unit type) => facility数量
+        self.facility_count = {}
+        for f in self.facilities:
+            key = (str(f.building_uuid), f.unit_type)
+            self.facility_count[key] = self.facility_count.get(key, 0) + 1
+
+        self.facility_units = {
+            str(i.facility_uuid)
+            for i in session.query(SiteFacilityUnit.facility_uuid).filter(
+                SiteFacilityUnit.site_uuid == site_uuid
+            )
+        }
 
-def _gen_group_sid(site_uuid: UUID) -> int:
-    max_group_sid = (
-        session.query(func.max(SiteGroup.facility_group_sid))
-        .filter(SiteGroup.site_uuid == site_uuid)
-        .scalar()
-        or 0
-    )
-    return max_group_sid + 1
-
-
-def _bootstrap_group(
-    site_uuid: UUID,
-    building_uuid: Optional[UUID],
-    building_floor_uuid: Optional[UUID],
-    name: str,
-    unit_type: int,
-    facility_group_sid: int,
-    members: list = [],
-):
-    group = SiteGroup(
-        name=name,
-        site_uuid=site_uuid,
-        building_uuid=building_uuid,
-        building_floor_uuid=building_floor_uuid,
-        unit_type=unit_type,
-        # todo 单元测试要检测同一站点下sid是否会重复
-        facility_group_sid=facility_group_sid or _gen_group_sid(site_uuid),
-        members=members,
+    def add(self, cls, **row) -> dict:
+        self._tick += 1
+        row.setdefault("uuid", uuid.uuid4())
+        row.setdefault(
+            "create_time", self._now + datetime.timedelta(microseconds=self._tick)
+        )
+        row.setdefault("modify_time", row["create_time"])
+        self.inserts[cls].append(row)
+        self.inserted_uuids.add(row["uuid"])
+        return row
+
+    def add_group(
+        self,
+        building_uuid: Optional[UUID],
+        name: str,
+        unit_type: int,
+        members: list = None,
+    ) -> dict:
+        group = self.add(
+            SiteGroup,
+            name=name,
+            site_uuid=self.site.uuid,
+            building_uuid=building_uuid,
+            building_floor_uuid=None,
+            unit_type=unit_type,
+            # sid在execute时整块预留
+            facility_group_sid=None,
+            members=members or [],
+        )
+        key = (str(building_uuid), unit_type)
+        self.group_count[key] = self.group_count.get(key, 0) + 1
+        return group
+
+    def update(self, cls, row: dict, **values):
+        # 已有的行记录变更  新增的行直接修改即可
+        row.update(values)
+        if row["uuid"] not in self.inserted_uuids:
+            self.updates[cls].setdefault(row["uuid"], {"uuid": row["uuid"]}).update(
+                values
+            )
+
+    def _assign_sid(self, cls, field: str, sid_type: int):
+        # 一条语句预留整块sid  按创建顺序依次分配
+        rows = self.inserts[cls]
+        if not rows:
+            return
+        first = SiteSidCounter.reserve(self.site.uuid, sid_type, len(rows))
+        for idx, row in enumerate(rows):
+            row[field] = first + idx
+
+    def execute(self):
+        self._assign_sid(SiteGroup, "facility_group_sid", SiteSidCounter.SID_TYPE_GROUP)
+        self._assign_sid(
+            SiteFacilityUnit, "facility_sid", SiteSidCounter.SID_TYPE_FACILITY
+        )
+        for cls in self.TABLES:
+            if self.inserts[cls]:
+                session.bulk_insert_mappings(cls, self.inserts[cls], render_nulls=True)
+        for cls in self.TABLES:
+            if self.updates[cls]:
+                session.bulk_update_mappings(cls, list(self.updates[cls].values()))
+
+
+def _plan_robot(plan: BootstrapPlan, robot_count: int):
+    site = plan.site
+    should_extend_robot = robot_count - len(plan.robots)
+    if should_extend_robot > 0:
+        facility_group_count = sum(
+            count
+            for (_, unit_type), count in plan.group_count.items()
+            if unit_type == Unit.UNIT_TYPE_ROBOT
+        )
+        group_name = f"{site.name}(默认)机器人组：[{facility_group_count + 1}]"
+
+        facility_group = plan.add_group(None, group_name, Unit.UNIT_TYPE_ROBOT)
+        for idx in range(should_extend_robot):
+            facility_name = f"{group_name}#robot{idx+1}号"
+            robot = plan.add(
+                Robot,
+                name=facility_name,
+                site_uuid=site.uuid,
+                group_uuid=facility_group["uuid"],
+            )
+            facility_group["members"].append(str(robot["uuid"]))
+
+
+def _plan_building_floor(plan: BootstrapPlan, building: dict, floor_count: int):
+    # building 内是否需要扩展楼层
+    # 羃等 创建时 building_floor_count 为0  更新时不为0
+    site_uuid = plan.site.uuid
+    floor_count_before = len(building["building_floors"])
+    should_extend_floor = floor_count - floor_count_before
+    if should_extend_floor <= 0:
+        return
+
+    new_building_floors = []
+    for idx in range(should_extend_floor):
+        index = floor_count_before + idx + 1
+        building_floor = plan.add(
+            BuildingFloor,
+            name=f"{index} 楼",
+            site_uuid=site_uuid,
+            building_uuid=building["uuid"],
+            floor_index=index,
+        )
+        new_building_floors.append(str(building_floor["uuid"]))
+
+    """
+    扩展了floor  同时同步扩展elevator floor  
+    elevator floor和 building floor层数相同
+    区别是 building floor  每幢楼内只有一个系列
+    但是elevator floor是 每个 电梯井内都有  elevator floor
+    """
+    for ele in plan.elevators.get(str(building["uuid"]), []):
+        new_ele_floors = []
+        for idx1, building_floor_uuid in enumerate(new_building_floors):
+            # elevator floor 默认名字为- 表示不可达
+            # 由前端更新name时修改 is reachable状态
+            elevator_floor = plan.add(
+                ElevatorFloor,
+                name="-",
+                site_uuid=site_uuid,
+                building_uuid=building["uuid"],
+                elevator_uuid=ele["uuid"],
+                building_floor_uuid=UUID(building_floor_uuid),
+                floor_index=floor_count_before + idx1 + 1,
+            )
+            new_ele_floors.append(str(elevator_floor["uuid"]))
+        plan.update(
+            Elevator, ele, elevator_floors=ele["elevator_floors"] + new_ele_floors
+        )
+
+    plan.update(
+        Building,
+        building,
+        building_floors=building["building_floors"] + new_building_floors,
     )
-    session.add(group)
-    session.flush()
-    # 记得更新group的members
-    # members存的都是组下facility uuid字符串
-    return group
-
-
-def _bootstrap_elevator(
-    site_uuid: UUID, building_uuid: UUID, group_uuid: UUID, brand: str, name: str
-):
-    elevator = Elevator(
-        name=name,
-        site_uuid=site_uuid,
-        building_uuid=building_uuid,
-        group_uuid=group_uuid,
-        brand=brand,
+
+
+def _plan_elevator(plan: BootstrapPlan, building: dict, elevator_count: int):
+    # 是否需要扩展电梯
+    should_extend_elevator = elevator_count - len(building["elevators"])
+    # 新增电梯略复杂  需要创建电梯组  如果此前已经有电梯组  是否新建或沿用旧的电梯组
+    # 这里的策略是创建新的电梯组
+    if should_extend_elevator <= 0:
+        return
+
+    site_uuid = plan.site.uuid
+    # 此前电梯组count
+    ele_group_count = plan.group_count.get(
+        (str(building["uuid"]), Unit.UNIT_TYPE_ELEVATOR), 0
     )
-    session.add(elevator)
-    session.flush()
-    return elevator
+    ele_name = building["name"] + f"默认电梯组[{ele_group_count+1}]"
+    ele_group = plan.add_group(building["uuid"], ele_name, Unit.UNIT_TYPE_ELEVATOR)
+    # elevator floor count == building floor count
+    new_elevators = []
+    for idx2 in range(should_extend_elevator):
+        name = f"{building['name']}-{ele_name}-{idx2+1}号梯"
+        ele = plan.add(
+            Elevator,
+            name=name,
+            site_uuid=site_uuid,
+            building_uuid=building["uuid"],
+            group_uuid=ele_group["uuid"],
+            brand="",
+            elevator_floors=[],
+        )
+        new_elevators.append(str(ele["uuid"]))
+        # bootstrap elevator floor
+        for idx3, building_floor_uuid in enumerate(building["building_floors"]):
+            elevator_floor = plan.add(
+                ElevatorFloor,
+                name="-",
+                site_uuid=site_uuid,
+                building_uuid=building["uuid"],
+                elevator_uuid=ele["uuid"],
+                building_floor_uuid=UUID(building_floor_uuid),
+                floor_index=idx3 + 1,
+            )
+            ele["elevator_floors"].append(str(elevator_floor["uuid"]))
+        plan.elevators.setdefault(str(building["uuid"]), []).append(ele)
 
+    ele_group["members"] = new_elevators
+    plan.update(Building, building, elevators=building["elevators"] + new_elevators)
 
-def _bootstrap_floor_facility(site_uuid: UUID, building: Building, building_info: dict):
+
+def _plan_floor_facility(plan: BootstrapPlan, building: dict, building_info: dict):
     # 创建floor facility
     # elevator robot 以及floor facility 都需要在分组下
     # 因为这三种设备都需要安装iot板子（robot比较特殊）用来和robot近场通讯
@@ -388,16 +506,11 @@ def _bootstrap_floor_facility(site_uuid: UUID, building: Building, building_info
                                "station_count": 9, "gate_count": 9, "auto_door_count": 9,
                                "charger_count": 9}
     """
-    station_count = building_info.get("station_count") or 0
-    gate_count = building_info.get("gate_count") or 0
-    auto_door_count = building_info.get("auto_door_count") or 0
-    charger_count = building_info.get("charger_count") or 0
-
     facility_count_map = {
-        Unit.UNIT_TYPE_STATION: station_count,
-        Unit.UNIT_TYPE_AUTO_DOOR: auto_door_count,
-        Unit.UNIT_TYPE_CHARGER: charger_count,
-        Unit.UNIT_TYPE_GATE: gate_count,
+        Unit.UNIT_TYPE_STATION: building_info.get("station_count") or 0,
+        Unit.UNIT_TYPE_AUTO_DOOR: building_info.get("auto_door_count") or 0,
+        Unit.UNIT_TYPE_CHARGER: building_info.get("charger_count") or 0,
+        Unit.UNIT_TYPE_GATE: building_info.get("gate_count") or 0,
     }
 
     facility_name_map = {
@@ -407,133 +520,45 @@ def _bootstrap_floor_facility(site_uuid: UUID, building: Building, building_info
         Unit.UNIT_TYPE_GATE: "闸机",
     }
 
-    facility_group_sid = _gen_group_sid(site_uuid)
+    # 注意此处没有判断type  直接使用了else  如果以后新增 facility类型  需要修改
+    facility_field_map = {
+        Unit.UNIT_TYPE_STATION: "stations",
+        Unit.UNIT_TYPE_AUTO_DOOR: "auto_doors",
+        Unit.UNIT_TYPE_CHARGER: "chargers",
+        Unit.UNIT_TYPE_GATE: "gates",
+    }
+
+    building_uuid = str(building["uuid"])
     for facility_type, facility_count in facility_count_map.items():
-        facility_count_before = (
-            session.query(FloorFacility)
-            .filter(
-                FloorFacility.building_uuid == building.uuid,
-                FloorFacility.unit_type == facility_type,
-            )
-            .count()
-            or 0
+        facility_count_before = plan.facility_count.get(
+            (building_uuid, facility_type), 0
         )
         should_extend_facility = facility_count - facility_count_before
-        if should_extend_facility > 0:
-            facility_group_count = (
-                session.query(SiteGroup)
-                .filter(
-                    SiteGroup.building_uuid == building.uuid,
-                    SiteGroup.unit_type == facility_type,
-                )
-                .count()
-                or 0
-            )
-            group_name = f"{building.name}(默认){facility_name_map[facility_type]}组：[{facility_group_count + 1}]"
-            new_facilities = []
-
-            facility_group = _bootstrap_group(
-                site_uuid,
-                building.uuid,
-                None,
-                group_name,
-                facility_type,
-                facility_group_sid,
-            )
-            session.add(facility_group)
-            session.flush()
-            facility_group_sid += 1
-            for idx in range(should_extend_facility):
-                facility_name = (
-                    f"{group_name}#{facility_name_map[facility_type]}{idx+1}号"
-                )
-                facility = _new_floor_facility(
-                    site_uuid,
-                    building.uuid,
-                    facility_group.uuid,
-                    facility_type,
-                    facility_name,
-                )
-                session.add(facility)
-                session.flush()
-                new_facilities.append(str(facility.uuid))
-
-            facility_group.members = new_facilities
-            if facility_type == Unit.UNIT_TYPE_CHARGER:
-                building.chargers = building.chargers + new_facilities
-            elif facility_type == Unit.UNIT_TYPE_AUTO_DOOR:
-                building.auto_doors = building.auto_doors + new_facilities
-            elif facility_type == Unit.UNIT_TYPE_STATION:
-                building.stations = building.stations + new_facilities
-            else:
-                # 注意此处没有判断type  直接使用了else  如果以后新增 facility类型  需要修改
-                building.gates = building.gates + new_facilities
-            session.flush()
-
-    return
-
-
-def _bootstrap_robot(site: Site, robot_count: int):
-
-    robot_count_before = (
-        session.query(Robot).filter(Robot.site_uuid == site.uuid).count() or 0
-    )
-    should_extend_robot = robot_count - robot_count_before
-    if should_extend_robot > 0:
-        facility_group_count = (
-            session.query(SiteGroup)
-            .filter(
-                SiteGroup.site_uuid == site.uuid,
-                SiteGroup.unit_type == Unit.UNIT_TYPE_ROBOT,
-            )
-            .count()
-            or 0
-        )
-        group_name = f"{site.name}(默认)机器人组：[{facility_group_count + 1}]"
-        new_facilities = []
-
-        facility_group = _bootstrap_group(
-            site.uuid, None, None, group_name, Unit.UNIT_TYPE_ROBOT, 0
-        )
-        session.add(facility_group)
-        session.flush()
-        for idx in range(should_extend_robot):
-            facility_name = f"{group_name}#robot{idx+1}号"
-            robot = _new_robot(site.uuid, facility_group.uuid, facility_name)
-            session.add(robot)
-            session.flush()
-            new_facilities.append(str(robot.uuid))
-
-        facility_group.members = new_facilities
-
-        session.flush()
-
-    return
-
-
-def _new_floor_facility(
-    site_uuid: UUID, building_uuid: UUID, group_uuid: UUID, unit_type: int, name: str
-):
-    facility = FloorFacility(
-        name=name,
-        site_uuid=site_uuid,
-        building_uuid=building_uuid,
-        group_uuid=group_uuid,
-        unit_type=unit_type,
-    )
-    session.add(facility)
-    session.flush()
-    return facility
+        if should_extend_facility <= 0:
+            continue
 
+        facility_group_count = plan.group_count.get((building_uuid, facility_type), 0)
+        group_name = f"{building['name']}(默认){facility_name_map[facility_type]}组：[{facility_group_count + 1}]"
+        facility_group = plan.add_group(building["uuid"], group_name, facility_type)
+        new_facilities = []
+        for idx in range(should_extend_facility):
+            facility_name = f"{group_name}#{facility_name_map[facility_type]}{idx+1}号"
+            facility = plan.add(
+                FloorFacility,
+                name=facility_name,
+                site_uuid=plan.site.uuid,
+                building_uuid=building["uuid"],
+                group_uuid=facility_group["uuid"],
+                unit_type=facility_type,
+            )
+            new_facilities.append(str(facility["uuid"]))
 
-def _new_robot(site_uuid: UUID, group_uuid: UUID, name: str):
-    robot = Robot(name=name, site_uuid=site_uuid, group_uuid=group_uuid)
-    session.add(robot)
-    session.flush()
-    return robot
+        facility_group["members"] = new_facilities
+        field = facility_field_map[facility_type]
+        plan.update(Building, building, **{field: building[field] + new_facilities})
 
 
-def _bootstrap_facility_unit(site: Site):
+def _plan_facility_unit(plan: BootstrapPlan):
     """
     创建facility绑定关系
     site facility unit 记录各个坑位（机器人、elevator、facility）内的设备是否就位（绑定or进坑）
@@ -543,122 +568,105 @@ def _bootstrap_facility_unit(site: Site):
     unit表内同时记录着各种facility的sid  所有facility（在三张表内floor_facility、elevator、robot）
     同时也记录每个facility在组内的index（从1开始计数）
     """
-    # 创建电梯绑定关系
-    site_uuid = site.uuid
-    site_uid = site.site_uid
-    facility_sid = _gen_facility_sid(site_uuid)
-
-    current_sfus = (
-        session.query(SiteFacilityUnit.facility_uuid)
-        .filter(SiteFacilityUnit.site_uuid == site_uuid)
-        .all()
+    site = plan.site
+    facilities = []
+    # 电梯绑定关系
+    for elevators in plan.elevators.values():
+        for ele in elevators:
+            facilities.append(
+                (ele["uuid"], ele.get("group_uuid"), Unit.UNIT_TYPE_ELEVATOR)
+            )
+    # robot绑定关系
+    facilities.extend((r.uuid, r.group_uuid, Unit.UNIT_TYPE_ROBOT) for r in plan.robots)
+    facilities.extend(
+        (r["uuid"], r["group_uuid"], Unit.UNIT_TYPE_ROBOT) for r in plan.inserts[Robot]
     )
-    current_sfus = [i[0] for i in current_sfus]
-    elevators = (
-        session.query(Elevator)
-        .filter(Elevator.site_uuid == site_uuid, Elevator.uuid.notin_(current_sfus))
-        .all()
+    facilities.extend((f.uuid, f.group_uuid, f.unit_type) for f in plan.facilities)
+    facilities.extend(
+        (f["uuid"], f["group_uuid"], f["unit_type"])
+        for f in plan.inserts[FloorFacility]
     )
-    # todo 后续优化批量新增 bulk_insert_mappings
-    for ele in elevators:
-        new_facility_unit(
-            site_uuid,
-            site_uid,
-            ele.group_uuid,
-            ele.uuid,
-            Unit.UNIT_TYPE_ELEVATOR,
-            facility_sid,
-        )
-        facility_sid += 1
 
-    # robot绑定关系
-    robots = (
-        session.query(Robot)
-        .filter(Robot.site_uuid == site_uuid, Robot.uuid.notin_(current_sfus))
-        .all()
-    )
-    for r in robots:
-        new_facility_unit(
-            site_uuid,
-            site_uid,
-            r.group_uuid,
-            r.uuid,
-            Unit.UNIT_TYPE_ROBOT,
-            facility_sid,
+    for facility_uuid, group_uuid, unit_type in facilities:
+        if str(facility_uuid) in plan.facility_units:
+            continue
+        plan.add(
+            SiteFacilityUnit,
+            site_uid=site.site_uid,
+            site_uuid=site.uuid,
+            facility_uuid=facility_uuid,
+            unit_type=unit_type,
+            facility_sid=None,
+            group_uuid=group_uuid,
         )
-        facility_sid += 1
+        plan.facility_units.add(str(facility_uuid))
 
-    facilities = (
-        session.query(FloorFacility)
-        .filter(
-            FloorFacility.site_uuid == site_uuid,
-            FloorFacility.uuid.notin_(current_sfus),
-        )
-        .all()
-    )
-    for f in facilities:
-        new_facility_unit(
-            site_uuid, site_uid, f.group_uuid, f.uuid, f.unit_type, facility_sid
-        )
-        facility_sid += 1
 
+# 刷新facility unit group index
+def flush_group_index(site_uuid: UUID, group_uuids: Optional[Iterable] = None) -> int:
+    """
+    每次新增或更新facility unit的时候 都要重新更新组内的index编号
+    组内按facility_sid排序编号  编号稳定  只改写编号有变化的行
+    group_uuids为空时刷新整个site  否则只刷新传入的组
+    返回改写的行数
+    """
+    if group_uuids is not None:
+        group_uuids = {UUID(str(i)) for i in group_uuids if i}
+        if not group_uuids:
+            return 0
 
-def _gen_facility_sid(site_uuid: UUID):
-    max_facility_sid = (
-        session.query(func.max(SiteFacilityUnit.facility_sid))
-        .filter(SiteFacilityUnit.site_uuid == site_uuid)
-        .scalar()
-        or 0
-    )
-    return max_facility_sid + 1
-
-
-def new_facility_unit(
-    site_uuid: UUID,
-    site_uid: int,
-    group_uuid: UUID,
-    facility_uuid: UUID,
-    unit_type: int,
-    facility_sid: int,
-):
-    sfu = SiteFacilityUnit(
-        site_uid=site_uid,
-        site_uuid=site_uuid,
-        facility_uuid=facility_uuid,
-        unit_type=unit_type,
-        facility_sid=facility_sid or _gen_facility_sid(site_uuid),
-        group_uuid=group_uuid,
-    )
-    session.add(sfu)
+    # 待刷新的facility unit可能还未flush
     session.flush()
-    return sfu
-
-
-# 刷新facility unit group index
-def flush_group_index(site_uuid: UUID):
-    # 每次新增或更新facility unit的时候 都要重新更新组内的index编号（编号顺序没有要求）
-    group_uuid_site_unit_dict = {}
-    sfus = (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.site_uuid == site_uuid)
-        .all()
+    table = SiteFacilityUnit.__table__
+    numbered = select(
+        [
+            table.c.uuid,
+            func.row_number()
+            .over(
+                partition_by=table.c.group_uuid,
+                order_by=(table.c.facility_sid, table.c.uuid),
+            )
+            .label("facility_group_index"),
+        ]
+    ).where(table.c.site_uuid == site_uuid)
+    if group_uuids is not None:
+        numbered = numbered.where(table.c.group_uuid.in_(group_uuids))
+    numbered = numbered.alias("numbered")
+
+    result = session.execute(
+        table.update()
+        .where(table.c.uuid == numbered.c.uuid)
+        .where(
+            table.c.facility_group_index.is_distinct_from(
+                numbered.c.facility_group_index
+            )
+        )
+        .values(facility_group_index=numbered.c.facility_group_index)
+        .returning(table.c.unit_uuid)
     )
-    for sfu in sfus:
-        if str(sfu.group_uuid) in group_uuid_site_unit_dict:
-            group_uuid_site_unit_dict[str(sfu.group_uuid)].append(sfu)
-        else:
-            group_uuid_site_unit_dict[str(sfu.group_uuid)] = [sfu]
-
-    for _, group_site_info in group_uuid_site_unit_dict.items():
-        for i, sfu in enumerate(group_site_info):
-            sfu.facility_group_index = i + 1
+    unit_uuids = [i.unit_uuid for i in result]
 
-    session.flush()
+    # session中已加载的facility unit编号过期  下次访问时重新加载
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, SiteFacilityUnit) and obj.site_uuid == site_uuid:
+            session.expire(obj, ["facility_group_index"])
+    # 寻址表与unit缓存中有组内编号  一并清除
+    address_index.invalidate(site_uuid)
+    unit_resolver.invalidate(unit_uuids)
+    return len(unit_uuids)
 
 
 def force_cleanup_site(site_uuid: UUID) -> None:
     logger.warning(f"delete site related rows for site_uuid={str(site_uuid)}")
 
+    # 删除后这些unit不再属于任何site  提交后清除unit缓存
+    unit_uuids = [
+        i.unit_uuid
+        for i in session.query(SiteFacilityUnit.unit_uuid).filter(
+            SiteFacilityUnit.site_uuid == site_uuid, SiteFacilityUnit.unit_uuid != None
+        )
+    ]
+
     session.query(Site).filter(Site.uuid == site_uuid).delete(synchronize_session=False)
     session.query(Building).filter(Building.site_uuid == site_uuid).delete(
         synchronize_session=False
@@ -688,6 +696,12 @@ def force_cleanup_site(site_uuid: UUID) -> None:
     session.query(Robot).filter(Robot.site_uuid == site_uuid).delete(
         synchronize_session=False
     )
+    session.query(SiteSidCounter).filter(SiteSidCounter.site_uuid == site_uuid).delete(
+        synchronize_session=False
+    )
+    session.query(SiteChangeLog).filter(SiteChangeLog.site_uuid == site_uuid).delete(
+        synchronize_session=False
+    )
     session.query(Cmdb).delete(synchronize_session=False)
 
     try:
@@ -696,6 +710,7 @@ def force_cleanup_site(site_uuid: UUID) -> None:
         logger.error(e)
         session.rollback()
         raise
+    unit_resolver.invalidate(unit_uuids)
 
 
 def create_site_json_sanity_check(request: dict):
@@ -1,8 +1,12 @@
+import datetime
+import json
 import logging
+import uuid
 from itertools import chain
 from uuid import UUID
-from typing import Optional
-from sqlalchemy import func
+from typing import Iterable, Optional, Tuple
+from sqlalchemy import bindparam, func, or_
+from app.cache import cache, site_building_key
 from app.models import (
     Site,
     Building,
@@ -13,17 +17,116 @@ from app.models import (
     FloorFacility,
     SiteGroup,
     SiteFacilityUnit,
+    SiteSidCounter,
+    SiteChangeLog,
     Robot,
     Unit,
+    bakery,
     session,
 )
-from app.handlers.build_site import flush_group_index, _bootstrap_group
+from app.handlers.build_site import flush_group_index
+from app.handlers.units import unit_resolver
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_site_building(site_uuid: UUID):
+# building内分组字段与unit type的对应关系  顺序与Building.get_building_info保持一致
+BUILDING_GROUP_FIELDS = (
+    ("elevator_groups", Unit.UNIT_TYPE_ELEVATOR),
+    ("charger_groups", Unit.UNIT_TYPE_CHARGER),
+    ("station_groups", Unit.UNIT_TYPE_STATION),
+    ("auto_door_groups", Unit.UNIT_TYPE_AUTO_DOOR),
+    ("gate_groups", Unit.UNIT_TYPE_GATE),
+)
+# 可按需返回的字段  building的uuid/name/address与site的版本信息总是返回
+BUILDING_FIELDS = ("building_floors", "elevators") + tuple(
+    field for field, _ in BUILDING_GROUP_FIELDS
+)
+SITE_FIELDS = ("robot_groups",)
+# 可展开的嵌套集合  elevators内的elevator_floors  分组内的members
+BUILDING_EXPANDS = ("elevator_floors", "members")
+# 分组成员所在的表
+MEMBER_CLS = {
+    Unit.UNIT_TYPE_GATE: FloorFacility,
+    Unit.UNIT_TYPE_AUTO_DOOR: FloorFacility,
+    Unit.UNIT_TYPE_CHARGER: FloorFacility,
+    Unit.UNIT_TYPE_STATION: FloorFacility,
+    Unit.UNIT_TYPE_ELEVATOR: Elevator,
+    Unit.UNIT_TYPE_ROBOT: Robot,
+}
+
+
+class BuildingScope(object):
+    """
+    GET /building的返回范围  不传参数时为完整文档
+
+        fields=elevators,building_floors    只返回列出的字段
+        expand=elevator_floors              只展开列出的嵌套集合  为空时都不展开
+        building_uuid=                      只返回一个building
+    """
+
+    def __init__(
+        self,
+        fields: Optional[Iterable[str]] = None,
+        expand: Optional[Iterable[str]] = None,
+        building_uuid: Optional[UUID] = None,
+    ):
+        self.fields = set(BUILDING_FIELDS + SITE_FIELDS if fields is None else fields)
+        self.expand = set(BUILDING_EXPANDS if expand is None else expand)
+        self.building_uuid = building_uuid
+
+    @classmethod
+    def from_args(cls, args) -> Optional["BuildingScope"]:
+        # 参数不合法时返回None
+        def split(name: str) -> Optional[list]:
+            value = args.get(name)
+            if value is None:
+                return None
+            return [i for i in value.split(",") if i]
+
+        fields, expand = split("fields"), split("expand")
+        if fields is not None and not set(fields) <= set(BUILDING_FIELDS + SITE_FIELDS):
+            return None
+        if expand is not None and not set(expand) <= set(BUILDING_EXPANDS):
+            return None
+        building_uuid = args.get("building_uuid")
+        if building_uuid is not None:
+            try:
+                building_uuid = UUID(building_uuid)
+            except ValueError:
+                return None
+        return cls(fields, expand, building_uuid)
+
+    @property
+    def is_full(self) -> bool:
+        return self.key == ""
+
+    @property
+    def key(self) -> str:
+        # 规范化后的范围  用于缓存key和ETag  完整文档为空串
+        parts = []
+        if self.fields != set(BUILDING_FIELDS + SITE_FIELDS):
+            parts.append("f=" + ",".join(sorted(self.fields)))
+        if self.expand != set(BUILDING_EXPANDS):
+            parts.append("e=" + ",".join(sorted(self.expand)))
+        if self.building_uuid is not None:
+            parts.append(f"b={self.building_uuid}")
+        return ";".join(parts)
+
+    def group_types(self) -> set:
+        # 需要返回的分组unit type
+        types = {t for field, t in BUILDING_GROUP_FIELDS if field in self.fields}
+        if "robot_groups" in self.fields:
+            types.add(Unit.UNIT_TYPE_ROBOT)
+        return types
+
+    def member_types(self) -> set:
+        # 需要组装成员的unit type
+        return self.group_types() if "members" in self.expand else set()
+
+
+def get_site_building(site_uuid: UUID, scope: Optional[BuildingScope] = None):
     # 返回site的building信息 包含分组信息
     # 其中elevator比较特别 会返回两次 一次是在组内 一次是在building内
     # 修改elevator的信息之可以从building内的数据结构中修改
@@ -32,63 +135,439 @@ def get_site_building(site_uuid: UUID):
     if site is None:
         return {}
 
-    site_building = {
-        "buildings": [],
-        "robot_groups": [],
-        "created_at": str(site.create_time),
-        "updated_at": str(site.modify_time),
-        "version_id": site.version_id,
-        "uuid": str(site.uuid),
-        "site_uid": site.site_uid,
+    return SiteBuildingLoader(site, scope).load()
+
+
+def get_site_building_version(site_uuid: UUID) -> Optional[int]:
+    # 只查site的版本号 不触及building相关表  用于ETag校验
+    # 每次GET /building都会执行  使用baked query
+    query = bakery(lambda s: s.query(Site.version_id))
+    query += lambda q: q.filter(Site.uuid == bindparam("site_uuid"))
+    row = query(session()).params(site_uuid=site_uuid).first()
+    if row is None:
+        return None
+    return row.version_id or 0
+
+
+def get_elevator_floors(
+    site_uuid: UUID,
+    building_uuid: Optional[UUID] = None,
+    elevator_uuid: Optional[UUID] = None,
+) -> list:
+    """
+    电梯可达楼层  robot乘梯前查询  两次查询 与电梯、楼层数量无关
+    [{"uuid", "name", "brand", "building_uuid",
+      "elevator_floors": [{"uuid", "name", "building_floor_uuid", "floor_index", "is_reachable"}]}]
+    楼层按floor_index排序
+    """
+    elevators = session.query(
+        Elevator.uuid, Elevator.building_uuid, Elevator.name, Elevator.brand
+    ).filter(Elevator.site_uuid == site_uuid)
+    efloors = session.query(
+        ElevatorFloor.uuid,
+        ElevatorFloor.elevator_uuid,
+        ElevatorFloor.name,
+        ElevatorFloor.building_floor_uuid,
+        ElevatorFloor.floor_index,
+        ElevatorFloor.is_reachable,
+    ).filter(ElevatorFloor.site_uuid == site_uuid)
+    if building_uuid is not None:
+        elevators = elevators.filter(Elevator.building_uuid == building_uuid)
+        efloors = efloors.filter(ElevatorFloor.building_uuid == building_uuid)
+    if elevator_uuid is not None:
+        elevators = elevators.filter(Elevator.uuid == elevator_uuid)
+        efloors = efloors.filter(ElevatorFloor.elevator_uuid == elevator_uuid)
+
+    floors = {}
+    for efloor in efloors.order_by(ElevatorFloor.floor_index):
+        floors.setdefault(efloor.elevator_uuid, []).append(
+            {
+                "uuid": str(efloor.uuid),
+                "name": efloor.name,
+                "building_floor_uuid": str(efloor.building_floor_uuid or ""),
+                "floor_index": efloor.floor_index,
+                "is_reachable": efloor.is_reachable,
+            }
+        )
+    return [
+        {
+            "uuid": str(ele.uuid),
+            "name": ele.name,
+            "brand": ele.brand,
+            "building_uuid": str(ele.building_uuid),
+            "elevator_floors": floors.get(ele.uuid, []),
+        }
+        for ele in elevators.order_by(Elevator.create_time)
+    ]
+
+
+def get_site_building_changes(site_uuid: UUID, since_version: int) -> dict:
+    """
+    since_version之后的增量  按写入顺序返回变动的行
+    日志已压缩到since_version之后  或客户端版本比服务端新时  返回完整文档
+    {"version_id": 12, "changes": [{"version_id", "table", "uuid", "op", "data"}]}
+    {"version_id": 12, "snapshot": {...get_site_building...}}
+    """
+    version_id = get_site_building_version(site_uuid)
+    if version_id is None:
+        return {}
+
+    if not SiteChangeLog.compacted_version(site_uuid) <= since_version <= version_id:
+        snapshot = get_site_building(site_uuid)
+        return {"version_id": snapshot["version_id"], "snapshot": snapshot}
+
+    return {
+        "version_id": version_id,
+        "changes": [
+            {
+                "version_id": i.version_id,
+                "table": i.table_name,
+                "uuid": str(i.entity_uuid),
+                "op": SiteChangeLog.OP_NAMES[i.op],
+                "data": i.data,
+            }
+            for i in SiteChangeLog.changes(site_uuid, since_version)
+            if i.version_id <= version_id
+        ],
     }
 
-    buildings = (
-        session.query(Building)
-        .filter(Building.site_uuid == site_uuid)
-        .order_by(Building.create_time)
-        .all()
+
+def compact_site_change_log(keep_versions: int) -> int:
+    # 每个site只保留最近keep_versions个版本的日志  返回删除条数
+    count = 0
+    for site_uuid, version_id in session.query(Site.uuid, Site.version_id).all():
+        count += SiteChangeLog.compact(site_uuid, (version_id or 0) - keep_versions)
+    try:
+        session.commit()
+    except Exception as e:
+        logger.error(e)
+        session.rollback()
+        raise
+    logger.info(
+        f"compact site change log keep_versions={keep_versions}, deleted={count}"
     )
-    for build in buildings:
-        site_building["buildings"].append(build.get_building_info())
-
-    robot_groups = (
-        session.query(SiteGroup)
-        .filter(
-            SiteGroup.site_uuid == site_uuid,
-            SiteGroup.unit_type == Unit.UNIT_TYPE_ROBOT,
+    return count
+
+
+def site_building_etag(
+    site_uuid: UUID, version_id: int, scope: Optional[BuildingScope] = None
+) -> str:
+    etag = f"{site_uuid}-{version_id}"
+    if scope is not None and not scope.is_full:
+        etag += f"-{scope.key}"
+    return etag
+
+
+def get_cached_site_building(
+    site_uuid: UUID, version_id: int, scope: Optional[BuildingScope] = None
+) -> Tuple[int, str]:
+    # 返回(版本号, 序列化后的site building)  缓存未命中时重新加载
+    scope_key = scope.key if scope is not None else ""
+    data = cache.get(site_building_key(site_uuid, version_id, scope_key))
+    if data is not None:
+        return version_id, data.decode("utf-8")
+
+    site_building = get_site_building(site_uuid, scope)
+    # 加载过程中site可能已被修改  以实际加载到的版本号为准
+    version_id = site_building.get("version_id") or 0
+    data = json.dumps(site_building)
+    if site_building:
+        cache.set(site_building_key(site_uuid, version_id, scope_key), data)
+    return version_id, data
+
+
+class SiteBuildingLoader(object):
+    """
+    批量加载site下所有building数据
+    每张表按site_uuid一次性查出  查询次数固定  与building、floor、elevator数量无关
+    然后在内存中组装  返回结构与Building.get_building_info等model方法完全一致
+    只查询scope需要的表  未请求的字段不查询也不组装
+    """
+
+    def __init__(self, site: Site, scope: Optional[BuildingScope] = None):
+        self.site = site
+        self.scope = scope or BuildingScope()
+
+    def load(self) -> dict:
+        site = self.site
+        self._prefetch()
+
+        info = {
+            "buildings": [self._building_info(b) for b in self.buildings],
+            "created_at": str(site.create_time),
+            "updated_at": str(site.modify_time),
+            "version_id": site.version_id,
+            "uuid": str(site.uuid),
+            "site_uid": site.site_uid,
+        }
+        if "robot_groups" in self.scope.fields:
+            info["robot_groups"] = [
+                self._group_info(g)
+                for g in self.groups
+                if g.unit_type == Unit.UNIT_TYPE_ROBOT
+            ]
+        return info
+
+    def _filter_building(self, query, column):
+        if self.scope.building_uuid is None:
+            return query
+        return query.filter(column == self.scope.building_uuid)
+
+    def _prefetch(self):
+        site_uuid = self.site.uuid
+        fields = self.scope.fields
+        group_types = self.scope.group_types()
+        member_types = self.scope.member_types()
+
+        self.buildings = (
+            self._filter_building(
+                session.query(
+                    Building.uuid,
+                    Building.name,
+                    Building.address,
+                    Building.building_floors,
+                    Building.elevators,
+                ).filter(Building.site_uuid == site_uuid),
+                Building.uuid,
+            )
+            .order_by(Building.create_time)
+            .all()
         )
-        .order_by(SiteGroup.create_time)
-        .all()
-    )
-    for r_g in robot_groups:
-        site_building["robot_groups"].append(r_g.get_site_group_info())
 
-    return site_building
+        self.building_floors = {}
+        self.floor_connects = {}
+        if "building_floors" in fields:
+            self._prefetch_building_floors()
+
+        self.elevators = {}
+        self.elevator_floors = {}
+        elevators = []
+        if "elevators" in fields or Unit.UNIT_TYPE_ELEVATOR in member_types:
+            elevators = self._prefetch_elevators()
+
+        self.groups = []
+        if group_types:
+            groups = session.query(
+                SiteGroup.uuid,
+                SiteGroup.building_uuid,
+                SiteGroup.building_floor_uuid,
+                SiteGroup.name,
+                SiteGroup.unit_type,
+                SiteGroup.members,
+            ).filter(
+                SiteGroup.site_uuid == site_uuid, SiteGroup.unit_type.in_(group_types)
+            )
+            if self.scope.building_uuid is not None:
+                # robot分组属于site  不随building过滤
+                groups = groups.filter(
+                    or_(
+                        SiteGroup.building_uuid == self.scope.building_uuid,
+                        SiteGroup.unit_type == Unit.UNIT_TYPE_ROBOT,
+                    )
+                )
+            self.groups = groups.order_by(SiteGroup.create_time).all()
+        self.building_groups = {}
+        for group in self.groups:
+            self.building_groups.setdefault(str(group.building_uuid), []).append(group)
+
+        self.facility_units = {}
+        self.members = {}
+        if member_types:
+            self._prefetch_members(member_types, elevators)
+
+    def _prefetch_building_floors(self):
+        site_uuid = self.site.uuid
+        for floor in self._filter_building(
+            session.query(
+                BuildingFloor.uuid, BuildingFloor.building_uuid, BuildingFloor.name
+            ).filter(BuildingFloor.site_uuid == site_uuid),
+            BuildingFloor.building_uuid,
+        ):
+            self.building_floors.setdefault(str(floor.building_uuid), {})[
+                str(floor.uuid)
+            ] = floor
+
+        # 只查主关联侧
+        site_floors = self._filter_building(
+            session.query(BuildingFloor.uuid).filter(
+                BuildingFloor.site_uuid == site_uuid
+            ),
+            BuildingFloor.building_uuid,
+        )
+        for connect in (
+            session.query(
+                BuildingFloorConnector.floor_uuid_1, BuildingFloorConnector.floor_uuid_2
+            )
+            .filter(BuildingFloorConnector.is_delete == 0)
+            .filter(BuildingFloorConnector.floor_uuid_1.in_(site_floors.subquery()))
+            .order_by(BuildingFloorConnector.create_time)
+        ):
+            self.floor_connects.setdefault(str(connect.floor_uuid_1), []).append(
+                connect.floor_uuid_2
+            )
+
+    def _prefetch_elevators(self) -> list:
+        site_uuid = self.site.uuid
+        elevators = (
+            self._filter_building(
+                session.query(
+                    Elevator.uuid,
+                    Elevator.building_uuid,
+                    Elevator.name,
+                    Elevator.brand,
+                    Elevator.elevator_floors,
+                ).filter(Elevator.site_uuid == site_uuid),
+                Elevator.building_uuid,
+            )
+            .order_by(Elevator.create_time)
+            .all()
+        )
+        for ele in elevators:
+            self.elevators.setdefault(str(ele.building_uuid), {})[str(ele.uuid)] = ele
+
+        if "elevators" in self.scope.fields and "elevator_floors" in self.scope.expand:
+            for efloor in self._filter_building(
+                session.query(
+                    ElevatorFloor.uuid,
+                    ElevatorFloor.elevator_uuid,
+                    ElevatorFloor.name,
+                    ElevatorFloor.building_floor_uuid,
+                ).filter(ElevatorFloor.site_uuid == site_uuid),
+                ElevatorFloor.building_uuid,
+            ):
+                self.elevator_floors.setdefault(str(efloor.elevator_uuid), {})[
+                    str(efloor.uuid)
+                ] = efloor
+        return elevators
+
+    def _prefetch_members(self, member_types: set, elevators: list):
+        site_uuid = self.site.uuid
+        self.facility_units = {
+            str(i.facility_uuid): i
+            for i in session.query(
+                SiteFacilityUnit.facility_uuid,
+                SiteFacilityUnit.unit_name,
+                SiteFacilityUnit.unit_uid,
+                SiteFacilityUnit.unit_uuid,
+            ).filter(
+                SiteFacilityUnit.site_uuid == site_uuid,
+                SiteFacilityUnit.unit_type.in_(member_types),
+            )
+        }
+
+        # 组成员按照facility的create_time排序 与SiteGroup.get_members_attr保持一致
+        facility_types = {t for t in member_types if MEMBER_CLS[t] == FloorFacility}
+        if facility_types:
+            floor_facilities = (
+                self._filter_building(
+                    session.query(
+                        FloorFacility.name,
+                        FloorFacility.uuid,
+                        FloorFacility.direction,
+                        FloorFacility.unit_type,
+                        FloorFacility.building_uuid,
+                        FloorFacility.building_floor_uuid,
+                    ).filter(
+                        FloorFacility.site_uuid == site_uuid,
+                        FloorFacility.unit_type.in_(facility_types),
+                    ),
+                    FloorFacility.building_uuid,
+                )
+                .order_by(FloorFacility.create_time)
+                .all()
+            )
+            self.members[FloorFacility] = self._rank(floor_facilities)
+        if Unit.UNIT_TYPE_ELEVATOR in member_types:
+            self.members[Elevator] = self._rank(elevators)
+        if Unit.UNIT_TYPE_ROBOT in member_types:
+            robots = (
+                session.query(Robot.name, Robot.uuid)
+                .filter(Robot.site_uuid == site_uuid)
+                .order_by(Robot.create_time)
+                .all()
+            )
+            self.members[Robot] = self._rank(robots)
+
+    @staticmethod
+    def _rank(rows) -> dict:
+        # uuid => (排序下标, row)
+        return {str(row.uuid): (idx, row) for idx, row in enumerate(rows)}
+
+    def _building_info(self, building) -> dict:
+        building_uuid = str(building.uuid)
+        fields = self.scope.fields
+        info = {
+            "uuid": building_uuid,
+            "name": building.name,
+            "address": building.address,
+        }
+        if "building_floors" in fields:
+            info["building_floors"] = self._building_floors_info(building)
+        if "elevators" in fields:
+            info["elevators"] = self._elevators_info(building)
+        groups = self.building_groups.get(building_uuid, [])
+        for field, unit_type in BUILDING_GROUP_FIELDS:
+            if field in fields:
+                info[field] = [
+                    self._group_info(g) for g in groups if g.unit_type == unit_type
+                ]
+        return info
+
+    def _building_floors_info(self, building) -> list:
+        return Building.floors_info(
+            building.building_floors,
+            self.building_floors.get(str(building.uuid), {}),
+            lambda i: self.floor_connects.get(i),
+        )
+
+    def _elevators_info(self, building) -> list:
+        def get_elevator_floors(elevator) -> list:
+            return Elevator.floors_info(
+                elevator.elevator_floors,
+                self.elevator_floors.get(str(elevator.uuid), {}),
+            )
+
+        return Building.elevators_info(
+            building.elevators,
+            self.elevators.get(str(building.uuid), {}),
+            get_elevator_floors if "elevator_floors" in self.scope.expand else None,
+        )
+
+    def _group_info(self, site_group) -> dict:
+        members = None
+        if "members" in self.scope.expand:
+            members = self._members_info(site_group)
+        return SiteGroup.group_info(site_group, members)
+
+    def _members_info(self, site_group) -> list:
+        cls = MEMBER_CLS[site_group.unit_type]
+        ranked = self.members[cls]
+        rows = sorted(
+            (ranked[i] for i in set(site_group.members) if i in ranked),
+            key=lambda i: i[0],
+        )
+        return [
+            SiteGroup.member_info(cls, row, self.facility_units[str(row.uuid)])
+            for _, row in rows
+        ]
 
 
-def update_site_building(site_uuid: UUID, site_building: dict):
-    # 修改building信息
+def update_site_building(site_uuid: UUID, site_building: dict) -> dict:
+    """
+    修改building信息
+    与当前数据比较  只写回有变化的字段  返回变更报告  没有变化时返回{}
+    """
     site = session.query(Site).get(site_uuid)
     if not site:
         raise
 
-    buildings = site_building["buildings"]
-    for build in buildings:
-        _update_building(site_uuid, build)
-    robot_groups = site_building["robot_groups"]
-    robot_groups_db = (
-        session.query(SiteGroup)
-        .filter(
-            SiteGroup.unit_type == Unit.UNIT_TYPE_ROBOT,
-            SiteGroup.site_uuid == site_uuid,
-        )
-        .all()
-    )
-    groups_db_map = {str(i.uuid): i for i in robot_groups_db}
-    # 更新robot组
-    _update_facility_group(robot_groups, groups_db_map, site_uuid)
-    # 刷新facility分组下标
-    flush_group_index(site_uuid)
+    diff = SiteBuildingDiff(site)
+    # 先完整校验并计算差异  出错时不会写入任何数据
+    diff.compare(site_building)
+    report = diff.apply()
+    if report:
+        site.version_id = (site.version_id or 0) + 1
+        SiteChangeLog.record(site.uuid, site.version_id, diff.inserts, diff.updates)
 
     try:
         session.commit()
@@ -96,221 +575,391 @@ def update_site_building(site_uuid: UUID, site_building: dict):
         logger.error(e)
         session.rollback()
         raise
+    # 提交前清除的缓存可能已被并发请求以旧数据回填
+    unit_resolver.invalidate(diff.moved_units)
 
     logger.info(
-        f"[API.SECTION_UPDATE] update_site_building(site_uuid={site_uuid}, site_building={site_building})"
+        f"[API.SECTION_UPDATE] update_site_building(site_uuid={site_uuid}, changes={report})"
     )
-
-
-def _update_building(site_uuid: UUID, building: dict):
-
-    building_uuid = building["uuid"]
-    building_db = session.query(Building).get(building_uuid)
-
-    building_db.name = building["name"]
-    building_db.address = building["address"]
-    elevators = (
-        session.query(Elevator).filter(Elevator.building_uuid == building_uuid).all()
-    )
-    ele_map = {str(i.uuid): i for i in elevators}
-    elevator_reqs = building["elevators"]
-    for ele_req in elevator_reqs:
-        ele = ele_map[ele_req["uuid"]]
-        ele.name = ele_req["name"]
-        ele.brand = ele_req["brand"]
-        _update_elevator_floors(ele.uuid, ele_req["elevator_floors"])
-
-    building_floors = (
-        session.query(BuildingFloor)
-        .filter(BuildingFloor.building_uuid == building_uuid)
-        .all()
+    return report
+
+
+class SiteBuildingDiff(object):
+    """
+    site building文档的差异更新
+    控制台每次保存都会提交完整的building文档  大部分字段并没有变化
+    按site一次性加载当前数据  与文档逐字段比较  只把真正变化的字段按表批量写回
+    没有变化的行不会产生UPDATE  也不会刷新modify_time
+    """
+
+    # 按此顺序写入
+    TABLES = (
+        Building,
+        BuildingFloor,
+        BuildingFloorConnector,
+        Elevator,
+        ElevatorFloor,
+        SiteGroup,
+        FloorFacility,
+        Robot,
+        SiteFacilityUnit,
     )
-    build_map = {str(i.uuid): i for i in building_floors}
-    building_floor_reqs = building["building_floors"]
-    for building_floor_req in building_floor_reqs:
-        building_floor = build_map[building_floor_req["uuid"]]
-        building_floor.name = building_floor_req["name"]
-        if building_floor_req.get("connected_building_floor_uuid"):
-            # 创建关联楼层信息
-            _new_or_update_building_floor_connects(
-                site_uuid,
-                building_floor.uuid,
-                UUID(building_floor_req["connected_building_floor_uuid"]),
-                building_uuid,
+
+    def __init__(self, site: Site):
+        self.site = site
+        self.inserts = {cls: [] for cls in self.TABLES}
+        self.updates = {cls: {} for cls in self.TABLES}
+        # 成员有变动的分组  只对这些组重新编号
+        self.touched_groups = set()
+        # 换组的已绑定unit  组内编号可能不变  需单独清除unit缓存
+        self.moved_units = set()
+        self._now = datetime.datetime.now()
+        self._tick = 0
+        self._load()
+
+    def _load(self):
+        site_uuid = self.site.uuid
+
+        def rows(*columns):
+            return session.query(*columns).filter(
+                columns[0].class_.site_uuid == site_uuid
             )
-        else:
-            # 清除关联关系
-            clean_connects(building_floor.uuid)
 
-    groups_db = (
-        session.query(SiteGroup).filter(SiteGroup.building_uuid == building_uuid).all()
-    )
-    groups_db_map = {str(i.uuid): i for i in groups_db}
-
-    # 更新其他组
-    for key in [
-        "elevator_groups",
-        "charger_groups",
-        "station_groups",
-        "auto_door_groups",
-        "gate_groups",
-    ]:
-        _update_facility_group(building[key], groups_db_map, site_uuid, building_uuid)
-
-
-def _update_elevator_floors(elevator_uuid: UUID, ele_floors: list):
-    elevator_floors = session.query(ElevatorFloor).filter(
-        ElevatorFloor.elevator_uuid == elevator_uuid
-    )
-    ele_floor_map = {str(i.uuid): i for i in elevator_floors}
-    for ele_floor_req in ele_floors:
-        ele_floor = ele_floor_map[ele_floor_req["uuid"]]
-        ele_floor.name = ele_floor_req["name"]
-        if ele_floor_req["name"] != "-":
-            ele_floor.is_reachable = True
-
-
-def _new_or_update_building_floor_connects(
-    site_uuid: UUID, floor_uuid1: UUID, floor_uuid2: UUID, building_uuid: UUID
-):
-    # 创建或者更新building floor connects
-    building_floor2 = (
-        session.query(BuildingFloor)
-        .filter(BuildingFloor.site_uuid == site_uuid, BuildingFloor.uuid == floor_uuid2)
-        .scalar()
-    )
-    # floor_uuid1  默认不做校验
-    if building_floor2 is None:
-        # 联通楼宇floor uuid错误
-        raise
-    if str(building_floor2.building_uuid) == str(building_uuid):
-        # 联通了同一栋楼宇
-        raise
-    if BuildingFloorConnector.is_floor_connect_exist(floor_uuid1, floor_uuid2):
-        # 联通关系已经存在
-        return
-    # 如果此前floor uuid 1 有其他 联通楼层  则替换掉
-    connect = (
-        session.query(BuildingFloorConnector)
-        .filter(
-            BuildingFloorConnector.floor_uuid_1 == floor_uuid1,
-            BuildingFloorConnector.is_delete == 0,
+        self.buildings = {
+            str(i.uuid): i._asdict()
+            for i in rows(Building.uuid, Building.name, Building.address)
+        }
+        self.building_floors = {
+            str(i.uuid): i._asdict()
+            for i in rows(
+                BuildingFloor.uuid, BuildingFloor.building_uuid, BuildingFloor.name
+            )
+        }
+        self.elevators = {
+            str(i.uuid): i._asdict()
+            for i in rows(
+                Elevator.uuid,
+                Elevator.building_uuid,
+                Elevator.name,
+                Elevator.brand,
+                Elevator.group_uuid,
+            )
+        }
+        self.elevator_floors = {
+            str(i.uuid): i._asdict()
+            for i in rows(
+                ElevatorFloor.uuid,
+                ElevatorFloor.elevator_uuid,
+                ElevatorFloor.name,
+                ElevatorFloor.is_reachable,
+            )
+        }
+        self.groups = {
+            str(i.uuid): i._asdict()
+            for i in rows(
+                SiteGroup.uuid,
+                SiteGroup.building_uuid,
+                SiteGroup.building_floor_uuid,
+                SiteGroup.name,
+                SiteGroup.unit_type,
+                SiteGroup.members,
+            )
+        }
+        self.members = {
+            Robot: {
+                str(i.uuid): i._asdict()
+                for i in rows(Robot.uuid, Robot.name, Robot.group_uuid)
+            },
+            Elevator: self.elevators,
+            FloorFacility: {
+                str(i.uuid): i._asdict()
+                for i in rows(
+                    FloorFacility.uuid,
+                    FloorFacility.name,
+                    FloorFacility.direction,
+                    FloorFacility.building_floor_uuid,
+                    FloorFacility.group_uuid,
+                )
+            },
+        }
+        self.facility_units = {
+            str(i.facility_uuid): i._asdict()
+            for i in rows(
+                SiteFacilityUnit.uuid,
+                SiteFacilityUnit.facility_uuid,
+                SiteFacilityUnit.unit_uuid,
+                SiteFacilityUnit.group_uuid,
+            )
+        }
+        # 生效中的联通关系  只查主关联侧在本site的
+        site_floors = session.query(BuildingFloor.uuid).filter(
+            BuildingFloor.site_uuid == site_uuid
         )
-        .scalar()
-    )
-    if connect:
-        connect.floor_uuid_2 = floor_uuid2
-    else:
-        connect = BuildingFloorConnector(
-            site_uuid=site_uuid,
+        self.connects = [
+            i._asdict()
+            for i in session.query(
+                BuildingFloorConnector.uuid,
+                BuildingFloorConnector.floor_uuid_1,
+                BuildingFloorConnector.floor_uuid_2,
+                BuildingFloorConnector.building_uuid_2,
+            )
+            .filter(BuildingFloorConnector.is_delete == 0)
+            .filter(BuildingFloorConnector.floor_uuid_1.in_(site_floors.subquery()))
+            .order_by(BuildingFloorConnector.create_time)
+        ]
+
+    def _set(self, cls, row: dict, **values):
+        # 只记录与当前值不同的字段  同时修改内存中的当前值  后续比较以此为准
+        changed = {k: v for k, v in values.items() if row[k] != v}
+        if not changed:
+            return
+        row.update(changed)
+        self.updates[cls].setdefault(row["uuid"], {"uuid": row["uuid"]}).update(changed)
+
+    def _add(self, cls, **row) -> dict:
+        # 新增行的create_time严格递增  保证按create_time排序时与文档顺序一致
+        self._tick += 1
+        row.setdefault("uuid", uuid.uuid4())
+        row["create_time"] = self._now + datetime.timedelta(microseconds=self._tick)
+        row["modify_time"] = row["create_time"]
+        self.inserts[cls].append(row)
+        return row
+
+    def compare(self, site_building: dict):
+        for building in site_building["buildings"]:
+            self._compare_building(building)
+
+        robot_groups = {
+            k: v
+            for k, v in self.groups.items()
+            if v["unit_type"] == Unit.UNIT_TYPE_ROBOT
+        }
+        self._compare_groups(site_building["robot_groups"], robot_groups)
+
+    def _compare_building(self, building: dict):
+        building_uuid = building["uuid"]
+        building_db = self.buildings.get(building_uuid)
+        if building_db is None:
+            # building 不存在
+            raise
+        self._set(
+            Building, building_db, name=building["name"], address=building["address"]
+        )
+
+        for ele_req in building["elevators"]:
+            ele = self.elevators[ele_req["uuid"]]
+            if str(ele["building_uuid"]) != building_uuid:
+                raise KeyError(ele_req["uuid"])
+            self._set(Elevator, ele, name=ele_req["name"], brand=ele_req["brand"])
+            for ele_floor_req in ele_req["elevator_floors"]:
+                ele_floor = self.elevator_floors[ele_floor_req["uuid"]]
+                if ele_floor["elevator_uuid"] != ele["uuid"]:
+                    raise KeyError(ele_floor_req["uuid"])
+                values = {"name": ele_floor_req["name"]}
+                if ele_floor_req["name"] != "-":
+                    values["is_reachable"] = True
+                self._set(ElevatorFloor, ele_floor, **values)
+
+        for building_floor_req in building["building_floors"]:
+            building_floor = self.building_floors[building_floor_req["uuid"]]
+            if str(building_floor["building_uuid"]) != building_uuid:
+                raise KeyError(building_floor_req["uuid"])
+            self._set(BuildingFloor, building_floor, name=building_floor_req["name"])
+            if building_floor_req.get("connected_building_floor_uuid"):
+                # 创建关联楼层信息
+                self._connect(
+                    building_floor["uuid"],
+                    building_floor_req["connected_building_floor_uuid"],
+                    building_floor["building_uuid"],
+                )
+            else:
+                # 清除关联关系
+                self._clean_connects(building_floor["uuid"])
+
+        groups_db = {
+            k: v
+            for k, v in self.groups.items()
+            if str(v["building_uuid"]) == building_uuid
+        }
+        # 更新其他组
+        for key, _ in BUILDING_GROUP_FIELDS:
+            self._compare_groups(building[key], groups_db, UUID(building_uuid))
+
+    def _connect(self, floor_uuid1: UUID, floor_uuid2: str, building_uuid: UUID):
+        # 创建或者更新building floor connects
+        building_floor2 = self.building_floors.get(floor_uuid2)
+        # floor_uuid1  默认不做校验
+        if building_floor2 is None:
+            # 联通楼宇floor uuid错误
+            raise
+        if building_floor2["building_uuid"] == building_uuid:
+            # 联通了同一栋楼宇
+            raise
+        floor_uuid2 = building_floor2["uuid"]
+        pair = {floor_uuid1, floor_uuid2}
+        if any({i["floor_uuid_1"], i["floor_uuid_2"]} == pair for i in self.connects):
+            # 联通关系已经存在  不允许 floor_uuid_1 floor_uuid_2 关联两次  即使位置不同
+            return
+        # 如果此前floor uuid 1 有其他 联通楼层  则替换掉
+        for connect in self.connects:
+            if connect["floor_uuid_1"] == floor_uuid1:
+                self._set(
+                    BuildingFloorConnector,
+                    connect,
+                    floor_uuid_2=floor_uuid2,
+                    building_uuid_2=building_floor2["building_uuid"],
+                )
+                return
+        connect = self._add(
+            BuildingFloorConnector,
+            site_uuid=self.site.uuid,
             building_uuid_1=building_uuid,
             floor_uuid_1=floor_uuid1,
-            building_uuid_2=building_floor2.building_uuid,
+            building_uuid_2=building_floor2["building_uuid"],
             floor_uuid_2=floor_uuid2,
+            is_delete=0,
         )
-        session.add(connect)
-        session.flush()
-
-
-def clean_connects(floor_uuid1: UUID):
-    # 清除联通关系
-    connect = (
-        session.query(BuildingFloorConnector)
-        .filter(
-            BuildingFloorConnector.floor_uuid_1 == floor_uuid1,
-            BuildingFloorConnector.is_delete == 0,
-        )
-        # todo 如果某一层联通了多个楼层 则此处使用scalar 会出错
-        .scalar()
-    )
-    if connect:
-        connect.is_delete = 1
-    session.flush()
-
-
-def _update_facility_group(
-    groups: list, groups_db_map: dict, site_uuid: UUID, building_uuid: UUID = None
-):
-    # 修改分组信息
-    # 比较特别的是elevator和robot组
-    # elevator有building uuid 没有building floor uuid
-    # robot 两者都没有
-    # 组内数据members可以移动 所以要刷新group index
-    # 分组数据比较特别 可以更新分组  也可以新增分组 但是不允许新增空的分组
-    # 允许把已有的分组members全部挪到别的分组去（这种方式产生空的分组  是被允许的）
-    # 可以创建新的分组 不带uuid即可 新增组的members不可为空
-    unit_type = groups[0]["unit_type"]
-    if not groups:
-        return
-
-    old_members = []
-    for _, groups_db in groups_db_map.items():
-        if groups_db.unit_type == unit_type:
-            old_members.extend(groups_db.members)
-
-    new_members = [j["uuid"] for j in chain(*[i["members"] for i in groups])]
-    if set(old_members) != set(new_members):
-        logger.error(f"组成员前后不一致old_members{old_members}， new_members：{new_members}， unit_type:{unit_type}")
-        raise
+        self.connects.append(connect)
+
+    def _clean_connects(self, floor_uuid1: UUID):
+        # 清除联通关系
+        for connect in [i for i in self.connects if i["floor_uuid_1"] == floor_uuid1]:
+            self.connects.remove(connect)
+            if connect in self.inserts[BuildingFloorConnector]:
+                self.inserts[BuildingFloorConnector].remove(connect)
+            else:
+                self.updates[BuildingFloorConnector].setdefault(
+                    connect["uuid"], {"uuid": connect["uuid"]}
+                )["is_delete"] = 1
+
+    def _compare_groups(
+        self, groups: list, groups_db: dict, building_uuid: Optional[UUID] = None
+    ):
+        # 修改分组信息
+        # 比较特别的是elevator和robot组
+        # elevator有building uuid 没有building floor uuid
+        # robot 两者都没有
+        # 组内数据members可以移动 所以要刷新group index
+        # 分组数据比较特别 可以更新分组  也可以新增分组 但是不允许新增空的分组
+        # 允许把已有的分组members全部挪到别的分组去（这种方式产生空的分组  是被允许的）
+        # 可以创建新的分组 不带uuid即可 新增组的members不可为空
+        if not groups:
+            return
+        unit_type = groups[0]["unit_type"]
+
+        old_members = []
+        for group_db in groups_db.values():
+            if group_db["unit_type"] == unit_type:
+                old_members.extend(group_db["members"])
+
+        new_members = [j["uuid"] for j in chain(*[i["members"] for i in groups])]
+        if set(old_members) != set(new_members):
+            logger.error(
+                f"组成员前后不一致old_members{old_members}， new_members：{new_members}， unit_type:{unit_type}"
+            )
+            raise
 
-    for group in groups:
-        group_member_list = [i["uuid"] for i in group["members"]]
         cls = FloorFacility
         if unit_type == Unit.UNIT_TYPE_ROBOT:
             cls = Robot
         if unit_type == Unit.UNIT_TYPE_ELEVATOR:
             cls = Elevator
-        members_db = session.query(cls).filter(cls.uuid.in_(group_member_list)).all()
-        members_db_map = {str(i.uuid): i for i in members_db}
-
-        assert len(members_db) == len(group_member_list), "members uuid  错误"
-        if group.get("building_floor_uuid"):
-            bf: BuildingFloor = BuildingFloor.get_by_uuid(
-                UUID(group["building_floor_uuid"])
+        members_db = self.members[cls]
+
+        for group in groups:
+            group_member_list = [i["uuid"] for i in group["members"]]
+            assert all(i in members_db for i in group_member_list), "members uuid  错误"
+
+            building_floor_uuid = group.get("building_floor_uuid") or None
+            if building_floor_uuid:
+                if building_floor_uuid not in self.building_floors:
+                    raise
+                building_floor_uuid = UUID(building_floor_uuid)
+
+            if group.get("uuid"):
+                # 更新
+                group_db = groups_db[group["uuid"]]
+                self._set(
+                    SiteGroup,
+                    group_db,
+                    name=group["name"],
+                    building_floor_uuid=building_floor_uuid,
+                    members=group_member_list,
+                )
+            else:
+                # 新增 不可新增空members group
+                if not group_member_list:
+                    raise
+                group_db = self._add(
+                    SiteGroup,
+                    name=group["name"],
+                    site_uuid=self.site.uuid,
+                    building_uuid=building_uuid,
+                    building_floor_uuid=building_floor_uuid,
+                    unit_type=unit_type,
+                    members=group_member_list,
+                )
+
+            group_uuid = group_db["uuid"]
+            for member in group["members"]:
+                # 很容易忘记修改site facility unit 的group uuid
+                sfu = self.facility_units.get(member["uuid"])
+                if sfu is not None and sfu["group_uuid"] != group_uuid:
+                    self.touched_groups.update([sfu["group_uuid"], group_uuid])
+                    if sfu["unit_uuid"]:
+                        self.moved_units.add(sfu["unit_uuid"])
+                    self._set(SiteFacilityUnit, sfu, group_uuid=group_uuid)
+
+                values = {"group_uuid": group_uuid}
+                if cls == Robot:
+                    values["name"] = member["name"]
+                if cls == FloorFacility:
+                    # elevator 只修改分组信息
+                    values["name"] = member["name"]
+                    values["direction"] = member.get("direction")
+                    values["building_floor_uuid"] = building_floor_uuid
+                self._set(cls, members_db[member["uuid"]], **values)
+
+    def apply(self) -> dict:
+        # 新增分组整块预留sid
+        new_groups = self.inserts[SiteGroup]
+        if new_groups:
+            first = SiteSidCounter.reserve(
+                self.site.uuid, SiteSidCounter.SID_TYPE_GROUP, len(new_groups)
             )
-            if not bf:
-                raise
-        if group.get("uuid"):
-            # 更新
-            groups_db = groups_db_map[group["uuid"]]
-            groups_db.name = group["name"]
-            groups_db.building_floor_uuid = group.get("building_floor_uuid") or None
-            groups_db.members = group_member_list
-
-        else:
-            # 新增 不可新增空members group
-            if not group_member_list:
-                raise
-
-            groups_db = _bootstrap_group(
-                site_uuid,
-                building_uuid,
-                group.get("building_floor_uuid") or None,
-                group["name"],
-                unit_type,
-                0,
-                group_member_list,
-            )
-
-        # update site_facility_unit
-        sfus = (
-            session.query(SiteFacilityUnit)
-            .filter(SiteFacilityUnit.site_uuid == site_uuid)
-            .filter(SiteFacilityUnit.facility_uuid.in_(group_member_list))
-            .all()
-        )
-        for sfu in sfus:
-            # 很容易忘记修改site facility unit 的group uuid
-            sfu.group_uuid = groups_db.uuid
-
-        for member in group["members"]:
-            member_db = members_db_map[member["uuid"]]
-            member_db.group_uuid = groups_db.uuid
-            if cls == Robot:
-                member_db.name = member["name"]
-            if cls != Elevator:
-                # elevator 只修改分组信息
-                member_db.name = member["name"]
-                member_db.direction = member.get("direction")
-                # members_db.building_uuid = group.get("building_uuid")
-                member_db.building_floor_uuid = group.get("building_floor_uuid") or None
+            for idx, row in enumerate(new_groups):
+                row["facility_group_sid"] = first + idx
+
+        for cls in self.TABLES:
+            if self.inserts[cls]:
+                session.bulk_insert_mappings(cls, self.inserts[cls])
+        for cls in self.TABLES:
+            if self.updates[cls]:
+                session.bulk_update_mappings(cls, list(self.updates[cls].values()))
+        # 刷新facility分组下标
+        flush_group_index(self.site.uuid, self.touched_groups)
+        unit_resolver.invalidate(self.moved_units)
+        return self.report()
+
+    def report(self) -> dict:
+        # 变更报告  {"created": {table: [uuid]}, "updated": {table: {uuid: {field: value}}}}
+        def jsonable(value):
+            if isinstance(value, UUID):
+                return str(value)
+            return value
+
+        report = {}
+        for cls in self.TABLES:
+            table = cls.__tablename__
+            if self.inserts[cls]:
+                report.setdefault("created", {})[table] = [
+                    str(i["uuid"]) for i in self.inserts[cls]
+                ]
+            if self.updates[cls]:
+                report.setdefault("updated", {})[table] = {
+                    str(row_uuid): {
+                        k: jsonable(v) for k, v in values.items() if k != "uuid"
+                    }
+                    for row_uuid, values in self.updates[cls].items()
+                }
+        return report
@@ -1,7 +1,9 @@
+import datetime
 import logging
 from uuid import UUID
 from typing import Optional
-from sqlalchemy import func
+from sqlalchemy import bindparam, func, text
+from app.handlers.units import unit_resolver
 from app.models import (
     Site,
     Building,
@@ -13,8 +15,10 @@ from app.models import (
     FloorFacility,
     SiteGroup,
     SiteFacilityUnit,
+    SiteChangeLog,
     Robot,
     Unit,
+    bakery,
     session,
 )
 
@@ -30,12 +34,17 @@ logger = logging.getLogger(__name__)
 
 def get_unbind_unit(unit_type: int, limit: int = 10, offset: int = 1) -> list:
 
-    # 获取所有未绑定的unit
+    # 获取所有未绑定的unit  offset为页码 从1开始
+    query = bakery(lambda s: s.query(Cmdb))
+    query += lambda q: (
+        q.filter(Cmdb.site_uuid == None, Cmdb.unit_type == bindparam("unit_type"))
+        .limit(bindparam("limit"))
+        .offset(bindparam("offset"))
+    )
     units = (
-        session.query(Cmdb)
-        .filter(Cmdb.site_uuid == None, Cmdb.unit_type == unit_type)
-        .paginate(offset, limit)
-        .items
+        query(session())
+        .params(unit_type=unit_type, limit=limit, offset=(offset - 1) * limit)
+        .all()
     )
     return [i.get_unit_info() for i in units]
 
@@ -71,101 +80,201 @@ def unbind_cmdb_unit(unit_uuid: UUID):
     session.flush()
 
 
-def bind_site_unit(
-    site_uuid: UUID,
-    site_uid: int,
-    unit_uuid: UUID,
-    facility_uuid: UUID,
-    force: bool = False,
-):
-    # site端加绑
-    cmdb = session.query(Cmdb).filter(Cmdb.unit_uuid == unit_uuid).scalar()
-    if not cmdb:
-        # 绑定iot不存在
-        raise
-
-    # iot设备此前是否已经绑定  如果绑定则根据force参数决定是否强制加解绑定
-    old_sfu = (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.unit_uuid == unit_uuid)
-        .first()
+# 批量解绑  cmdb和site facility unit在同一条语句中修改
+UNBIND_SQL = text(
+    """
+    WITH v AS (
+        SELECT * FROM unnest(CAST(:facility_uuids AS uuid[]), CAST(:unit_uuids AS uuid[]))
+            AS t(facility_uuid, unit_uuid)
+    ), c AS (
+        UPDATE public.cmdb
+        SET site_uuid = NULL, site_uid = 0, facility_uuid = NULL, modify_time = :now
+        FROM v
+        WHERE cmdb.unit_uuid = v.unit_uuid
     )
-    if old_sfu:
-        if force:
-            unbind_site_unit(old_sfu.facility_uuid)
-        else:
-            logger.error(
-                "Unit already bind to another facility, unit_uuid = {}, facility_uuid = {}".format(
-                    unit_uuid, facility_uuid
-                )
-            )
-            raise
+    UPDATE public.site_facility_unit
+    SET unit_uuid = NULL, unit_name = '', unit_uid = NULL, modify_time = :now
+    FROM v
+    WHERE site_facility_unit.facility_uuid = v.facility_uuid
+    RETURNING site_facility_unit.uuid, site_facility_unit.unit_uuid,
+        site_facility_unit.unit_name, site_facility_unit.unit_uid
+    """
+)
 
-    new_sfu = (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.facility_uuid == facility_uuid)
-        .scalar()
+# 批量加绑  cmdb改写后返回资产信息  再写入site facility unit
+BIND_SQL = text(
+    """
+    WITH v AS (
+        SELECT * FROM unnest(CAST(:facility_uuids AS uuid[]), CAST(:unit_uuids AS uuid[]))
+            AS t(facility_uuid, unit_uuid)
+    ), c AS (
+        UPDATE public.cmdb
+        SET site_uuid = :site_uuid, site_uid = :site_uid,
+            facility_uuid = v.facility_uuid, modify_time = :now
+        FROM v
+        WHERE cmdb.unit_uuid = v.unit_uuid
+        RETURNING v.facility_uuid, cmdb.unit_uuid, cmdb.unit_name, cmdb.unit_uid
     )
-    if not new_sfu:
-        # 要绑定的设施不存在
-        raise
-    if new_sfu.unit_type != cmdb.unit_type:
+    UPDATE public.site_facility_unit
+    SET unit_uuid = c.unit_uuid, unit_name = c.unit_name, unit_uid = c.unit_uid,
+        modify_time = :now
+    FROM c
+    WHERE site_facility_unit.facility_uuid = c.facility_uuid
+    RETURNING site_facility_unit.uuid, site_facility_unit.unit_uuid,
+        site_facility_unit.unit_name, site_facility_unit.unit_uid
+    """
+)
+
 
-        logger.error(
-            "Unit type not matched with CMDB, unit_uuid = {}, unit_name = {}, unit_type = {}, cmdb_type = {}".format(
-                unit_uuid, cmdb.unit_name, new_sfu.unit_type, cmdb.unit_type
+class SiteUnitBinder(object):
+    """
+    批量加解绑
+    先用固定次数的查询校验整批数据  再各用一条语句同时修改cmdb和site facility unit
+    与逐个调用bind_site_unit/unbind_site_unit的校验和报错一致
+    bind/unbind各自先完成全部校验再写入  校验失败时没有任何写入
+    session没有提交也没有回滚  由调用方决定
+    """
+
+    def __init__(self, site_uuid: UUID, site_uid: int):
+        self.site_uuid = site_uuid
+        self.site_uid = site_uid
+        # 改写过的site facility unit  uuid => 绑定字段  用于写变更日志
+        self.updates = {}
+        # 加解绑过的unit  提交后再清一次缓存
+        self.unit_uuids = set()
+
+    @staticmethod
+    def _facility_units(key: str, values: list) -> dict:
+        # key: facility_uuid 或 unit_uuid  返回 key => row
+        rows = (
+            session.query(
+                SiteFacilityUnit.facility_uuid,
+                SiteFacilityUnit.unit_uuid,
+                SiteFacilityUnit.unit_type,
             )
+            .filter(getattr(SiteFacilityUnit, key).in_(values))
+            .all()
         )
-        raise
+        return {getattr(i, key): i for i in rows}
 
-    try:
-        bind_cmdb_unit(site_uuid, site_uid, facility_uuid, unit_uuid, new_sfu.unit_type)
+    @staticmethod
+    def _cmdbs(unit_uuids: list) -> dict:
+        rows = (
+            session.query(Cmdb.unit_uuid, Cmdb.unit_type, Cmdb.unit_name)
+            .filter(Cmdb.unit_uuid.in_(unit_uuids))
+            .all()
+        )
+        return {i.unit_uuid: i for i in rows}
+
+    def _execute(self, sql, pairs: list, **params):
+        rows = session.execute(
+            sql,
+            dict(
+                facility_uuids=[str(i[0]) for i in pairs],
+                unit_uuids=[str(i[1]) for i in pairs],
+                now=datetime.datetime.now(),
+                **params,
+            ),
+        )
+        for row in rows:
+            self.updates.setdefault(row.uuid, {}).update(
+                unit_uuid=row.unit_uuid, unit_name=row.unit_name, unit_uid=row.unit_uid
+            )
+        unit_uuids = {i[1] for i in pairs}
+        self.unit_uuids.update(unit_uuids)
+        unit_resolver.invalidate(unit_uuids)
+
+    def _unbind_pairs(self, facility_uuids: list) -> list:
+        # 校验  返回要解绑的(facility_uuid, unit_uuid)
+        if not facility_uuids:
+            return []
+        sfus = self._facility_units("facility_uuid", facility_uuids)
+        if len(sfus) != len(set(facility_uuids)):
+            # 要解绑定的设施不存在
+            raise
 
-        new_sfu.unit_uuid = unit_uuid
-        new_sfu.unit_name = cmdb.unit_name
-        new_sfu.unit_uid = cmdb.unit_uid
-        # 注意此处session没有提交
-        session.flush()
-    except Exception as e:
-        logger.error(e)
-        session.rollback()
-        raise
+        # 未绑定的设施无需解绑
+        pairs = [(i.facility_uuid, i.unit_uuid) for i in sfus.values() if i.unit_uuid]
+        if pairs and len(self._cmdbs([i[1] for i in pairs])) != len(pairs):
+            # 绑定iot不存在
+            raise
+        return pairs
+
+    def unbind(self, facility_uuids: list):
+        self._unbind(self._unbind_pairs(facility_uuids))
+
+    def _unbind(self, pairs: list):
+        if not pairs:
+            return
+        self._execute(UNBIND_SQL, pairs)
+        for facility_uuid, _ in pairs:
+            logger.info("bind facility {} -> NONE".format(facility_uuid))
+
+    def bind(self, pairs: list, force: bool = False):
+        # pairs: [(facility_uuid, unit_uuid)]
+        if not pairs:
+            return
+        unit_uuids = [i[1] for i in pairs]
+        cmdbs = self._cmdbs(unit_uuids)
+        if len(cmdbs) != len(set(unit_uuids)):
+            # 绑定iot不存在
+            raise
 
-    logger.info("bind facility {} -> {}".format(facility_uuid, unit_uuid))
+        # iot设备此前是否已经绑定  如果绑定则根据force参数决定是否强制加解绑定
+        old_sfus = self._facility_units("unit_uuid", unit_uuids)
+        if old_sfus and not force:
+            for i in old_sfus.values():
+                logger.error(
+                    "Unit already bind to another facility, unit_uuid = {}, facility_uuid = {}".format(
+                        i.unit_uuid, i.facility_uuid
+                    )
+                )
+            raise
 
+        new_sfus = self._facility_units("facility_uuid", [i[0] for i in pairs])
+        for facility_uuid, unit_uuid in pairs:
+            new_sfu = new_sfus.get(facility_uuid)
+            if not new_sfu:
+                # 要绑定的设施不存在
+                raise
+            cmdb = cmdbs[unit_uuid]
+            if new_sfu.unit_type != cmdb.unit_type:
+                logger.error(
+                    "Unit type not matched with CMDB, unit_uuid = {}, unit_name = {}, unit_type = {}, cmdb_type = {}".format(
+                        unit_uuid, cmdb.unit_name, new_sfu.unit_type, cmdb.unit_type
+                    )
+                )
+                raise
 
-def unbind_site_unit(facility_uuid: UUID,):
-    new_sfu = (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.facility_uuid == facility_uuid)
-        .scalar()
-    )
-    if not new_sfu:
-        # 要解绑定的设施不存在
-        raise
+        # 校验全部通过后再强制解绑
+        self._unbind(self._unbind_pairs([i.facility_uuid for i in old_sfus.values()]))
+        self._execute(
+            BIND_SQL, pairs, site_uuid=str(self.site_uuid), site_uid=self.site_uid
+        )
+        for facility_uuid, unit_uuid in pairs:
+            logger.info("bind facility {} -> {}".format(facility_uuid, unit_uuid))
 
-    if not new_sfu.unit_uuid:
-        return
 
-    try:
-        unbind_cmdb_unit(new_sfu.unit_uuid)
+def bind_site_unit(
+    site_uuid: UUID,
+    site_uid: int,
+    unit_uuid: UUID,
+    facility_uuid: UUID,
+    force: bool = False,
+):
+    # site端加绑  校验失败时不修改session  注意此处session没有提交
+    SiteUnitBinder(site_uuid, site_uid).bind([(facility_uuid, unit_uuid)], force)
 
-        new_sfu.unit_uuid = None
-        new_sfu.unit_name = ""
-        new_sfu.unit_uid = None
-        # 注意此处session没有提交
-        session.flush()
-    except Exception as e:
-        logger.error(e)
-        session.rollback()
-        raise
 
-    logger.info("bind facility {} -> NONE".format(facility_uuid))
+def unbind_site_unit(facility_uuid: UUID,):
+    SiteUnitBinder(None, None).unbind([facility_uuid])
 
 
 def get_buildings_bind_units(building_uuid: UUID, unit_type: int) -> list:
     # 获取building下已经绑定的units
-    building = session.query(Building).filter(Building.uuid == building_uuid).scalar()
+    query = bakery(lambda s: s.query(Building))
+    query += lambda q: q.filter(Building.uuid == bindparam("building_uuid"))
+    building = query(session()).params(building_uuid=building_uuid).scalar()
 
     def get_info(info):
         return {
@@ -186,24 +295,25 @@ def get_buildings_bind_units(building_uuid: UUID, unit_type: int) -> list:
     }
 
     members = mappings[unit_type]
-    sfus = (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.unit_uuid != None)
-        .filter(SiteFacilityUnit.facility_uuid.in_(members))
-        .all()
+    query = bakery(lambda s: s.query(SiteFacilityUnit))
+    query += lambda q: (
+        q.filter(SiteFacilityUnit.unit_uuid != None).filter(
+            SiteFacilityUnit.facility_uuid.in_(bindparam("members", expanding=True))
+        )
     )
+    sfus = query(session()).params(members=members).all()
     return [get_info(i) for i in sfus]
 
 
 def get_bond_robots(site_uuid: UUID) -> list:
     # site下已经绑定的robot
-    return (
-        session.query(SiteFacilityUnit)
-        .filter(SiteFacilityUnit.site_uuid == site_uuid)
+    query = bakery(lambda s: s.query(SiteFacilityUnit))
+    query += lambda q: (
+        q.filter(SiteFacilityUnit.site_uuid == bindparam("site_uuid"))
         .filter(SiteFacilityUnit.unit_uuid != None)
         .filter(SiteFacilityUnit.unit_type == Unit.UNIT_TYPE_ROBOT)
-        .all()
     )
+    return query(session()).params(site_uuid=site_uuid).all()
 
 
 def get_unit_list(unit_type: int, site_uuid: UUID, building_uuid: UUID = None) -> list:
@@ -237,90 +347,86 @@ def update_bind_facility(site_uuid: UUID, new_bind_facility: list, unit_type: in
     if not new_bind_facility:
         return
     site = session.query(Site).get(site_uuid)
-    site.version_id += 1
+    if site is None:
+        # site不存在
+        raise
 
     # 前端传过来的uuid  这里要求前端要把site下同building下所有同类型的facility数据传过来 后台作比较验证
     # 如果是robot 则没有building限制
-    front_facility_uuids = [i.get("facility_uuid") for i in new_bind_facility]
-    sfus = (
-        session.query(SiteFacilityUnit)
+    front_facility_uuids = [UUID(i.get("facility_uuid")) for i in new_bind_facility]
+    sfu_count = (
+        session.query(func.count(SiteFacilityUnit.uuid))
         .filter(SiteFacilityUnit.facility_uuid.in_(front_facility_uuids))
-        .all()
+        .scalar()
     )
-    session.flush()
-    assert len(sfus) == len(set(front_facility_uuids))
+    assert sfu_count == len(set(front_facility_uuids))
 
     # 同一个building下的facility解绑后可以再次绑定到同building下其他的facility上
     # 此前绑定过的组合就无需再次绑定 未绑定的组合调用绑定方法即可
     # facility_uuid, unit_uuid 组成元组  以元组为单位区分此前是否绑定过
 
     new_bind_list = [
-        (i.get("facility_uuid"), i.get("unit_uuid"))
+        (UUID(i.get("facility_uuid")), UUID(i.get("unit_uuid")))
         for i in new_bind_facility
         if i.get("unit_uuid")
     ]
 
-    one_faility_uuid = new_bind_facility[0]["facility_uuid"]
+    old_sfus = session.query(
+        SiteFacilityUnit.facility_uuid, SiteFacilityUnit.unit_uuid
+    ).filter(SiteFacilityUnit.unit_uuid != None)
     if unit_type != Unit.UNIT_TYPE_ROBOT:
         if unit_type == Unit.UNIT_TYPE_ELEVATOR:
             cls = Elevator
         else:
             cls = FloorFacility
 
-        facility = session.query(cls).get(one_faility_uuid)
-        building_uuid = facility.building_uuid
-
-        groups = (
-            session.query(SiteGroup)
-            .filter(
-                SiteGroup.unit_type == unit_type,
-                SiteGroup.building_uuid == building_uuid,
-            )
-            .all()
+        building_uuid = (
+            session.query(cls.building_uuid)
+            .filter(cls.uuid == front_facility_uuids[0])
+            .one()
+            .building_uuid
         )
-        one_building_groups = [i.uuid for i in groups]
-        old_sfus = (
-            session.query(SiteFacilityUnit)
-            .filter(SiteFacilityUnit.group_uuid.in_(one_building_groups))
-            .all()
+        one_building_groups = session.query(SiteGroup.uuid).filter(
+            SiteGroup.unit_type == unit_type, SiteGroup.building_uuid == building_uuid
+        )
+        old_sfus = old_sfus.filter(
+            SiteFacilityUnit.group_uuid.in_(one_building_groups.subquery())
         )
-        old_bind_list = [
-            (str(i.facility_uuid), str(i.unit_uuid)) for i in old_sfus if i.unit_uuid
-        ]
     else:
-        binded_sfu = (
-            session.query(SiteFacilityUnit)
-            .filter(
-                SiteFacilityUnit.site_uuid == site_uuid,
-                SiteFacilityUnit.unit_type == unit_type,
-                SiteFacilityUnit.unit_uuid != None,
-            )
-            .all()
+        old_sfus = old_sfus.filter(
+            SiteFacilityUnit.site_uuid == site_uuid,
+            SiteFacilityUnit.unit_type == unit_type,
         )
-        old_bind_list = [(str(i.facility_uuid), str(i.unit_uuid)) for i in binded_sfu]
+    old_bind_set = {(i.facility_uuid, i.unit_uuid) for i in old_sfus}
 
     facility_uuid_list = [i[0] for i in new_bind_list]
     unit_uuid_list = [i[1] for i in new_bind_list]
     if len(set(facility_uuid_list)) != len(set(unit_uuid_list)):
         # 重复绑定
-        session.flush()
         raise
 
-    for old in old_bind_list:
-        if old not in new_bind_list:
-            unbind_site_unit(UUID(old[0]))
-
-    for new_ in new_bind_list:
-        if new_ not in old_bind_list:
-            bind_site_unit(site.uuid, site.site_uid, UUID(new_[1]), UUID(new_[0]))
+    new_bind_set = set(new_bind_list)
+    to_unbind = [i[0] for i in old_bind_set if i not in new_bind_set]
+    to_bind = [i for i in new_bind_list if i not in old_bind_set]
+    if len(set(to_bind)) != len(to_bind):
+        # 同一组合提交了两次  第二次绑定时设备已经被绑定
+        raise
 
-    session.flush()
+    binder = SiteUnitBinder(site.uuid, site.site_uid)
     try:
+        binder.unbind(to_unbind)
+        binder.bind(to_bind)
+        site.version_id += 1
+        SiteChangeLog.record(
+            site.uuid, site.version_id, updates={SiteFacilityUnit: binder.updates}
+        )
         session.commit()
     except Exception as e:
         logger.error(e)
         session.rollback()
         raise
+    # 提交前清除的缓存可能已被并发请求以旧数据回填
+    unit_resolver.invalidate(binder.unit_uuids)
 
     logger.info(
         "[API.SECTION_UPDATE] update_section_facility(site_uuid={}, new_section_facility={})".format(
@@ -0,0 +1,140 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+site列表查询
+
+API
+
+    GET `/sites?name=`                      全部site  一次性返回列表
+    GET `/sites?name=&after=&limit=`        按site_uid分页  after为上一页返回的next_after
+    Response =>
+    {
+        "items": [...],
+        "next_after": 1024,     # 没有下一页时为null
+    }
+
+    GET `/sites?name=&stream=ndjson|json`   流式返回全部site  服务端游标逐批读取  内存占用与site数量无关
+
+    GET `/sites?search=&limit=`             按名称/地址相似度排序  返回前limit个
+    Response =>
+    [
+        {..., "score": 0.8},
+    ]
+"""
+import json
+from typing import Iterator, Optional
+
+from sqlalchemy import func, or_
+
+from app.models import Site, session
+
+# 分页默认与最大条数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# 相似度搜索默认返回条数
+DEFAULT_SEARCH_SIZE = 20
+# 流式返回时每批从游标读取的行数
+STREAM_BATCH_SIZE = 500
+
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+
+def parse_site(site: Site):
+    return {
+        "site_uid": site.site_uid,
+        "uuid": str(site.uuid),
+        "name": site.name,
+        "status": site.status,
+        "address": site.address,
+        "has_building_connector": site.has_building_connector,
+        "business_types": site.business_types,
+        "location": site.location,
+        "meta_info": site.meta_info,
+    }
+
+
+def query_sites(name: Optional[str] = None):
+    # 只查parse_site需要的列  不构造ORM对象
+    sites = session.query(
+        Site.site_uid,
+        Site.uuid,
+        Site.name,
+        Site.status,
+        Site.address,
+        Site.has_building_connector,
+        Site.business_types,
+        Site.location,
+        Site.meta_info,
+    )
+    if name:
+        sites = sites.filter(Site.name.ilike(f"%{name}%"))
+    return sites
+
+
+def get_sites(name: Optional[str] = None) -> list:
+    return [parse_site(i) for i in query_sites(name)]
+
+
+def page_size(limit: Optional[int], default: int) -> int:
+    # 未传或为0时取默认值  限制在[1, MAX_PAGE_SIZE]  负数不能直接用作LIMIT
+    return max(1, min(limit or default, MAX_PAGE_SIZE))
+
+
+def get_sites_page(
+    name: Optional[str] = None, after: Optional[int] = None, limit: Optional[int] = None
+) -> dict:
+    # keyset分页  按site_uid升序  翻页代价与页码无关
+    limit = page_size(limit, DEFAULT_PAGE_SIZE)
+    sites = query_sites(name)
+    if after is not None:
+        sites = sites.filter(Site.site_uid > after)
+    # 多取一条判断是否还有下一页
+    rows = sites.order_by(Site.site_uid).limit(limit + 1).all()
+    items = [parse_site(i) for i in rows[:limit]]
+    return {
+        "items": items,
+        "next_after": items[-1]["site_uid"] if len(rows) > limit else None,
+    }
+
+
+def iter_sites(name: Optional[str] = None, fmt: str = "ndjson") -> Iterator[str]:
+    # 流式返回  stream_results使用服务端游标  yield_per每批只缓存STREAM_BATCH_SIZE行
+    sites = (
+        query_sites(name)
+        .order_by(Site.site_uid)
+        .execution_options(stream_results=True)
+        .yield_per(STREAM_BATCH_SIZE)
+    )
+    if fmt == "ndjson":
+        for site in sites:
+            yield json.dumps(parse_site(site)) + "\n"
+        return
+
+    yield "["
+    for idx, site in enumerate(sites):
+        yield ("," if idx else "") + json.dumps(parse_site(site))
+    yield "]\n"
+
+
+def search_sites(search: str, limit: Optional[int] = None) -> list:
+    # 子串匹配或相似度超过pg_trgm阈值的site  均可走ix_site_name_trgm/ix_site_address_trgm
+    limit = page_size(limit, DEFAULT_SEARCH_SIZE)
+    pattern = f"%{search}%"
+    score = func.greatest(
+        func.similarity(Site.name, search), func.similarity(Site.address, search)
+    ).label("score")
+    sites = (
+        query_sites()
+        .add_columns(score)
+        .filter(
+            or_(
+                Site.name.ilike(pattern),
+                Site.address.ilike(pattern),
+                Site.name.op("%%")(search),
+                Site.address.op("%%")(search),
+            )
+        )
+        .order_by(score.desc(), Site.site_uid)
+        .limit(limit)
+    )
+    return [dict(parse_site(i), score=i.score) for i in sites]
@@ -0,0 +1,110 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+iot设备启动时按unit_uuid查询所属site、sid与组内编号
+
+API
+
+    POST `/units/resolve`
+    Request => ["unit_uuid", ...]
+    Response =>
+    {
+        "unit_uuid": {...SiteFacilityUnit.get_site_info...},   # 未绑定或不存在时为null
+    }
+
+整栋楼断电后大量设备同时重启  同一批请求集中到达
+    L1  进程内LRU  命中时不访问redis和数据库
+    L2  共享cache(redis)  多进程/多实例共享
+    未绑定的unit_uuid同样缓存  有效期较短
+    同一unit_uuid并发未命中时只有一个请求查库  其余等待其结果
+绑定关系与组内编号变化时清除对应unit的缓存
+"""
+import json
+import logging
+from typing import Iterable
+from uuid import UUID
+
+from app.cache import TieredCache, SingleFlight
+from app.models import SiteGroup, SiteFacilityUnit, session
+
+logger = logging.getLogger(__name__)
+
+# 已绑定unit的缓存时间
+UNIT_CACHE_TTL = 600
+# 未绑定unit的缓存时间
+UNIT_NEGATIVE_TTL = 30
+# 进程内缓存  其他进程清除缓存后最多延迟UNIT_L1_TTL秒生效
+UNIT_L1_TTL = 5
+UNIT_L1_MAX_ENTRIES = 10000
+
+NEGATIVE = "null"
+
+
+class UnitSiteResolver(object):
+    def __init__(self):
+        self.cache = TieredCache("unit_site", UNIT_L1_MAX_ENTRIES, UNIT_L1_TTL)
+        self.flight = SingleFlight()
+
+    def resolve(self, unit_uuids: Iterable) -> dict:
+        # unit_uuid不合法时抛出ValueError
+        keys = list(dict.fromkeys(str(UUID(str(i))) for i in unit_uuids))
+        result = {k: json.loads(v) for k, v in self.cache.get_many(keys).items()}
+        missing = [k for k in keys if k not in result]
+        if missing:
+            result.update(self.flight.do_many(missing, self._load))
+        return result
+
+    def _load(self, keys: list) -> dict:
+        rows = (
+            session.query(
+                SiteFacilityUnit.site_uuid,
+                SiteFacilityUnit.site_uid,
+                SiteFacilityUnit.unit_type,
+                SiteFacilityUnit.unit_uuid,
+                SiteFacilityUnit.unit_uid,
+                SiteFacilityUnit.facility_sid,
+                SiteGroup.facility_group_sid,
+                SiteFacilityUnit.facility_group_index,
+                SiteFacilityUnit.unit_name,
+            )
+            .outerjoin(SiteGroup, SiteGroup.uuid == SiteFacilityUnit.group_uuid)
+            .filter(SiteFacilityUnit.unit_uuid.in_(keys))
+        )
+        found = {}
+        for row in rows:
+            if row.facility_group_sid is None:
+                # SiteGroupNotFound  与get_site_info一样视为无法解析
+                logger.error(f"site group not found for unit {row.unit_uuid}")
+                continue
+            # 与SiteFacilityUnit.get_site_info一致
+            found[str(row.unit_uuid)] = {
+                "site_uuid": str(row.site_uuid),
+                "site_uid": row.site_uid,
+                "unit_type": row.unit_type,
+                "unit_uuid": str(row.unit_uuid),
+                "unit_uid": row.unit_uid,
+                "unit_sid": row.facility_sid,
+                "unit_group_sid": row.facility_group_sid,
+                "unit_group_index": row.facility_group_index,
+                "unit_name": row.unit_name,
+            }
+
+        self.cache.set_many(
+            {k: json.dumps(v) for k, v in found.items()}, UNIT_CACHE_TTL
+        )
+        self.cache.set_many(
+            {k: NEGATIVE for k in keys if k not in found}, UNIT_NEGATIVE_TTL
+        )
+        return {k: found.get(k) for k in keys}
+
+    def invalidate(self, unit_uuids: Iterable):
+        keys = {str(i) for i in unit_uuids if i}
+        if keys:
+            self.cache.delete(keys)
+
+
+unit_resolver = UnitSiteResolver()
+
+
+def resolve_units(unit_uuids: Iterable) -> dict:
+    return unit_resolver.resolve(unit_uuids)
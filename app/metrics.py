@@ -0,0 +1,157 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+prometheus指标  GET /metrics
+
+    site_api_request_seconds{resource, method}      接口耗时直方图  resource为flask endpoint 如buildingview
+    site_api_sql_queries_total{resource}            sql语句数  来自sqlstats
+    site_api_sql_seconds_total{resource}            sql耗时
+    site_api_errors_total{resource, exception}      异常数  按异常类型
+    site_api_db_pool_wait_seconds                   连接池取连接的等待时间直方图
+    site_api_db_pool_*{database}                    连接池大小、使用中、溢出、空闲  采集时读取
+
+每个请求只做几次字典查找和加法  连接池状态在采集时才读取
+多进程部署时每个进程单独暴露
+"""
+import time
+import weakref
+
+from flask import Response, current_app, g, got_request_exception, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+REQUEST_SECONDS = Histogram(
+    "site_api_request_seconds", "API latency", ["resource", "method"]
+)
+SQL_QUERIES = Counter(
+    "site_api_sql_queries_total", "SQL statements executed", ["resource"]
+)
+SQL_SECONDS = Counter(
+    "site_api_sql_seconds_total", "Time spent in SQL statements", ["resource"]
+)
+ERRORS = Counter(
+    "site_api_errors_total", "Exceptions raised by API", ["resource", "exception"]
+)
+POOL_WAIT_SECONDS = Histogram(
+    "site_api_db_pool_wait_seconds",
+    "Time waiting for a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+
+
+class TimedQueuePool(QueuePool):
+    # 记录取连接的等待时间  连接池用满时等待时间变长
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+
+class PoolCollector(object):
+    # 采集时读取各app engine的连接池状态
+    # 按数据库名只保留最后注册的app  重复create_app不会重复上报  也不会持有已释放的app
+    def __init__(self):
+        self.apps = weakref.WeakValueDictionary()
+
+    def register(self, app):
+        uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+        database = make_url(uri).database if uri else None
+        self.apps[database or ""] = app
+
+    def collect(self):
+        gauges = {
+            name: GaugeMetricFamily(
+                f"site_api_db_pool_{name}", doc, labels=["database"]
+            )
+            for name, doc in (
+                ("size", "Pool size"),
+                ("checked_out", "Connections in use"),
+                ("overflow", "Connections over pool size"),
+                ("checked_in", "Idle connections in pool"),
+            )
+        }
+        for database, app in list(self.apps.items()):
+            state = app.extensions.get("sqlalchemy")
+            if state is None:
+                continue
+            pool = state.db.get_engine(app).pool
+            if not isinstance(pool, QueuePool):
+                continue
+            database = [database]
+            gauges["size"].add_metric(database, pool.size())
+            gauges["checked_out"].add_metric(database, pool.checkedout())
+            gauges["overflow"].add_metric(database, max(pool.overflow(), 0))
+            gauges["checked_in"].add_metric(database, pool.checkedin())
+        return list(gauges.values())
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+
+def resource_name() -> str:
+    return request.endpoint or "unknown"
+
+
+class Metrics(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # engine在第一次使用时创建  此前替换连接池类型即可
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.setdefault("poolclass", TimedQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+        pool_collector.register(app)
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+        got_request_exception.connect(self.on_exception, app)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+        app.extensions["site_metrics"] = self
+
+    @staticmethod
+    def before_request():
+        g.metrics_start = time.perf_counter()
+
+    @staticmethod
+    def teardown_request(exc=None):
+        start = g.get("metrics_start")
+        if start is None:
+            return
+        resource = resource_name()
+        REQUEST_SECONDS.labels(resource, request.method).observe(
+            time.perf_counter() - start
+        )
+        stats = g.get("sql_stats")
+        if stats is not None:
+            SQL_QUERIES.labels(resource).inc(stats.count)
+            SQL_SECONDS.labels(resource).inc(stats.seconds)
+        if exc is not None:
+            Metrics.on_exception(current_app, exc)
+
+    @staticmethod
+    def on_exception(sender, exception, **extra):
+        # flask-restful和flask都会发送信号  同一异常只计一次
+        if g.get("metrics_exception") is exception:
+            return
+        g.metrics_exception = exception
+        ERRORS.labels(resource_name(), type(exception).__name__).inc()
+
+    @staticmethod
+    def metrics_view():
+        return Response(generate_latest(REGISTRY), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
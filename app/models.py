@@ -2,18 +2,27 @@
 # -*- coding: utf-8 -*-
 import datetime
 import uuid
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any
 from app import db
-from sqlalchemy.dialects.postgresql import JSONB, UUID, ARRAY
-from sqlalchemy import func, or_, and_
+from sqlalchemy.dialects.postgresql import JSONB, UUID, ARRAY, insert
+from sqlalchemy import func, or_, and_, event, DDL, bindparam
+from sqlalchemy.ext import baked
 from flask import g
 
 
+# 按线程(gevent下按协程)区分的scoped_session  app context结束时关闭并移除
+# 连接归还连接池  identity map随之释放  不会在请求之间共享对象
+session = db.session
+
+
 def get_session():
-    return db.create_scoped_session(options={"autocommit": False, "autoflush": False})
+    # 当前app context的session
+    return session()
 
 
-session = get_session()
+# 热点查询使用baked query  同一形状的查询只构造和编译一次  之后按参数执行
+# 依赖类的查询需把类作为bakery的参数 参与缓存key
+bakery = baked.bakery()
 
 
 class BaseMixIn(object):
@@ -43,7 +52,9 @@ class BaseMixIn(object):
 
     @classmethod
     def get_by_uuid(cls, cls_uuid):
-        return session.query(cls).filter(cls.uuid == cls_uuid).scalar()
+        query = bakery(lambda s: s.query(cls), cls)
+        query += lambda q: q.filter(cls.uuid == bindparam("uuid"))
+        return query(session()).params(uuid=cls_uuid).scalar()
 
     @property
     def creator_user(self):
@@ -85,9 +96,29 @@ class Direction:
     DIRECTION_BIDIRECTIONAL = 4
 
 
+# site uid 全局递增唯一  由数据库sequence分配  并发创建site不会重复
+site_uid_seq = db.Sequence("site_uid_seq", metadata=db.Model.metadata, schema="public")
+
+
 class Site(db.Model, BaseMixIn):
     __tablename__: str = "site"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_site_site_uid", "site_uid"),
+        # pg_trgm索引  名称/地址的模糊匹配与相似度排序不再全表扫描
+        db.Index(
+            "ix_site_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+        db.Index(
+            "ix_site_address_trgm",
+            "address",
+            postgresql_using="gin",
+            postgresql_ops={"address": "gin_trgm_ops"},
+        ),
+        {"schema": "public"},
+    )
 
     SITE_STATUS_UNKNOWN = 0
     SITE_STATUS_NORMAL = 1
@@ -115,6 +146,10 @@ class Site(db.Model, BaseMixIn):
     section_facility = db.Column(JSONB, nullable=False, default={})
     section_iot = db.Column(JSONB, nullable=False, default={})
 
+    @classmethod
+    def gen_site_uid(cls) -> int:
+        return session.query(func.nextval("public.site_uid_seq")).scalar()
+
     @classmethod
     def encode_business_type(cls, type_str: str) -> int:
         mapping = {
@@ -152,9 +187,18 @@ class Site(db.Model, BaseMixIn):
         return mapping.get(status, "SITE_STATUS_UNKNOWN")
 
 
+# create_all建site表前确保pg_trgm扩展存在  迁移中同样会创建
+event.listen(
+    Site.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+)
+
+
 class Building(db.Model, BaseMixIn):
     __tablename__: str = "building"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_building_site_uuid", "site_uuid", "create_time"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
 
@@ -209,14 +253,24 @@ class Building(db.Model, BaseMixIn):
             .all()
         )
         bfloors = {str(floor.uuid): floor for floor in query}
+        return self.floors_info(
+            self.building_floors, bfloors, get_connect_building_floor_uuid
+        )
 
-        # TODO change to SystemError
-        assert len(bfloors) == len(self.building_floors)
+    @staticmethod
+    def floors_info(floor_uuids: list, bfloors: dict, get_connects) -> list:
+        """Keep order based on building_floors
+        bfloors: floor uuid => floor  get_connects: floor uuid => 联通的floor uuid列表
+        """
+        if len(bfloors) != len(floor_uuids):
+            raise SystemError(
+                f"building floors mismatch: {len(bfloors)} rows, {len(floor_uuids)} uuids"
+            )
 
         info = []
-        for _uuid in self.building_floors:
+        for _uuid in floor_uuids:
             bfloor: BuildingFloor = bfloors[_uuid]
-            connect_building_floor_uuid_list = get_connect_building_floor_uuid(_uuid)
+            connect_building_floor_uuid_list = get_connects(_uuid)
             if connect_building_floor_uuid_list:
                 for connect in connect_building_floor_uuid_list:
                     if str(connect) != _uuid:
@@ -246,31 +300,48 @@ class Building(db.Model, BaseMixIn):
         )
 
         belevators = {str(elevator.uuid): elevator for elevator in query}
+        return self.elevators_info(
+            self.elevators, belevators, lambda i: i.get_elevator_floors_info()
+        )
 
-        # TODO change to SystemError
-        assert len(belevators) == len(self.elevators)
+    @staticmethod
+    def elevators_info(
+        elevator_uuids: list, belevators: dict, get_elevator_floors=None
+    ) -> list:
+        """Keep order based on elevators
+        belevators: elevator uuid => elevator
+        get_elevator_floors为None时不返回elevator_floors
+        """
+        if len(belevators) != len(elevator_uuids):
+            raise SystemError(
+                f"elevators mismatch: {len(belevators)} rows, {len(elevator_uuids)} uuids"
+            )
 
         info = []
-        for _uuid in self.elevators:
+        for _uuid in elevator_uuids:
             belevator: Elevator = belevators[_uuid]
-            info.append(
-                {
-                    "uuid": str(belevator.uuid),
-                    "name": belevator.name,
-                    "brand": belevator.brand,
-                    "elevator_floors": belevator.get_elevator_floors_info(),
-                }
-            )
+            elevator = {
+                "uuid": str(belevator.uuid),
+                "name": belevator.name,
+                "brand": belevator.brand,
+            }
+            if get_elevator_floors is not None:
+                elevator["elevator_floors"] = get_elevator_floors(belevator)
+            info.append(elevator)
         return info
 
     def get_facility_group(self, unit_type: int):
         """Keep order based on elevators
         """
-        query = (
-            session.query(SiteGroup)
-            .filter(SiteGroup.building_uuid == self.uuid)
-            .filter(SiteGroup.unit_type == unit_type)
+        baked_query = bakery(lambda s: s.query(SiteGroup))
+        baked_query += lambda q: (
+            q.filter(SiteGroup.building_uuid == bindparam("building_uuid"))
+            .filter(SiteGroup.unit_type == bindparam("unit_type"))
             .order_by(SiteGroup.create_time)
+        )
+        query = (
+            baked_query(session())
+            .params(building_uuid=self.uuid, unit_type=unit_type)
             .all()
         )
 
@@ -299,7 +370,11 @@ class Building(db.Model, BaseMixIn):
 
 class BuildingFloor(db.Model, BaseMixIn):
     __tablename__: str = "building_floor"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_building_floor_site_uuid", "site_uuid"),
+        db.Index("ix_building_floor_building_uuid", "building_uuid", "floor_index"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
     building_uuid = db.Column(UUID(as_uuid=True))
@@ -323,7 +398,20 @@ class BuildingFloor(db.Model, BaseMixIn):
 
 class BuildingFloorConnector(db.Model, BaseMixIn):
     __tablename__: str = "building_floor_connector"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_building_floor_connector_site_uuid", "site_uuid"),
+        db.Index(
+            "ix_building_floor_connector_floor_uuid_1",
+            "floor_uuid_1",
+            postgresql_where=db.text("is_delete = 0"),
+        ),
+        db.Index(
+            "ix_building_floor_connector_floor_uuid_2",
+            "floor_uuid_2",
+            postgresql_where=db.text("is_delete = 0"),
+        ),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
 
@@ -356,7 +444,12 @@ class BuildingFloorConnector(db.Model, BaseMixIn):
 
 class Elevator(db.Model, BaseMixIn):
     __tablename__: str = "elevator"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_elevator_site_uuid", "site_uuid", "create_time"),
+        db.Index("ix_elevator_building_uuid", "building_uuid"),
+        db.Index("ix_elevator_group_uuid", "group_uuid"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
     building_uuid = db.Column(UUID(as_uuid=True))
@@ -370,14 +463,19 @@ class Elevator(db.Model, BaseMixIn):
         """Keep elevator floors order based on elevator_floors
         :return:
         """
-        query = (
-            session.query(ElevatorFloor)
-            .filter(ElevatorFloor.elevator_uuid == self.uuid)
-            .all()
+        baked_query = bakery(lambda s: s.query(ElevatorFloor))
+        baked_query += lambda q: q.filter(
+            ElevatorFloor.elevator_uuid == bindparam("elevator_uuid")
         )
+        query = baked_query(session()).params(elevator_uuid=self.uuid).all()
         efloors = {str(efloor.uuid): efloor for efloor in query}
+        return self.floors_info(self.elevator_floors, efloors)
+
+    @staticmethod
+    def floors_info(floor_uuids: list, efloors: dict) -> list:
+        # efloors: elevator floor uuid => elevator floor  按floor_uuids排序
         info = []
-        for _uuid in self.elevator_floors:
+        for _uuid in floor_uuids:
             efloor: ElevatorFloor = efloors[_uuid]
             info.append(
                 {
@@ -391,7 +489,12 @@ class Elevator(db.Model, BaseMixIn):
 
 class ElevatorFloor(db.Model, BaseMixIn):
     __tablename__: str = "elevator_floor"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_elevator_floor_site_uuid", "site_uuid"),
+        db.Index("ix_elevator_floor_elevator_uuid", "elevator_uuid", "floor_index"),
+        db.Index("ix_elevator_floor_building_floor_uuid", "building_floor_uuid"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
     building_uuid = db.Column(UUID(as_uuid=True))
@@ -405,7 +508,12 @@ class ElevatorFloor(db.Model, BaseMixIn):
 
 class FloorFacility(db.Model, BaseMixIn):
     __tablename__: str = "floor_facility"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_floor_facility_site_uuid", "site_uuid", "create_time"),
+        db.Index("ix_floor_facility_building_uuid", "building_uuid", "unit_type"),
+        db.Index("ix_floor_facility_group_uuid", "group_uuid"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
 
@@ -429,7 +537,13 @@ class FloorFacility(db.Model, BaseMixIn):
 
 class SiteGroup(db.Model, BaseMixIn):
     __tablename__: str = "site_group"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_site_group_site_uuid", "site_uuid", "create_time"),
+        db.Index("ix_site_group_building_uuid", "building_uuid", "unit_type"),
+        # robot按(site_uid, facility_group_sid, facility_group_index)寻址
+        db.Index("ix_site_group_facility_group_sid", "site_uuid", "facility_group_sid"),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True))
     building_uuid = db.Column(UUID(as_uuid=True), nullable=True)
@@ -454,76 +568,89 @@ class SiteGroup(db.Model, BaseMixIn):
         # elevator、robot 没有building floor uuid 、 unit_type
         # robot 只有name
 
-        units = (
-            session.query(SiteFacilityUnit)
-            .filter(SiteFacilityUnit.facility_uuid.in_(self.members))
-            .all()
+        # members长度不同时共用同一个查询  执行时展开IN列表
+        baked_query = bakery(lambda s: s.query(SiteFacilityUnit))
+        baked_query += lambda q: q.filter(
+            SiteFacilityUnit.facility_uuid.in_(bindparam("members", expanding=True))
         )
+        units = baked_query(session()).params(members=self.members).all()
         facility_unit_dict = {str(i.facility_uuid): i for i in units}
 
         if cls == FloorFacility:
-            query = (
-                session.query(
+            baked_query = bakery(
+                lambda s: s.query(
                     cls.name,
                     cls.uuid,
                     cls.direction,
                     cls.unit_type,
                     cls.building_uuid,
                     cls.building_floor_uuid,
-                )
-                .filter(cls.uuid.in_(self.members))
-                .order_by(cls.create_time)
-                .all()
+                ),
+                cls,
             )
-
-            return [
-                {
-                    "name": i.name,
-                    "uuid": str(i.uuid),
-                    "direction": i.direction,
-                    "unit_type": i.unit_type,
-                    "building_uuid": str(i.building_uuid),
-                    "unit_name": facility_unit_dict[str(i.uuid)].unit_name or "",
-                    "unit_uid": facility_unit_dict[str(i.uuid)].unit_uid or 0,
-                    "unit_uuid": str(facility_unit_dict[str(i.uuid)].unit_uuid or ""),
-                    "building_floor_uuid": str(i.building_floor_uuid or ""),
-                }
-                for i in query
-            ]
+            baked_query += lambda q: q.filter(
+                cls.uuid.in_(bindparam("members", expanding=True))
+            ).order_by(cls.create_time)
+            query = baked_query(session()).params(members=self.members).all()
         if cls == Elevator or cls == Robot:
-            query = (
-                session.query(cls.name, cls.uuid)
-                .filter(cls.uuid.in_(self.members))
-                .order_by(cls.create_time)
-                .all()
-            )
-            return [
-                {
-                    "name": i.name,
-                    "uuid": str(i.uuid),
-                    "unit_name": facility_unit_dict[str(i.uuid)].unit_name or "",
-                    "unit_uid": facility_unit_dict[str(i.uuid)].unit_uid or 0,
-                    "unit_uuid": str(facility_unit_dict[str(i.uuid)].unit_uuid or ""),
-                }
-                for i in query
-            ]
+            baked_query = bakery(lambda s: s.query(cls.name, cls.uuid), cls)
+            baked_query += lambda q: q.filter(
+                cls.uuid.in_(bindparam("members", expanding=True))
+            ).order_by(cls.create_time)
+            query = baked_query(session()).params(members=self.members).all()
+        return [
+            self.member_info(cls, i, facility_unit_dict[str(i.uuid)]) for i in query
+        ]
+
+    @staticmethod
+    def member_info(cls, row, sfu) -> dict:
+        # row: cls的成员  sfu: 成员对应的site facility unit
+        if cls == FloorFacility:
+            return {
+                "name": row.name,
+                "uuid": str(row.uuid),
+                "direction": row.direction,
+                "unit_type": row.unit_type,
+                "building_uuid": str(row.building_uuid),
+                "unit_name": sfu.unit_name or "",
+                "unit_uid": sfu.unit_uid or 0,
+                "unit_uuid": str(sfu.unit_uuid or ""),
+                "building_floor_uuid": str(row.building_floor_uuid or ""),
+            }
+        return {
+            "name": row.name,
+            "uuid": str(row.uuid),
+            "unit_name": sfu.unit_name or "",
+            "unit_uid": sfu.unit_uid or 0,
+            "unit_uuid": str(sfu.unit_uuid or ""),
+        }
 
     def get_site_group_info(self):
+        return self.group_info(self, self.get_members_attr())
+
+    @staticmethod
+    def group_info(site_group, members: Optional[list] = None) -> dict:
+        # members为None时不返回members
         group = {
-            "uuid": str(self.uuid),
-            "name": self.name,
-            "building_floor_uuid": str(self.building_floor_uuid or ""),
-            "unit_type": self.unit_type,
-            "members": self.get_members_attr(),
+            "uuid": str(site_group.uuid),
+            "name": site_group.name,
+            "building_floor_uuid": str(site_group.building_floor_uuid or ""),
+            "unit_type": site_group.unit_type,
         }
-        if self.unit_type in [Unit.UNIT_TYPE_ROBOT, Unit.UNIT_TYPE_ELEVATOR]:
+        if members is not None:
+            group["members"] = members
+        if site_group.unit_type in [Unit.UNIT_TYPE_ROBOT, Unit.UNIT_TYPE_ELEVATOR]:
             del group["building_floor_uuid"]
         return group
 
 
 class Robot(db.Model, BaseMixIn):
     __tablename__: str = "robot"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_robot_site_uuid", "site_uuid", "create_time"),
+        db.Index("ix_robot_group_uuid", "group_uuid"),
+        {"schema": "public"},
+    )
 
     ROBOT_TYPE_UNKNOWN = 0
     ROBOT_TYPE_DELIVERY = 10
@@ -551,7 +678,14 @@ class Robot(db.Model, BaseMixIn):
 
 class SiteFacilityUnit(db.Model, BaseMixIn):
     __tablename__: str = "site_facility_unit"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_site_facility_unit_site_uuid", "site_uuid"),
+        db.Index("ix_site_facility_unit_facility_uuid", "facility_uuid"),
+        db.Index(
+            "ix_site_facility_unit_group_index", "group_uuid", "facility_group_index"
+        ),
+        {"schema": "public"},
+    )
 
     site_uuid = db.Column(UUID(as_uuid=True), nullable=False)
     site_uid = db.Column(db.BigInteger, nullable=False)
@@ -624,13 +758,23 @@ class SiteFacilityUnit(db.Model, BaseMixIn):
 
     @classmethod
     def query_by_unit_uuid(cls, unit_uuid: str):
-        return session.query(cls).filter(cls.unit_uuid == unit_uuid).first()
+        query = bakery(lambda s: s.query(cls), cls)
+        query += lambda q: q.filter(cls.unit_uuid == bindparam("unit_uuid"))
+        return query(session()).params(unit_uuid=unit_uuid).first()
 
 
 class Cmdb(db.Model, BaseMixIn):
     # 资产管理 包含绑定信息 绑定站点 绑定状态
     __tablename__: str = "cmdb"
-    __table_args__: Dict[str, Any] = {"schema": "public"}
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_cmdb_site_uuid", "site_uuid"),
+        db.Index(
+            "ix_cmdb_unbind_unit_type",
+            "unit_type",
+            postgresql_where=db.text("site_uuid IS NULL"),
+        ),
+        {"schema": "public"},
+    )
 
     # 站点信息可空  非空则表示已绑定
     site_uuid = db.Column(UUID(as_uuid=True))
@@ -654,3 +798,170 @@ class Cmdb(db.Model, BaseMixIn):
             "unit_uid": self.unit_uid,
             "unit_name": self.unit_name,
         }
+
+
+class SiteSidCounter(db.Model):
+    # site内sid计数器  facility_group_sid、facility_sid在site内分别递增
+    # 每次分配只更新一行计数器  不需要扫描site_group、site_facility_unit求max
+    __tablename__: str = "site_sid_counter"
+    __table_args__: Dict[str, Any] = {"schema": "public"}
+
+    SID_TYPE_GROUP = 1
+    SID_TYPE_FACILITY = 2
+
+    site_uuid = db.Column(UUID(as_uuid=True), primary_key=True)
+    sid_type = db.Column(db.SmallInteger, primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def reserve(cls, site_uuid, sid_type: int, count: int = 1) -> int:
+        """
+        预留count个连续的sid  返回其中第一个
+        计数器行在事务提交前保持行锁  同一site的并发分配会排队  不同site互不影响
+        """
+        table = cls.__table__
+        last_value = session.execute(
+            table.update()
+            .where(and_(table.c.site_uuid == site_uuid, table.c.sid_type == sid_type))
+            .values(last_value=table.c.last_value + count)
+            .returning(table.c.last_value)
+        ).scalar()
+
+        if last_value is None:
+            # 首次分配  以已有数据的最大sid为起点
+            if sid_type == cls.SID_TYPE_GROUP:
+                column, model = SiteGroup.facility_group_sid, SiteGroup
+            else:
+                column, model = SiteFacilityUnit.facility_sid, SiteFacilityUnit
+            current = (
+                session.query(func.max(column))
+                .filter(model.site_uuid == site_uuid)
+                .scalar()
+                or 0
+            )
+            stmt = insert(table).values(
+                site_uuid=site_uuid, sid_type=sid_type, last_value=current + count
+            )
+            last_value = session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[table.c.site_uuid, table.c.sid_type],
+                    set_={"last_value": table.c.last_value + count},
+                ).returning(table.c.last_value)
+            ).scalar()
+
+        return last_value - count + 1
+
+
+class SiteChangeLog(db.Model):
+    """
+    site数据变更日志  每次写操作在同一事务内按新版本号记录变动的行
+    GET /building/changes据此返回某版本之后的增量
+    日志可以压缩  压缩后只留下一条OP_COMPACT标记  更早的版本只能取完整文档
+    """
+
+    __tablename__: str = "site_change_log"
+    __table_args__: Tuple[Any, ...] = (
+        db.Index("ix_site_change_log_site_uuid", "site_uuid", "version_id"),
+        {"schema": "public"},
+    )
+
+    OP_CREATE = 1
+    OP_UPDATE = 2
+    OP_DELETE = 3
+    # 压缩标记  version_id及之前的日志已删除
+    OP_COMPACT = 10
+
+    OP_NAMES = {OP_CREATE: "create", OP_UPDATE: "update", OP_DELETE: "delete"}
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    site_uuid = db.Column(UUID(as_uuid=True), nullable=False)
+    version_id = db.Column(db.Integer, nullable=False)
+    table_name = db.Column(db.String(64), nullable=False, default="")
+    entity_uuid = db.Column(UUID(as_uuid=True), nullable=True)
+    op = db.Column(db.SmallInteger, nullable=False)
+    data = db.Column(JSONB, nullable=False, default={})
+    create_time = db.Column(db.DateTime(), default=datetime.datetime.now)
+
+    @classmethod
+    def jsonable(cls, value):
+        if isinstance(value, dict):
+            return {k: cls.jsonable(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls.jsonable(i) for i in value]
+        if isinstance(value, (uuid.UUID, datetime.datetime)):
+            return str(value)
+        return value
+
+    @classmethod
+    def record(
+        cls, site_uuid, version_id: int, inserts: dict = None, updates: dict = None
+    ) -> int:
+        """
+        批量写入一个版本的变更  返回写入条数
+        inserts: {model: [row]}  updates: {model: {uuid: {field: value}}}
+        与BootstrapPlan、SiteBuildingDiff中的结构一致  is_delete置1的更新记为删除
+        """
+        logs = []
+        for model, rows in (inserts or {}).items():
+            for row in rows:
+                logs.append(
+                    dict(
+                        table_name=model.__tablename__,
+                        entity_uuid=row["uuid"],
+                        op=cls.OP_CREATE,
+                        data=cls.jsonable(row),
+                    )
+                )
+        for model, rows in (updates or {}).items():
+            for row_uuid, values in rows.items():
+                values = {k: v for k, v in values.items() if k != "uuid"}
+                logs.append(
+                    dict(
+                        table_name=model.__tablename__,
+                        entity_uuid=row_uuid,
+                        op=cls.OP_DELETE if values.get("is_delete") else cls.OP_UPDATE,
+                        data=cls.jsonable(values),
+                    )
+                )
+        if logs:
+            now = datetime.datetime.now()
+            for log in logs:
+                log.update(site_uuid=site_uuid, version_id=version_id, create_time=now)
+            session.bulk_insert_mappings(cls, logs)
+        return len(logs)
+
+    @classmethod
+    def compacted_version(cls, site_uuid) -> int:
+        # 此版本及之前的日志已压缩  没有标记时日志从头开始完整
+        return (
+            session.query(func.max(cls.version_id))
+            .filter(cls.site_uuid == site_uuid, cls.op == cls.OP_COMPACT)
+            .scalar()
+            or 0
+        )
+
+    @classmethod
+    def changes(cls, site_uuid, since_version: int) -> list:
+        return (
+            session.query(cls)
+            .filter(
+                cls.site_uuid == site_uuid,
+                cls.version_id > since_version,
+                cls.op != cls.OP_COMPACT,
+            )
+            .order_by(cls.id)
+            .all()
+        )
+
+    @classmethod
+    def compact(cls, site_uuid, version_id: int) -> int:
+        # 删除version_id及之前的日志  留下压缩标记  返回删除条数
+        if version_id <= cls.compacted_version(site_uuid):
+            return 0
+        count = (
+            session.query(cls)
+            .filter(cls.site_uuid == site_uuid, cls.version_id <= version_id)
+            .delete(synchronize_session=False)
+        )
+        session.add(cls(site_uuid=site_uuid, version_id=version_id, op=cls.OP_COMPACT))
+        return count
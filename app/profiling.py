@@ -0,0 +1,196 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+按需profiling单个请求
+
+满足以下任一条件的请求用cProfile包裹执行  同时记录每条sql语句及耗时
+    请求头 X-Profile: <PROFILE_TOKEN>    PROFILE_TOKEN未配置时不生效
+    匹配PROFILE_ALLOWLIST中的一条规则    如{"endpoint": "buildingview", "method": "PUT", "site_uuid": "..."}
+                                         规则中的key都匹配才算匹配  site_uuid取自query参数
+
+结果写入PROFILE_DIR  响应头 X-Profile-Id 返回id
+    <id>.pstats     cProfile结果  可用pstats/snakeviz查看
+    <id>.json       请求信息与sql语句列表
+
+同一时间只profiling一个请求  其他请求照常执行不profiling
+    python manage.py profiles               列出已保存的profile
+    python manage.py profiles --profile-id  查看某个profile的热点函数和慢sql
+
+cProfile按线程统计  gevent server(wsgi.py)下所有协程在同一线程中运行
+    profile会混入同期其他请求的函数调用  只有threaded server下准确  sql列表不受影响
+    此时profile中记录greenlets=true  查看时给出提示
+"""
+import cProfile
+import datetime
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+
+from flask import current_app, g, request
+
+from app.sqlstats import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def greenlets_patched() -> bool:
+    # 未使用gevent时不导入
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+class ProfileRun(object):
+    def __init__(self):
+        now = datetime.datetime.now()
+        self.id = f"{now:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.created_at = now.isoformat()
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+
+
+class Profiling(object):
+    def __init__(self, app=None):
+        # cProfile同一时间只能有一个在运行
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PROFILE_DIR", "/tmp/site-profiles")
+        app.config.setdefault("PROFILE_TOKEN", None)
+        app.config.setdefault("PROFILE_ALLOWLIST", [])
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.extensions["site_profiling"] = self
+
+    @staticmethod
+    def wanted() -> bool:
+        config = current_app.config
+        token = config["PROFILE_TOKEN"]
+        header = request.headers.get("X-Profile")
+        if token and header and hmac.compare_digest(header, token):
+            return True
+
+        values = {
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "site_uuid": request.args.get("site_uuid"),
+        }
+        return any(
+            all(values.get(k) == v for k, v in rule.items())
+            for rule in config["PROFILE_ALLOWLIST"]
+        )
+
+    def before_request(self):
+        if not self.wanted() or not self._lock.acquire(blocking=False):
+            return
+        run = ProfileRun()
+        stats = g.get("sql_stats")
+        if stats is not None:
+            stats.trace = []
+        g.profile_run = run
+        run.profiler.enable()
+
+    def after_request(self, response):
+        run = g.pop("profile_run", None)
+        if run is None:
+            return response
+        run.profiler.disable()
+        self._lock.release()
+        try:
+            self.save(run, response.status_code)
+        except OSError as e:
+            logger.error(f"save profile {run.id} failed: {e}")
+            return response
+        response.headers["X-Profile-Id"] = run.id
+        return response
+
+    def teardown_request(self, exc=None):
+        # 请求异常时after_request不会执行  在这里释放
+        run = g.pop("profile_run", None)
+        if run is not None:
+            run.profiler.disable()
+            self._lock.release()
+
+    @staticmethod
+    def save(run: ProfileRun, status: int):
+        directory = current_app.config["PROFILE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        run.profiler.dump_stats(os.path.join(directory, f"{run.id}.pstats"))
+
+        stats = g.get("sql_stats")
+        trace = (stats.trace if stats is not None else None) or []
+        info = {
+            "id": run.id,
+            "created_at": run.created_at,
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "endpoint": request.endpoint,
+            "status": status,
+            "seconds": round(time.perf_counter() - run.start, 4),
+            "greenlets": greenlets_patched(),
+            "sql_count": len(trace),
+            "sql_ms": round(sum(i[1] for i in trace) * 1000, 2),
+            "sql": [
+                {"statement": statement, "ms": round(seconds * 1000, 3)}
+                for statement, seconds in trace
+            ],
+        }
+        with open(os.path.join(directory, f"{run.id}.json"), "w") as f:
+            json.dump(info, f, ensure_ascii=False)
+        logger.info(f"profile {run.id} saved for {request.method} {request.path}")
+
+
+def list_profiles(directory: str) -> list:
+    # 按时间倒序  不含sql列表
+    profiles = []
+    if not os.path.isdir(directory):
+        return profiles
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            info = json.load(f)
+        info.pop("sql", None)
+        profiles.append(info)
+    return sorted(profiles, key=lambda i: i["created_at"], reverse=True)
+
+
+def summarize_profile(directory: str, profile_id: str, top: int = 20) -> Optional[str]:
+    # 请求信息  累计耗时最多的函数  最慢和重复最多的sql
+    path = os.path.join(directory, profile_id)
+    if not os.path.exists(f"{path}.json"):
+        return None
+    with open(f"{path}.json") as f:
+        info = json.load(f)
+
+    out = io.StringIO()
+    out.write(
+        f"{info['id']}  {info['method']} {info['path']}  status={info['status']}  "
+        f"{info['seconds']}s  sql_count={info['sql_count']}  sql_ms={info['sql_ms']}\n"
+    )
+    if info.get("greenlets"):
+        out.write("gevent下的profile包含同期其他协程的函数调用  耗时仅供参考\n")
+    pstats.Stats(f"{path}.pstats", stream=out).sort_stats("cumulative").print_stats(top)
+
+    out.write("slowest sql\n")
+    for item in sorted(info["sql"], key=lambda i: i["ms"], reverse=True)[:top]:
+        out.write(f"    {item['ms']:>10.3f}ms  {' '.join(item['statement'].split())}\n")
+    out.write("repeated sql\n")
+    repeated = Counter(fingerprint(i["statement"]) for i in info["sql"])
+    for statement, count in repeated.most_common(top):
+        out.write(f"    {count:>6}  {statement}\n")
+    return out.getvalue()
+
+
+profiling = Profiling()
@@ -0,0 +1,206 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+只读接口使用从库
+
+SQLALCHEMY_REPLICA_URIS配置从库地址  为空时全部走主库
+    views中GET方法加上read_replica的接口  查询轮流发往健康的从库
+    同一请求内只用一个从库  flush等写操作仍走主库
+
+健康检查
+    每REPLICA_HEALTH_INTERVAL秒在请求中检查一次  SELECT复制延迟
+    连不上或延迟超过REPLICA_MAX_LAG_SECONDS的从库暂不使用  全部不可用时读主库
+    从库查询时连接断开立即标记为不可用
+
+读到自己的写
+    请求中提交过事务后  同一客户端REPLICA_STICKY_SECONDS秒内的读请求走主库
+    客户端由请求头X-Client-Id区分  没有时用remote_addr  标记存在缓存中 多进程部署需用redis
+
+SQL_STATS_HEADERS=True时响应头X-DB-Route返回本次读请求使用的库  primary或replica_<n>
+"""
+import functools
+import itertools
+import logging
+import threading
+import time
+from typing import Optional
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# 主库上pg_last_xact_replay_timestamp()为null  延迟视为0
+LAG_SQL = text(
+    "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+)
+
+
+class Replica(object):
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = False
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        event.listen(engine, "handle_error", self.on_error)
+
+    def check(self, interval: float, max_lag: float):
+        # 只有一个线程检查  其他线程使用上次的结果
+        if time.monotonic() - self.checked_at < interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            with self.engine.connect() as conn:
+                lag = conn.execute(LAG_SQL).scalar()
+            self.healthy = not max_lag or lag <= max_lag
+            if not self.healthy:
+                logger.warning(f"replica {self.name} lag {lag}s exceeds {max_lag}s")
+        except SQLAlchemyError as e:
+            self.healthy = False
+            logger.warning(f"replica {self.name} health check failed: {e}")
+        finally:
+            self.checked_at = time.monotonic()
+            self._lock.release()
+
+    def on_error(self, context):
+        if context.is_disconnect:
+            self.healthy = False
+            self.checked_at = time.monotonic()
+
+
+class ReplicaSet(object):
+    def __init__(self, app, uris: tuple):
+        self.uris = uris
+        self.replicas = [
+            Replica(f"replica_{i}", self.create_engine(app, uri))
+            for i, uri in enumerate(uris)
+        ]
+        self._counter = itertools.count()
+
+    @staticmethod
+    def create_engine(app, uri: str):
+        # 与主库engine使用相同的连接池配置
+        db = app.extensions["sqlalchemy"].db
+        sa_url = make_url(uri)
+        options = {}
+        db.apply_pool_defaults(app, options)
+        db.apply_driver_hacks(app, sa_url, options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        return create_engine(sa_url, **options)
+
+    def choose(self, interval: float, max_lag: float) -> Optional[Replica]:
+        for replica in self.replicas:
+            replica.check(interval, max_lag)
+        healthy = [i for i in self.replicas if i.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+def mark_wrote(session):
+    # 只读的POST(units/resolve等)不提交事务  不触发读主库
+    if has_request_context():
+        g.db_wrote = True
+
+
+def client_key() -> str:
+    client = request.headers.get("X-Client-Id") or request.remote_addr
+    return cache.key("db-primary", client)
+
+
+class Replicas(object):
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+        app.config.setdefault("REPLICA_STICKY_SECONDS", 5)
+        app.config.setdefault("REPLICA_HEALTH_INTERVAL", 10)
+        app.config.setdefault("REPLICA_MAX_LAG_SECONDS", 0)
+        session = app.extensions["sqlalchemy"].db.session
+        if not event.contains(session, "after_commit", mark_wrote):
+            event.listen(session, "after_commit", mark_wrote)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.extensions["site_replicas"] = None
+
+    def replica_set(self, app) -> Optional[ReplicaSet]:
+        # 配置变化时重建  测试中修改配置后生效
+        uris = tuple(app.config["SQLALCHEMY_REPLICA_URIS"])
+        replica_set = app.extensions["site_replicas"]
+        if replica_set is not None and replica_set.uris == uris:
+            return replica_set
+        with self._lock:
+            replica_set = app.extensions["site_replicas"]
+            if replica_set is None or replica_set.uris != uris:
+                if replica_set is not None:
+                    replica_set.dispose()
+                replica_set = ReplicaSet(app, uris) if uris else None
+                app.extensions["site_replicas"] = replica_set
+        return replica_set
+
+    def route(self):
+        # read_replica接口调用  选定本次请求使用的从库
+        app = current_app._get_current_object()
+        replica_set = self.replica_set(app)
+        if replica_set is None or cache.get(client_key()) is not None:
+            return
+        config = app.config
+        replica = replica_set.choose(
+            config["REPLICA_HEALTH_INTERVAL"], config["REPLICA_MAX_LAG_SECONDS"]
+        )
+        if replica is not None:
+            g.db_replica = replica
+
+    @staticmethod
+    def before_request():
+        g.db_replica = None
+        g.db_wrote = False
+
+    @staticmethod
+    def after_request(response):
+        config = current_app.config
+        if not config["SQLALCHEMY_REPLICA_URIS"]:
+            return response
+        if g.get("db_wrote"):
+            cache.set(client_key(), b"1", ttl=config["REPLICA_STICKY_SECONDS"])
+        elif config["SQL_STATS_HEADERS"]:
+            replica = g.get("db_replica")
+            response.headers["X-DB-Route"] = replica.name if replica else "primary"
+        return response
+
+
+replicas = Replicas()
+
+
+def read_replica(func):
+    # 只读接口使用从库  加在Resource的method_decorators中
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        replicas.route()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # flush为写操作  始终走主库
+        if not self._flushing and has_request_context():
+            replica = g.get("db_replica")
+            if replica is not None:
+                return replica.engine
+        return super().get_bind(mapper, clause)
@@ -0,0 +1,35 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+robot侧读取site拓扑的gRPC服务  定义见topology.proto
+
+生成的topology_pb2*.py不入库  与部署环境的protobuf版本一致即可
+    python manage.py compile_proto
+    python manage.py grpc --port 50051
+"""
+import os
+
+PROTO_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(PROTO_DIR))
+
+
+def compile_proto() -> int:
+    # 以项目根目录为import路径  生成的代码中为from app.rpc import topology_pb2
+    from grpc_tools import protoc
+
+    proto = os.path.relpath(os.path.join(PROTO_DIR, "topology.proto"), ROOT_DIR)
+    cwd = os.getcwd()
+    os.chdir(ROOT_DIR)
+    try:
+        return protoc.main(
+            [
+                "grpc_tools.protoc",
+                "-I.",
+                f"-I{os.path.dirname(protoc.__file__)}/_proto",
+                "--python_out=.",
+                "--grpc_python_out=.",
+                proto,
+            ]
+        )
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,163 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Topology gRPC服务  直接调用handler层  返回与http json接口相同的数据
+
+    GetSiteBuilding     GET /building  按版本号缓存序列化后的protobuf
+    GetElevatorFloors   GET /elevator/floors
+    ResolveUnits        POST /units/resolve  共用unit缓存
+    ListUnits           GET /units
+
+参数不合法时返回INVALID_ARGUMENT  site不存在时返回NOT_FOUND
+每个请求在app context中执行  app context结束时释放数据库session
+"""
+import functools
+import logging
+import time
+from concurrent import futures
+from typing import Tuple
+from uuid import UUID
+
+import grpc
+from google.protobuf import json_format
+
+from app.cache import cache, site_building_key
+from app.handlers.buildings import (
+    BUILDING_EXPANDS,
+    BuildingScope,
+    get_elevator_floors,
+    get_site_building,
+    get_site_building_version,
+)
+from app.handlers.facility_bind import get_unit_list
+from app.handlers.units import unit_resolver
+from app.rpc import topology_pb2, topology_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 50051
+DEFAULT_WORKERS = 10
+
+
+def optional_uuid(value: str):
+    # proto3的string默认为空串  空串视为未传
+    return UUID(value) if value else None
+
+
+def rpc_method(func):
+    @functools.wraps(func)
+    def wrapper(self, request, context):
+        with self.app.app_context():
+            try:
+                return func(self, request, context)
+            except (TypeError, ValueError) as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    return wrapper
+
+
+class TopologyServicer(topology_pb2_grpc.TopologyServicer):
+    def __init__(self, app):
+        self.app = app
+
+    @rpc_method
+    def GetSiteBuilding(self, request, context):
+        site_uuid = UUID(request.site_uuid)
+        if not set(request.collapse) <= set(BUILDING_EXPANDS):
+            raise ValueError("invalid collapse")
+        args = {}
+        if request.fields:
+            args["fields"] = ",".join(request.fields)
+        if request.collapse:
+            args["expand"] = ",".join(set(BUILDING_EXPANDS) - set(request.collapse))
+        if request.building_uuid:
+            args["building_uuid"] = request.building_uuid
+        scope = BuildingScope.from_args(args)
+        if scope is None:
+            raise ValueError("invalid fields or building_uuid")
+
+        version_id = get_site_building_version(site_uuid)
+        if version_id is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "site not found")
+        # 缓存序列化后的protobuf  与json文档同在site_building_key下  版本号变化即失效
+        scope_key = f"pb:{scope.key}"
+        data = cache.get(site_building_key(site_uuid, version_id, scope_key))
+        if data is not None:
+            return topology_pb2.SiteBuilding.FromString(data)
+
+        site_building = get_site_building(site_uuid, scope)
+        if not site_building:
+            context.abort(grpc.StatusCode.NOT_FOUND, "site not found")
+        message = json_format.ParseDict(
+            site_building, topology_pb2.SiteBuilding(), ignore_unknown_fields=True
+        )
+        version_id = site_building["version_id"] or 0
+        cache.set(
+            site_building_key(site_uuid, version_id, scope_key),
+            message.SerializeToString(),
+        )
+        return message
+
+    @rpc_method
+    def GetElevatorFloors(self, request, context):
+        elevators = get_elevator_floors(
+            UUID(request.site_uuid),
+            optional_uuid(request.building_uuid),
+            optional_uuid(request.elevator_uuid),
+        )
+        # 直接构造message  比json_format快
+        return topology_pb2.ElevatorFloorsReply(
+            elevators=[
+                topology_pb2.Elevator(
+                    uuid=i["uuid"],
+                    name=i["name"],
+                    brand=i["brand"],
+                    building_uuid=i["building_uuid"],
+                    elevator_floors=[
+                        topology_pb2.ElevatorFloor(**f) for f in i["elevator_floors"]
+                    ],
+                )
+                for i in elevators
+            ]
+        )
+
+    @rpc_method
+    def ResolveUnits(self, request, context):
+        units = unit_resolver.resolve(request.unit_uuids)
+        return topology_pb2.ResolveUnitsReply(
+            units={k: topology_pb2.UnitSite(**v) for k, v in units.items() if v}
+        )
+
+    @rpc_method
+    def ListUnits(self, request, context):
+        if not request.unit_type:
+            raise ValueError("unit_type is required")
+        units = get_unit_list(
+            request.unit_type,
+            UUID(request.site_uuid),
+            optional_uuid(request.building_uuid),
+        )
+        return topology_pb2.ListUnitsReply(
+            units=[topology_pb2.Unit(**i) for i in units]
+        )
+
+
+def serve(
+    app, port: int = DEFAULT_PORT, max_workers: int = DEFAULT_WORKERS
+) -> Tuple[grpc.Server, int]:
+    # 返回已启动的server和实际监听的端口  port为0时随机分配
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    topology_pb2_grpc.add_TopologyServicer_to_server(TopologyServicer(app), server)
+    port = server.add_insecure_port(f"[::]:{port}")
+    server.start()
+    logger.info(f"topology grpc server listening on {port}")
+    return server, port
+
+
+def run(app, port: int = DEFAULT_PORT, max_workers: int = DEFAULT_WORKERS):
+    server, _ = serve(app, port, max_workers)
+    try:
+        while True:
+            time.sleep(86400)
+    except KeyboardInterrupt:
+        server.stop(0)
@@ -2,8 +2,8 @@ import uuid
 from app.models import Cmdb, Unit, session
 
 
-def build_random_unit():
-    # 创建随机的unit
+def build_random_unit(count: int = 20):
+    # 创建随机的unit  每种类型count个
     unit_name_map = {
         Unit.UNIT_TYPE_ROBOT: "fake-机器人",
         Unit.UNIT_TYPE_ELEVATOR: "fake-电梯板",
@@ -15,7 +15,7 @@ def build_random_unit():
 
     unit_uid =1
     for unit_type, name in unit_name_map.items():
-        for i in range(20):
+        for i in range(count):
             unit = Cmdb(
                 unit_type=unit_type,
                 unit_uuid=uuid.uuid4(),
@@ -32,3 +32,40 @@ def build_random_unit():
     except Exception as e:
         session.rollback()
         raise
+
+
+def build_site_request(
+    name: str = "fake-site",
+    building_count: int = 2,
+    floor_count: int = 6,
+    elevator_count: int = 3,
+    facility_count: int = 12,
+    robot_count: int = 3,
+) -> dict:
+    # 生成create_site的请求数据  每个building的facility_count个设施平均分给工作站、闸机、自动门、充电桩
+    per_type = max(facility_count // 4, 1)
+    return {
+        "business_types": [1],
+        "name": name,
+        "address": f"{name}-address",
+        "has_building_connector": True,
+        "enabled": True,
+        "status": 1,
+        "location": "",
+        "meta_info": {
+            "building_count": building_count,
+            "robot_count": robot_count,
+            "building_info": [
+                {
+                    "name": f"{name}-building-{i + 1}",
+                    "floor_count": floor_count,
+                    "elevator_count": elevator_count,
+                    "station_count": per_type,
+                    "gate_count": per_type,
+                    "auto_door_count": per_type,
+                    "charger_count": per_type,
+                }
+                for i in range(building_count)
+            ],
+        },
+    }
@@ -0,0 +1,239 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+慢sql记录
+
+engine上执行时间超过SLOW_QUERY_MS的语句  在后台线程用另一个连接取执行计划
+    SELECT          EXPLAIN (ANALYZE, BUFFERS)  会再执行一次  有statement_timeout限制  执行后回滚
+    INSERT/UPDATE/DELETE/SELECT FOR UPDATE  EXPLAIN  不执行
+    调用nextval、advisory lock等回滚也撤销不了的函数的SELECT  EXPLAIN  不执行
+    调用了其他有副作用函数的语句  执行时加上execution_options(slow_query_analyze=False)
+连同调用它的app内函数(如app.models.get_members_attr)和endpoint 以json行追加到SLOW_QUERY_LOG
+
+限流  不会放大数据库压力
+    每分钟最多SLOW_QUERY_EXPLAIN_PER_MINUTE次EXPLAIN
+    同一语句指纹SLOW_QUERY_EXPLAIN_COOLDOWN秒内只EXPLAIN一次
+    队列满时丢弃  超出限流的慢sql只记日志不取计划
+
+    python manage.py slow_queries   按语句指纹汇总
+"""
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.sqlstats import fingerprint
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+LOCKING_RE = re.compile(r"\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b", re.I)
+WRITE_RE = re.compile(r"\b(INSERT|UPDATE|DELETE)\b", re.I)
+# 回滚撤销不了的函数  序列值  会话级锁  通知等
+SIDE_EFFECT_RE = re.compile(
+    r"\b(nextval|setval|pg_(try_)?advisory\w*|pg_notify|pg_sleep|set_config"
+    r"|pg_cancel_backend|pg_terminate_backend|dblink\w*|lo_\w+)\s*\(",
+    re.I,
+)
+# 语句的执行选项  为False时只EXPLAIN不ANALYZE
+ANALYZE_OPTION = "slow_query_analyze"
+
+
+def caller() -> str:
+    # 调用栈上第一个app内的函数  跳过本模块
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(APP_DIR) and filename != os.path.abspath(__file__):
+            module = frame.f_globals.get("__name__", "")
+            return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return ""
+
+
+def explain_options(statement: str, analyze: bool = True) -> str:
+    # 只读的SELECT才ANALYZE  写操作、加锁和有副作用的查询只看计划
+    if not analyze or SIDE_EFFECT_RE.search(statement):
+        return ""
+    head = statement.lstrip().upper()
+    if head.startswith("SELECT") and not LOCKING_RE.search(statement):
+        return "(ANALYZE, BUFFERS)"
+    if head.startswith("WITH") and not WRITE_RE.search(statement):
+        return "(ANALYZE, BUFFERS)"
+    return ""
+
+
+class ExplainLimiter(object):
+    def __init__(self, per_minute: int, cooldown: int, max_fingerprints: int = 1000):
+        self.per_minute = per_minute
+        self.cooldown = cooldown
+        self.max_fingerprints = max_fingerprints
+        self._minute = 0
+        self._count = 0
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            minute = int(now // 60)
+            if minute != self._minute:
+                self._minute, self._count = minute, 0
+            last = self._last.get(key)
+            if self._count >= self.per_minute or (
+                last is not None and now - last < self.cooldown
+            ):
+                return False
+            self._count += 1
+            self._last[key] = now
+            self._last.move_to_end(key)
+            while len(self._last) > self.max_fingerprints:
+                self._last.popitem(last=False)
+            return True
+
+
+class SlowQueryLog(object):
+    def __init__(self, app=None):
+        self.threshold = 0
+        self.path = None
+        self.timeout_ms = 5000
+        self.limiter = ExplainLimiter(6, 600)
+        self._queue = queue.Queue(maxsize=10)
+        self._worker = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # engine事件是全局的  以最后初始化的app配置为准
+        config = app.config
+        self.threshold = config.setdefault("SLOW_QUERY_MS", 0) / 1000
+        self.path = config.setdefault("SLOW_QUERY_LOG", "/tmp/site-slow-queries.log")
+        self.timeout_ms = config.setdefault("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", 5000)
+        self.limiter = ExplainLimiter(
+            config.setdefault("SLOW_QUERY_EXPLAIN_PER_MINUTE", 6),
+            config.setdefault("SLOW_QUERY_EXPLAIN_COOLDOWN", 600),
+        )
+        if not event.contains(Engine, "after_cursor_execute", self.after_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_execute)
+        app.extensions["slow_query_log"] = self
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.threshold and context is not None:
+            context._slow_query_start = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_slow_query_start", None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        if seconds < self.threshold:
+            return
+
+        key = fingerprint(statement)
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "ms": round(seconds * 1000, 2),
+            "caller": caller(),
+            "endpoint": request.endpoint if has_request_context() else None,
+            "fingerprint": key,
+            "statement": statement,
+        }
+        analyze = context.execution_options.get(ANALYZE_OPTION, True)
+        record["explain"] = "analyze" if explain_options(statement, analyze) else "plan"
+        logger.warning(
+            f"slow query {record['ms']}ms in {record['caller']}: {key[:200]}"
+        )
+        explainable = (
+            not executemany
+            and statement.lstrip().upper().startswith(EXPLAINABLE)
+            and self.limiter.allow(key)
+        )
+        if not explainable:
+            return
+        try:
+            self._queue.put_nowait((conn.engine, record, parameters))
+        except queue.Full:
+            return
+        self._start_worker()
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="slow-query-explain", daemon=True
+                )
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            engine, record, parameters = self._queue.get()
+            try:
+                self._explain(engine, record, parameters)
+                self._write(record)
+            except Exception as e:
+                logger.error(f"explain slow query failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _explain(self, engine, record: dict, parameters):
+        # 用单独的DBAPI连接执行  不触发engine事件  执行后回滚
+        options = explain_options(record["statement"], record["explain"] == "analyze")
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(f"SET LOCAL statement_timeout = {int(self.timeout_ms)}")
+            cursor.execute(f"EXPLAIN {options} {record['statement']}", parameters)
+            record["plan"] = [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            record["plan"] = []
+            record["error"] = str(e)
+        finally:
+            raw.rollback()
+            raw.close()
+
+    def _write(self, record: dict):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def join(self):
+        # 等待已入队的EXPLAIN完成  测试和脚本中使用
+        self._queue.join()
+
+
+def summarize_slow_queries(path: str, top: int = 20) -> list:
+    # 按语句指纹汇总  次数、最大耗时、调用函数、最近一次的执行计划
+    summary = {}
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            item = summary.setdefault(
+                record["fingerprint"],
+                {"fingerprint": record["fingerprint"], "count": 0, "max_ms": 0},
+            )
+            item["count"] += 1
+            item["max_ms"] = max(item["max_ms"], record["ms"])
+            item["caller"] = record["caller"]
+            item["plan"] = record.get("plan", [])
+    return sorted(summary.values(), key=lambda i: i["max_ms"], reverse=True)[:top]
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,132 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+每个请求的sql统计
+
+通过engine事件记录请求内执行的语句数和数据库耗时
+    SQL_STATS_HEADERS=True   写入响应头 X-SQL-Count X-SQL-Time(ms)  开发测试时使用
+    SQL_STATS_HEADERS=False  写入日志  字段见extra  生产环境使用
+
+超出预算时记warning  带上重复次数最多的语句指纹  方便定位N+1
+    SQL_QUERY_BUDGET    默认每个请求的语句数上限  0为不检查
+    SQL_QUERY_BUDGETS   {endpoint: 上限}  endpoint为flask endpoint名 如buildingview
+"""
+import logging
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+PARAM_RE = re.compile(r"%\(\w+\)s|%s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def fingerprint(statement: str) -> str:
+    # 参数和常量替换为?  IN列表合并为(...)  同一语句不同参数得到相同指纹
+    statement = LIST_RE.sub("(...)", PARAM_RE.sub("?", statement))
+    return " ".join(statement.split())
+
+
+class RequestSqlStats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+        # 设为列表时记录每条语句  profiling时使用
+        self.trace = None
+
+    def add(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(statement)] += 1
+        if self.trace is not None:
+            self.trace.append((statement, seconds))
+
+    @property
+    def milliseconds(self) -> float:
+        return round(self.seconds * 1000, 2)
+
+
+def current_stats():
+    # 不在请求中(脚本、gRPC)时不统计
+    if not has_request_context():
+        return None
+    return g.get("sql_stats")
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault("sql_stats_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    starts = conn.info.get("sql_stats_start")
+    if stats is not None and starts:
+        stats.add(statement, time.perf_counter() - starts.pop())
+
+
+class SqlStats(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQL_STATS_HEADERS", False)
+        app.config.setdefault("SQL_QUERY_BUDGET", 0)
+        app.config.setdefault("SQL_QUERY_BUDGETS", {})
+        # 监听所有engine  多个app只注册一次
+        if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.extensions["sql_stats"] = self
+
+    @staticmethod
+    def before_request():
+        g.sql_stats = RequestSqlStats()
+
+    @staticmethod
+    def after_request(response):
+        stats = g.get("sql_stats")
+        if stats is None:
+            return response
+        config = current_app.config
+        fields = {
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "status": response.status_code,
+            "sql_count": stats.count,
+            "sql_time_ms": stats.milliseconds,
+        }
+        if config["SQL_STATS_HEADERS"]:
+            response.headers["X-SQL-Count"] = str(stats.count)
+            response.headers["X-SQL-Time"] = str(stats.milliseconds)
+        else:
+            logger.info(
+                f"{request.method} {request.path} sql_count={stats.count} "
+                f"sql_time_ms={stats.milliseconds}",
+                extra=fields,
+            )
+
+        budget = config["SQL_QUERY_BUDGETS"].get(
+            request.endpoint, config["SQL_QUERY_BUDGET"]
+        )
+        if budget and stats.count > budget:
+            statement, repeated = stats.fingerprints.most_common(1)[0]
+            logger.warning(
+                f"sql budget exceeded: {request.method} {request.path} "
+                f"sql_count={stats.count} budget={budget} "
+                f"repeated={repeated} statement={statement}",
+                extra=dict(fields, sql_budget=budget, sql_repeated=repeated),
+            )
+        return response
+
+
+sql_stats = SqlStats()
@@ -0,0 +1,70 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+GET请求使用只读事务
+
+SQL_READ_ONLY_GET=True时  GET/HEAD请求中开始的事务为READ ONLY
+    SQL_READ_ONLY_ISOLATION  事务隔离级别  默认REPEATABLE READ
+                             get_site_building等多次查询读到同一快照  为None时使用数据库默认
+    postgres不需要为只读事务分配事务id  GET中误写数据时直接报错
+
+通过psycopg2的set_session设置  随BEGIN一起发送  不增加语句
+连接归还连接池时恢复默认  请求结束时结束只读事务
+"""
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+READ_METHODS = ("GET", "HEAD")
+
+
+def after_begin(session, transaction, connection):
+    options = g.get("db_read_only") if has_app_context() else None
+    if not options:
+        return
+    # DBAPI连接此时还未发送BEGIN
+    connection.connection.set_session(**options)
+    connection.info["read_only_session"] = True
+
+
+def reset_session(dbapi_connection, connection_record):
+    if connection_record.info.pop("read_only_session", None):
+        dbapi_connection.set_session(readonly="DEFAULT", isolation_level="DEFAULT")
+
+
+class ReadOnlyTransactions(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQL_READ_ONLY_GET", False)
+        app.config.setdefault("SQL_READ_ONLY_ISOLATION", None)
+        session = app.extensions["sqlalchemy"].db.session
+        if not event.contains(session, "after_begin", after_begin):
+            event.listen(session, "after_begin", after_begin)
+            event.listen(Pool, "checkin", reset_session)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.extensions["read_only_transactions"] = self
+
+    @staticmethod
+    def before_request():
+        config = current_app.config
+        g.db_read_only = None
+        if config["SQL_READ_ONLY_GET"] and request.method in READ_METHODS:
+            g.db_read_only = {"readonly": True}
+            if config["SQL_READ_ONLY_ISOLATION"]:
+                g.db_read_only["isolation_level"] = config["SQL_READ_ONLY_ISOLATION"]
+
+    @staticmethod
+    def after_request(response):
+        # 流式响应在返回后才查询  保留到请求结束
+        if not g.get("db_read_only") or response.is_streamed:
+            return response
+        g.db_read_only = None
+        current_app.extensions["sqlalchemy"].db.session.rollback()
+        return response
+
+
+read_only_transactions = ReadOnlyTransactions()
@@ -1,30 +1,37 @@
+import json
 import logging
-from flask import request
+from flask import request, Response, stream_with_context
 from flask_restful import Resource
 from app.models import Site
+from app.replicas import read_replica
 from app.handlers.build_site import create_site, update_site, session
-from app.handlers.buildings import get_site_building, update_site_building
+from app.handlers.buildings import (
+    BuildingScope,
+    get_site_building,
+    update_site_building,
+    get_site_building_version,
+    get_cached_site_building,
+    get_site_building_changes,
+    get_elevator_floors,
+    site_building_etag,
+)
 from app.handlers.facility_bind import get_unit_list, update_bind_facility
+from app.handlers.addressing import resolve_facility, resolve_facilities
+from app.handlers.units import resolve_units
+from app.handlers.sites import (
+    STREAM_MIMETYPES,
+    get_sites,
+    get_sites_page,
+    iter_sites,
+    parse_site,
+    search_sites,
+)
 
 logger = logging.getLogger()
 
 
-def parse_site(site: Site):
-    return {
-        "site_uid": site.site_uid,
-        "uuid": str(site.uuid),
-        "name": site.name,
-        "status": site.status,
-        "address": site.address,
-        "has_building_connector": site.has_building_connector,
-        "business_types": site.business_types,
-        "location": site.location,
-        "meta_info": site.meta_info,
-    }
-
-
 class SiteView(Resource):
-    method_decorators = []
+    method_decorators = {"get": [read_replica]}
 
     def get(self):
         site_uuid = request.args.get("site_uuid")
@@ -54,25 +61,53 @@ class SiteView(Resource):
 
 
 class SitesView(Resource):
-    method_decorators = []
+    method_decorators = {"get": [read_replica]}
 
     def get(self):
         name = request.args.get("name")
-        sites = session.query(Site)
-        if name:
-            sites = sites.filter(Site.name.ilike(f"%{name}%"))
+        stream = request.args.get("stream")
+        if stream:
+            if stream not in STREAM_MIMETYPES:
+                return {"msg": "请求参数出错"}
+            return Response(
+                stream_with_context(iter_sites(name, stream)),
+                mimetype=STREAM_MIMETYPES[stream],
+            )
+
+        after = request.args.get("after", type=int)
+        limit = request.args.get("limit", type=int)
+        search = request.args.get("search")
+        if search:
+            return search_sites(search, limit)
+
+        if after is not None or limit is not None:
+            return get_sites_page(name, after, limit)
 
-        return [parse_site(i) for i in sites]
+        return get_sites(name)
 
 
 class BuildingView(Resource):
-    method_decorators = []
+    method_decorators = {"get": [read_replica]}
 
     def get(self):
         site_uuid = request.args.get("site_uuid")
-        if site_uuid is None:
+        scope = BuildingScope.from_args(request.args)
+        if site_uuid is None or scope is None:
             return {"msg": "请求参数出错"}
-        return get_site_building(site_uuid)
+
+        # 先只查site版本号  客户端数据未过期则直接返回304
+        version_id = get_site_building_version(site_uuid)
+        if version_id is None:
+            return {}
+        etag = site_building_etag(site_uuid, version_id, scope)
+        if request.if_none_match.contains(etag):
+            rsp = Response(status=304)
+        else:
+            version_id, data = get_cached_site_building(site_uuid, version_id, scope)
+            etag = site_building_etag(site_uuid, version_id, scope)
+            rsp = Response(data, mimetype="application/json")
+        rsp.set_etag(etag)
+        return rsp
 
     def put(self):
         site_uuid = request.args.get("site_uuid")
@@ -82,12 +117,64 @@ class BuildingView(Resource):
         if data is None:
             return {"msg": "没有请求数据"}
 
-        update_site_building(site_uuid, data)
-        return get_site_building(site_uuid)
+        report = update_site_building(site_uuid, data)
+        # 返回更新后的文档  changes为本次的变更报告  没有变化时为{}
+        version_id = get_site_building_version(site_uuid)
+        _, data = get_cached_site_building(site_uuid, version_id)
+        site_building = json.loads(data)
+        site_building["changes"] = report
+        return site_building
+
+
+class BuildingChangesView(Resource):
+    method_decorators = {"get": [read_replica]}
+
+    def get(self):
+        site_uuid = request.args.get("site_uuid")
+        since_version = request.args.get("since_version", type=int)
+        if site_uuid is None or since_version is None:
+            return {"msg": "请求参数出错"}
+        return get_site_building_changes(site_uuid, since_version)
+
+
+class ElevatorFloorsView(Resource):
+    method_decorators = {"get": [read_replica]}
+
+    def get(self):
+        site_uuid = request.args.get("site_uuid")
+        if site_uuid is None:
+            return {"msg": "请求参数出错"}
+        return get_elevator_floors(
+            site_uuid,
+            request.args.get("building_uuid"),
+            request.args.get("elevator_uuid"),
+        )
+
+
+class FacilityAddressView(Resource):
+    method_decorators = {"get": [read_replica]}
+
+    def get(self):
+        site_uid = request.args.get("site_uid", type=int)
+        group_sid = request.args.get("group_sid", type=int)
+        group_index = request.args.get("group_index", type=int)
+        if None in (site_uid, group_sid, group_index):
+            return {"msg": "请求参数出错"}
+        return resolve_facility(site_uid, group_sid, group_index) or {}
+
+    def post(self):
+        data = request.get_json()
+        if data is None:
+            return {"msg": "没有请求数据"}
+        try:
+            triples = [(i["site_uid"], i["group_sid"], i["group_index"]) for i in data]
+            return resolve_facilities(triples)
+        except (KeyError, TypeError, ValueError):
+            return {"msg": "请求参数出错"}
 
 
 class UnitsView(Resource):
-    method_decorators = []
+    method_decorators = {"get": [read_replica]}
 
     def get(self):
         site_uuid = request.args.get("site_uuid")
@@ -98,6 +185,19 @@ class UnitsView(Resource):
         return get_unit_list(unit_type, site_uuid, building_uuid)
 
 
+class UnitsResolveView(Resource):
+    method_decorators = []
+
+    def post(self):
+        unit_uuids = request.get_json()
+        if unit_uuids is None:
+            return {"msg": "没有请求数据"}
+        try:
+            return resolve_units(unit_uuids)
+        except (TypeError, ValueError):
+            return {"msg": "请求参数出错"}
+
+
 class FacilityBindView(Resource):
     method_decorators = []
 
@@ -10,7 +10,6 @@ from app import create_app, db
 
 app = create_app(os.getenv('FLASK_ENV', 'dev'))
 
-app.debug = True
 manager = Manager(app)
 migrate = Migrate(app, db)
 
@@ -36,6 +35,61 @@ def recreate_db():
     db.session.commit()
 
 
+@manager.command
+def compact_change_log(keep=100):
+    """
+    每个site只保留最近keep个版本的变更日志  更早的版本请求增量时返回完整文档
+    """
+    from app.handlers.buildings import compact_site_change_log
+    print('deleted', compact_site_change_log(int(keep)))
+
+
+@manager.command
+def compile_proto():
+    """
+    生成gRPC代码 app/rpc/topology_pb2.py topology_pb2_grpc.py
+    """
+    from app.rpc import compile_proto as compile_topology_proto
+    if compile_topology_proto() != 0:
+        print('生成失败')
+
+
+@manager.command
+def grpc(port=50051, workers=10):
+    """
+    启动Topology gRPC服务  需要先执行compile_proto
+    """
+    from app.rpc.server import run
+    run(app, int(port), int(workers))
+
+
+@manager.option('-i', '--profile-id', dest='profile_id', default=None)
+@manager.option('-t', '--top', dest='top', default=20)
+def profiles(profile_id=None, top=20):
+    """
+    列出PROFILE_DIR中保存的profile  指定profile id时查看热点函数和慢sql
+    """
+    from app.profiling import list_profiles, summarize_profile
+    directory = app.config['PROFILE_DIR']
+    if profile_id:
+        print(summarize_profile(directory, profile_id, int(top)) or 'profile不存在')
+        return
+    for i in list_profiles(directory)[:int(top)]:
+        print('{id}  {method} {path}  status={status}  {seconds}s  sql_count={sql_count}  sql_ms={sql_ms}'.format(**i))
+
+
+@manager.option('-t', '--top', dest='top', default=20)
+def slow_queries(top=20):
+    """
+    按语句指纹汇总SLOW_QUERY_LOG中的慢sql  附调用函数和执行计划
+    """
+    from app.slowlog import summarize_slow_queries
+    for i in summarize_slow_queries(app.config['SLOW_QUERY_LOG'], int(top)):
+        print('{max_ms:>10.2f}ms  x{count}  {caller}\n    {fingerprint}'.format(**i))
+        for line in i['plan']:
+            print('        ' + line)
+
+
 @manager.command
 def del_version():
     from sqlalchemy import text
@@ -0,0 +1,31 @@
+"""trigram index on site name and address
+
+Revision ID: 5d2a7f9e3b18
+Revises: c3e8a5f41d07
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2a7f9e3b18'
+down_revision = 'c3e8a5f41d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CONCURRENTLY不能在事务中执行  建索引期间不阻塞写入
+    with op.get_context().autocommit_block():
+        op.create_index('ix_site_name_trgm', 'site', ['name'], unique=False, schema='public', postgresql_concurrently=True, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+        op.create_index('ix_site_address_trgm', 'site', ['address'], unique=False, schema='public', postgresql_concurrently=True, postgresql_using='gin', postgresql_ops={'address': 'gin_trgm_ops'})
+
+
+def downgrade():
+    # 扩展可能被其他对象使用  只删除索引
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_site_address_trgm', table_name='site', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_name_trgm', table_name='site', schema='public', postgresql_concurrently=True)
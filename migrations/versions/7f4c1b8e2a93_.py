@@ -0,0 +1,42 @@
+"""site change log
+
+Revision ID: 7f4c1b8e2a93
+Revises: 5d2a7f9e3b18
+Create Date: 2026-10-18 22:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '7f4c1b8e2a93'
+down_revision = '5d2a7f9e3b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('site_change_log',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('site_uuid', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('version_id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=64), nullable=False),
+    sa.Column('entity_uuid', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('op', sa.SmallInteger(), nullable=False),
+    sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('create_time', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    schema='public'
+    )
+    op.create_index('ix_site_change_log_site_uuid', 'site_change_log', ['site_uuid', 'version_id'], unique=False, schema='public')
+    # 已有site没有变更日志  以当前版本写入压缩标记(op=10)  更早的版本请求增量时返回完整文档
+    op.execute(
+        "INSERT INTO public.site_change_log (site_uuid, version_id, table_name, op, data, create_time) "
+        "SELECT uuid, COALESCE(version_id, 0), '', 10, '{}', now() FROM public.site"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_site_change_log_site_uuid', table_name='site_change_log', schema='public')
+    op.drop_table('site_change_log', schema='public')
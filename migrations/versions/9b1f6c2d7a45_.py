@@ -0,0 +1,48 @@
+"""site uid sequence and site sid counter
+
+Revision ID: 9b1f6c2d7a45
+Revises: 4e18a33f3420
+Create Date: 2026-10-18 20:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '9b1f6c2d7a45'
+down_revision = '4e18a33f3420'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('site_uid_seq', schema='public')))
+    # 从已有最大site_uid继续
+    op.execute(
+        "SELECT setval('public.site_uid_seq', "
+        "(SELECT COALESCE(MAX(site_uid), 0) + 1 FROM public.site), false)"
+    )
+    op.create_table('site_sid_counter',
+    sa.Column('site_uuid', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('sid_type', sa.SmallInteger(), nullable=False),
+    sa.Column('last_value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('site_uuid', 'sid_type'),
+    schema='public'
+    )
+    # 以已有数据的最大sid初始化计数器  1: facility_group_sid  2: facility_sid
+    op.execute(
+        "INSERT INTO public.site_sid_counter (site_uuid, sid_type, last_value) "
+        "SELECT site_uuid, 1, COALESCE(MAX(facility_group_sid), 0) FROM public.site_group "
+        "WHERE site_uuid IS NOT NULL GROUP BY site_uuid"
+    )
+    op.execute(
+        "INSERT INTO public.site_sid_counter (site_uuid, sid_type, last_value) "
+        "SELECT site_uuid, 2, COALESCE(MAX(facility_sid), 0) FROM public.site_facility_unit "
+        "WHERE site_uuid IS NOT NULL GROUP BY site_uuid"
+    )
+
+
+def downgrade():
+    op.drop_table('site_sid_counter', schema='public')
+    op.execute(sa.schema.DropSequence(sa.Sequence('site_uid_seq', schema='public')))
@@ -0,0 +1,34 @@
+"""index facility addressing columns
+
+Revision ID: a6e0d3c9b514
+Revises: 7f4c1b8e2a93
+Create Date: 2026-10-18 23:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e0d3c9b514'
+down_revision = '7f4c1b8e2a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CONCURRENTLY不能在事务中执行  建索引期间不阻塞写入
+    with op.get_context().autocommit_block():
+        op.create_index('ix_site_site_uid', 'site', ['site_uid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_group_facility_group_sid', 'site_group', ['site_uuid', 'facility_group_sid'], unique=False, schema='public', postgresql_concurrently=True)
+        # (group_uuid, facility_group_index)同样覆盖只按group_uuid的查询
+        op.create_index('ix_site_facility_unit_group_index', 'site_facility_unit', ['group_uuid', 'facility_group_index'], unique=False, schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_facility_unit_group_uuid', table_name='site_facility_unit', schema='public', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_site_facility_unit_group_uuid', 'site_facility_unit', ['group_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_facility_unit_group_index', table_name='site_facility_unit', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_group_facility_group_sid', table_name='site_group', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_site_uid', table_name='site', schema='public', postgresql_concurrently=True)
@@ -0,0 +1,81 @@
+"""index foreign key like uuid columns
+
+Revision ID: c3e8a5f41d07
+Revises: 9b1f6c2d7a45
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8a5f41d07'
+down_revision = '9b1f6c2d7a45'
+branch_labels = None
+depends_on = None
+
+
+def _has_cmdb():
+    # cmdb表不在初始迁移中  由create_all创建的库才有
+    bind = op.get_bind()
+    return bind.dialect.has_table(bind, 'cmdb', schema='public')
+
+
+def upgrade():
+    # CONCURRENTLY不能在事务中执行  建索引期间不阻塞写入
+    with op.get_context().autocommit_block():
+        op.create_index('ix_building_site_uuid', 'building', ['site_uuid', 'create_time'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_building_floor_building_uuid', 'building_floor', ['building_uuid', 'floor_index'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_building_floor_site_uuid', 'building_floor', ['site_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_building_floor_connector_floor_uuid_1', 'building_floor_connector', ['floor_uuid_1'], unique=False, schema='public', postgresql_concurrently=True, postgresql_where=sa.text('is_delete = 0'))
+        op.create_index('ix_building_floor_connector_floor_uuid_2', 'building_floor_connector', ['floor_uuid_2'], unique=False, schema='public', postgresql_concurrently=True, postgresql_where=sa.text('is_delete = 0'))
+        op.create_index('ix_building_floor_connector_site_uuid', 'building_floor_connector', ['site_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_building_uuid', 'elevator', ['building_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_group_uuid', 'elevator', ['group_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_site_uuid', 'elevator', ['site_uuid', 'create_time'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_floor_building_floor_uuid', 'elevator_floor', ['building_floor_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_floor_elevator_uuid', 'elevator_floor', ['elevator_uuid', 'floor_index'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_elevator_floor_site_uuid', 'elevator_floor', ['site_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_floor_facility_building_uuid', 'floor_facility', ['building_uuid', 'unit_type'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_floor_facility_group_uuid', 'floor_facility', ['group_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_floor_facility_site_uuid', 'floor_facility', ['site_uuid', 'create_time'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_robot_group_uuid', 'robot', ['group_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_robot_site_uuid', 'robot', ['site_uuid', 'create_time'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_facility_unit_facility_uuid', 'site_facility_unit', ['facility_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_facility_unit_group_uuid', 'site_facility_unit', ['group_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_facility_unit_site_uuid', 'site_facility_unit', ['site_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_group_building_uuid', 'site_group', ['building_uuid', 'unit_type'], unique=False, schema='public', postgresql_concurrently=True)
+        op.create_index('ix_site_group_site_uuid', 'site_group', ['site_uuid', 'create_time'], unique=False, schema='public', postgresql_concurrently=True)
+        if _has_cmdb():
+            op.create_index('ix_cmdb_site_uuid', 'cmdb', ['site_uuid'], unique=False, schema='public', postgresql_concurrently=True)
+            op.create_index('ix_cmdb_unbind_unit_type', 'cmdb', ['unit_type'], unique=False, schema='public', postgresql_concurrently=True, postgresql_where=sa.text('site_uuid IS NULL'))
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        if _has_cmdb():
+            op.drop_index('ix_cmdb_unbind_unit_type', table_name='cmdb', schema='public', postgresql_concurrently=True)
+            op.drop_index('ix_cmdb_site_uuid', table_name='cmdb', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_group_site_uuid', table_name='site_group', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_group_building_uuid', table_name='site_group', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_facility_unit_site_uuid', table_name='site_facility_unit', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_facility_unit_group_uuid', table_name='site_facility_unit', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_site_facility_unit_facility_uuid', table_name='site_facility_unit', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_robot_site_uuid', table_name='robot', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_robot_group_uuid', table_name='robot', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_floor_facility_site_uuid', table_name='floor_facility', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_floor_facility_group_uuid', table_name='floor_facility', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_floor_facility_building_uuid', table_name='floor_facility', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_floor_site_uuid', table_name='elevator_floor', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_floor_elevator_uuid', table_name='elevator_floor', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_floor_building_floor_uuid', table_name='elevator_floor', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_site_uuid', table_name='elevator', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_group_uuid', table_name='elevator', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_elevator_building_uuid', table_name='elevator', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_floor_connector_site_uuid', table_name='building_floor_connector', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_floor_connector_floor_uuid_2', table_name='building_floor_connector', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_floor_connector_floor_uuid_1', table_name='building_floor_connector', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_floor_site_uuid', table_name='building_floor', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_floor_building_uuid', table_name='building_floor', schema='public', postgresql_concurrently=True)
+        op.drop_index('ix_building_site_uuid', table_name='building', schema='public', postgresql_concurrently=True)
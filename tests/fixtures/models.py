@@ -13,15 +13,16 @@ from app.script import build_random_unit
 def client():
     cls = CreateApp()
     app = cls.create_app("test")
-    with app.test_client() as client:
-        with app.app_context():
-            # 清空此前测试数据
-            # 注意保证创建site数据库作为测试数据库
-            # dev数据库为postgres
-            cls.db.drop_all()
-            cls.db.create_all()
-            cls.db.session.commit()
-        yield client
+    # 测试代码与请求共用test app的session
+    with app.app_context():
+        # 清空此前测试数据
+        # 注意保证创建site数据库作为测试数据库
+        # dev数据库为postgres
+        cls.db.drop_all()
+        cls.db.create_all()
+        cls.db.session.commit()
+        with app.test_client() as client:
+            yield client
 
 
 @pytest.fixture(scope="function")
@@ -62,11 +63,14 @@ def connect_site(client):
             },
         }
     )
-    yield
-    s = session.query(Site).first()
-    force_cleanup_site(s.uuid)
+    # 返回并只清理本次创建的site  不依赖表中其他site及行的顺序
+    s = session.query(Site).order_by(Site.create_time.desc()).first()
+    site_uuid = s.uuid
+    yield s
+    # 测试中可能已经删除了site
+    force_cleanup_site(site_uuid)
 
 
 @pytest.fixture(scope="function")
-def fake_site():
-    return session.query(Site).first()
+def fake_site(connect_site):
+    return connect_site
@@ -0,0 +1,111 @@
+import json
+from sqlalchemy import event
+from app.handlers.addressing import address_index, resolve_facilities
+from app.handlers.buildings import (
+    session,
+    SiteGroup,
+    SiteFacilityUnit,
+    Unit,
+    get_site_building,
+    update_site_building,
+)
+
+
+def expected_addresses(site_uuid) -> dict:
+    # (site_uid, group_sid, group_index) => facility_uuid
+    rows = (
+        session.query(
+            SiteFacilityUnit.site_uid,
+            SiteGroup.facility_group_sid,
+            SiteFacilityUnit.facility_group_index,
+            SiteFacilityUnit.facility_uuid,
+        )
+        .join(SiteGroup, SiteGroup.uuid == SiteFacilityUnit.group_uuid)
+        .filter(SiteFacilityUnit.site_uuid == site_uuid)
+    )
+    return {tuple(i[:3]): str(i[3]) for i in rows}
+
+
+def resolve_counting(triples) -> tuple:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = resolve_facilities(triples)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return result, len(statements)
+
+
+def test_resolve_facilities(connect_site, fake_site):
+    """
+    按(site_uid, group_sid, group_index)批量寻址  命中缓存后只查一次site版本号
+    """
+    address_index.invalidate(fake_site.uuid)
+    expected = expected_addresses(fake_site.uuid)
+    triples = list(expected)
+    assert len(triples) > 10
+
+    result, query_count = resolve_counting(triples)
+    assert [i["facility_uuid"] for i in result] == list(expected.values())
+    assert query_count == 2
+
+    result, query_count = resolve_counting(triples)
+    assert [i["facility_uuid"] for i in result] == list(expected.values())
+    assert query_count == 1
+
+    site_uid, group_sid, _ = triples[0]
+    assert resolve_facilities([(site_uid, group_sid, 10000), (-1, 1, 1)]) == [
+        None,
+        None,
+    ]
+
+    # 移动机器人后组内编号变化  寻址结果随之变化
+    site_info = get_site_building(fake_site.uuid)
+    groups = site_info["robot_groups"]
+    groups.append(
+        {
+            "name": "addressing robots",
+            "unit_type": Unit.UNIT_TYPE_ROBOT,
+            "members": [groups[0]["members"].pop(0)],
+        }
+    )
+    update_site_building(fake_site.uuid, site_info)
+    expected = expected_addresses(fake_site.uuid)
+    assert list(expected) != triples
+    result = resolve_facilities(list(expected))
+    assert [i["facility_uuid"] for i in result] == list(expected.values())
+
+
+def test_facility_address_api(client, connect_site, fake_site):
+    expected = expected_addresses(fake_site.uuid)
+    (site_uid, group_sid, group_index), facility_uuid = next(iter(expected.items()))
+
+    rsp = client.get(
+        f"/facility/address?site_uid={site_uid}&group_sid={group_sid}&group_index={group_index}"
+    )
+    info = rsp.get_json()
+    assert info["facility_uuid"] == facility_uuid
+    assert info["unit_group_sid"] == group_sid
+    assert info["unit_group_index"] == group_index
+
+    rsp = client.post(
+        "/facility/address",
+        data=json.dumps(
+            [
+                {"site_uid": site_uid, "group_sid": group_sid, "group_index": i}
+                for i in (group_index, 10000)
+            ]
+        ),
+        content_type="application/json",
+    )
+    result = rsp.get_json()
+    assert result[0]["facility_uuid"] == facility_uuid
+    assert result[1] is None
+
+    rsp = client.get(f"/facility/address?site_uid={site_uid}")
+    assert rsp.get_json() == {"msg": "请求参数出错"}
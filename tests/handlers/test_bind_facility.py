@@ -4,7 +4,11 @@ handlers 目录下bind facility测试函数
 """
 
 import json
-from uuid import UUID
+import threading
+import time
+from uuid import UUID, uuid4
+import pytest
+from sqlalchemy import event
 from app.handlers.build_site import (
     session,
     Site,
@@ -19,8 +23,16 @@ from app.handlers.build_site import (
     Unit,
     force_cleanup_site,
 )
-from app.handlers.buildings import get_site_building, update_site_building
+from app.handlers.buildings import (
+    get_site_building,
+    get_site_building_changes,
+    get_site_building_version,
+    update_site_building,
+)
+from app.cache import SingleFlight
+from app.handlers.units import resolve_units
 from app.handlers.facility_bind import (
+    bind_site_unit,
     get_unit_list,
     update_bind_facility,
     get_unbind_unit,
@@ -168,3 +180,205 @@ def test_change_bind_unit(connect_site, fake_site):
 
     assert str(sfu_dict2[robot_1.uuid].unit_uuid) == available_units[1]["unit_uuid"]
     assert str(sfu_dict2[robot_2.uuid].unit_uuid) == available_units[0]["unit_uuid"]
+
+
+def test_rebind_building_gates(connect_site, fake_site):
+    # 整层闸机一次性绑定、交换绑定  语句数量与闸机数量无关
+    building = get_site_building(fake_site.uuid)["buildings"][0]
+    gates = [j["uuid"] for i in building["gate_groups"] for j in i["members"]]
+    units = [i["unit_uuid"] for i in get_unbind_unit(Unit.UNIT_TYPE_GATE, len(gates))]
+    assert len(gates) == len(units) == 5
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def bind(pairs):
+        statements.clear()
+        engine = session.get_bind()
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            update_bind_facility(
+                fake_site.uuid,
+                [
+                    {
+                        "facility_uuid": f,
+                        "unit_type": Unit.UNIT_TYPE_GATE,
+                        "unit_uuid": u,
+                    }
+                    for f, u in pairs
+                ],
+                Unit.UNIT_TYPE_GATE,
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        return len(statements)
+
+    def bound():
+        session.expire_all()
+        sfus = (
+            session.query(SiteFacilityUnit)
+            .filter(SiteFacilityUnit.facility_uuid.in_(gates))
+            .all()
+        )
+        return {str(i.facility_uuid): str(i.unit_uuid) for i in sfus}
+
+    first = bind([(gates[0], units[0])])
+    assert bind(list(zip(gates, units))) <= first + 2
+    assert bound() == dict(zip(gates, units))
+
+    # 交换绑定 先解绑再绑定
+    swapped = units[1:] + units[:1]
+    version_id = get_site_building_version(fake_site.uuid)
+    bind(list(zip(gates, swapped)))
+    assert bound() == dict(zip(gates, swapped))
+    # 变更日志中每个site facility unit只记一条  为最终的绑定结果
+    changes = get_site_building_changes(fake_site.uuid, version_id)["changes"]
+    assert {i["table"] for i in changes} == {"site_facility_unit"}
+    assert sorted(i["data"]["unit_uuid"] for i in changes) == sorted(swapped)
+    cmdbs = session.query(Cmdb).filter(Cmdb.unit_uuid.in_(units)).all()
+    assert {str(i.unit_uuid): str(i.facility_uuid) for i in cmdbs} == dict(
+        zip(swapped, gates)
+    )
+
+    # 绑定类型不一致的设备报错  不写入任何数据
+    robot_unit = get_unbind_unit(Unit.UNIT_TYPE_ROBOT)[0]["unit_uuid"]
+    with pytest.raises(RuntimeError):
+        bind([(gates[0], robot_unit)] + list(zip(gates[1:], swapped[1:])))
+    assert bound() == dict(zip(gates, swapped))
+
+
+def test_bind_site_unit_keeps_session(connect_site, fake_site):
+    # 单个加绑校验失败时  不回滚调用方尚未提交的修改
+    robot = session.query(Robot).filter(Robot.site_uuid == fake_site.uuid).first()
+    gate_unit = get_unbind_unit(Unit.UNIT_TYPE_GATE)[0]["unit_uuid"]
+    robot.name = "robot-pending"
+    try:
+        with pytest.raises(RuntimeError):
+            bind_site_unit(
+                fake_site.uuid, fake_site.site_uid, UUID(gate_unit), robot.uuid
+            )
+        assert robot in session.dirty
+        session.flush()
+        assert (
+            session.query(Robot.name).filter(Robot.uuid == robot.uuid).scalar()
+            == "robot-pending"
+        )
+    finally:
+        session.rollback()
+
+
+def test_resolve_units(client, connect_site, fake_site):
+    """
+    批量查询unit所属site  结果与get_site_info一致  命中缓存不查库  加解绑后缓存失效
+    """
+    robots = (
+        session.query(Robot)
+        .filter(Robot.site_uuid == fake_site.uuid)
+        .order_by(Robot.create_time)
+        .all()
+    )
+    units = [i["unit_uuid"] for i in get_unbind_unit(Unit.UNIT_TYPE_ROBOT, 2)]
+    unknown = str(uuid4())
+
+    def bind(pairs):
+        update_bind_facility(
+            fake_site.uuid,
+            [
+                {
+                    "facility_uuid": str(robot.uuid),
+                    "unit_type": Unit.UNIT_TYPE_ROBOT,
+                    "unit_uuid": unit,
+                }
+                for robot, unit in pairs
+            ],
+            Unit.UNIT_TYPE_ROBOT,
+        )
+
+    def expected(unit_uuid):
+        sfu = SiteFacilityUnit.query_by_unit_uuid(unit_uuid)
+        return sfu.get_site_info() if sfu else None
+
+    def resolve_counting(unit_uuids):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = session.get_bind()
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            result = resolve_units(unit_uuids)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        return result, len(statements)
+
+    bind([(robots[0], units[0])])
+    result, query_count = resolve_counting(units + [unknown])
+    assert result == {i: expected(i) for i in units + [unknown]}
+    assert result[units[0]] is not None
+    assert result[units[1]] is None and result[unknown] is None
+    assert query_count == 1
+    # 已绑定与未绑定的结果都已缓存
+    assert resolve_counting(units + [unknown]) == (result, 0)
+
+    # 换绑后缓存失效
+    bind([(robots[0], units[1])])
+    result = resolve_units(units)
+    assert result[units[0]] is None
+    assert result[units[1]] == expected(units[1])
+
+    rsp = client.post(
+        "/units/resolve", data=json.dumps(units), content_type="application/json"
+    )
+    assert rsp.get_json() == result
+    rsp = client.post(
+        "/units/resolve", data=json.dumps(["x"]), content_type="application/json"
+    )
+    assert rsp.get_json() == {"msg": "请求参数出错"}
+
+
+def test_resolve_units_after_cleanup(connect_site, fake_site):
+    # 删除site后  已缓存的unit不再解析到该site
+    robot = session.query(Robot).filter(Robot.site_uuid == fake_site.uuid).first()
+    unit_uuid = get_unbind_unit(Unit.UNIT_TYPE_ROBOT)[0]["unit_uuid"]
+    update_bind_facility(
+        fake_site.uuid,
+        [
+            {
+                "facility_uuid": str(robot.uuid),
+                "unit_type": Unit.UNIT_TYPE_ROBOT,
+                "unit_uuid": unit_uuid,
+            }
+        ],
+        Unit.UNIT_TYPE_ROBOT,
+    )
+    assert resolve_units([unit_uuid])[unit_uuid]["site_uuid"] == str(fake_site.uuid)
+
+    force_cleanup_site(fake_site.uuid)
+    assert resolve_units([unit_uuid]) == {unit_uuid: None}
+
+
+def test_single_flight():
+    # 并发的相同未命中只执行一次load
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def load(keys):
+        calls.append(sorted(keys))
+        started.set()
+        time.sleep(0.2)
+        return {k: k.upper() for k in keys}
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flight.do_many(["a", "b"], load))
+    )
+    leader.start()
+    started.wait()
+    results.append(flight.do_many(["a", "b", "c"], load))
+    leader.join()
+    assert calls == [["a", "b"], ["c"]]
+    assert results == [{"a": "A", "b": "B"}, {"a": "A", "b": "B", "c": "C"}]
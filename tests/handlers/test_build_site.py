@@ -1,4 +1,10 @@
+import copy
 import json
+import re
+from collections import Counter
+from flask import g
+from app.script import build_site_request
+from app.sqlstats import RequestSqlStats
 from app.handlers.build_site import (
     session,
     Site,
@@ -10,7 +16,10 @@ from app.handlers.build_site import (
     SiteGroup,
     SiteFacilityUnit,
     Unit,
+    BootstrapPlan,
+    create_site,
     force_cleanup_site,
+    update_site,
 )
 
 
@@ -213,3 +222,271 @@ def test_update_site(client):
     elevators = session.query(Elevator).all()
     for ele in elevators:
         assert len(ele.elevator_floors) == 9
+    force_cleanup_site(site_info["uuid"])
+
+
+def test_site_sid_allocation(client):
+    """
+    同一站点下group sid与facility sid连续且不重复  扩展站点后从计数器继续分配
+    """
+    request = {
+        "business_types": [1],
+        "name": "sid大厦",
+        "address": "上海市南京路60号",
+        "has_building_connector": False,
+        "enabled": True,
+        "status": 1,
+        "location": "",
+        "meta_info": {
+            "building_count": 1,
+            "robot_count": 3,
+            "building_info": [
+                {
+                    "name": "",
+                    "floor_count": 3,
+                    "elevator_count": 2,
+                    "station_count": 1,
+                    "gate_count": 2,
+                    "auto_door_count": 1,
+                    "charger_count": 2,
+                }
+            ],
+        },
+    }
+    create_site(request)
+    site = session.query(Site).filter(Site.name == "sid大厦").one()
+
+    def sids():
+        group_sids = session.query(SiteGroup.facility_group_sid).filter(
+            SiteGroup.site_uuid == site.uuid
+        )
+        facility_sids = session.query(SiteFacilityUnit.facility_sid).filter(
+            SiteFacilityUnit.site_uuid == site.uuid
+        )
+        return sorted(i for i, in group_sids), sorted(i for i, in facility_sids)
+
+    group_sids, facility_sids = sids()
+    assert group_sids == list(range(1, len(group_sids) + 1))
+    assert facility_sids == list(range(1, len(facility_sids) + 1))
+
+    request["uuid"] = site.uuid
+    request["meta_info"]["robot_count"] = 5
+    request["meta_info"]["building_info"][0]["charger_count"] = 4
+    update_site(request)
+    group_sids_after, facility_sids_after = sids()
+    assert len(group_sids_after) > len(group_sids)
+    assert len(facility_sids_after) > len(facility_sids)
+    assert group_sids_after == list(range(1, len(group_sids_after) + 1))
+    assert facility_sids_after == list(range(1, len(facility_sids_after) + 1))
+
+    # site uid由sequence分配  不会重复
+    assert Site.gen_site_uid() != Site.gen_site_uid()
+    force_cleanup_site(site.uuid)
+
+
+BOOTSTRAP_TABLES = [cls.__tablename__ for cls in BootstrapPlan.TABLES]
+
+
+def traced_statements(app, func, *args) -> list:
+    # 借用sqlstats的trace记录func执行的全部语句
+    with app.test_request_context(method="POST"):
+        g.sql_stats = RequestSqlStats()
+        g.sql_stats.trace = []
+        func(*args)
+        return [statement for statement, _ in g.sql_stats.trace]
+
+
+def insert_counts(statements: list) -> Counter:
+    # 表名 => INSERT语句数  bootstrap的INSERT不用RETURNING取回主键
+    counts = Counter()
+    for statement in statements:
+        match = re.match(r"\s*INSERT INTO (?:\w+\.)?(\w+)", statement)
+        if match:
+            counts[match.group(1)] += 1
+            if match.group(1) in BOOTSTRAP_TABLES:
+                assert "RETURNING" not in statement
+    return counts
+
+
+def site_row_counts(site_uuid) -> dict:
+    return {
+        cls.__tablename__: session.query(cls).filter(cls.site_uuid == site_uuid).count()
+        for cls in BootstrapPlan.TABLES
+    }
+
+
+def test_bootstrap_bulk_insert(client):
+    """
+    create_site时bootstrap涉及的每张表只有一条INSERT  uuid在客户端生成
+    """
+    request = build_site_request("批量大厦")
+    statements = traced_statements(client.application, create_site, request)
+    site = session.query(Site).filter(Site.name == "批量大厦").one()
+    try:
+        inserts = insert_counts(statements)
+        assert {i: inserts[i] for i in BOOTSTRAP_TABLES} == dict.fromkeys(
+            BOOTSTRAP_TABLES, 1
+        )
+        rows = site_row_counts(site.uuid)
+        assert rows["building"] == 2
+        assert rows["building_floor"] == 2 * 6
+        assert rows["elevator_floor"] == 2 * 3 * 6
+    finally:
+        force_cleanup_site(site.uuid)
+
+
+def test_bootstrap_idempotent(client):
+    """
+    相同请求多次update_site不新增数据  数量减少时只扩展不删除
+    """
+    create_site(build_site_request("幂等大厦"))
+    site = session.query(Site).filter(Site.name == "幂等大厦").one()
+    try:
+        # 与前端一样带上building uuid
+        request = build_site_request("幂等大厦")
+        request["uuid"] = site.uuid
+        request["meta_info"] = copy.deepcopy(site.meta_info)
+        rows = site_row_counts(site.uuid)
+        for _ in range(2):
+            statements = traced_statements(client.application, update_site, request)
+            assert site_row_counts(site.uuid) == rows
+            inserts = insert_counts(statements)
+            assert not any(inserts[i] for i in BOOTSTRAP_TABLES)
+
+        request["meta_info"]["robot_count"] = 1
+        request["meta_info"]["building_info"][0]["floor_count"] = 1
+        request["meta_info"]["building_info"][0]["elevator_count"] = 1
+        update_site(request)
+        assert site_row_counts(site.uuid) == rows
+        assert site.meta_info["building_info"][0]["floor_count"] == 6
+    finally:
+        force_cleanup_site(site.uuid)
+
+
+def test_bootstrap_large_site(client):
+    """
+    bootstrap的语句数与站点规模无关
+    """
+    app = client.application
+    small = traced_statements(app, create_site, build_site_request("小站点"))
+    large = traced_statements(
+        app, create_site, build_site_request("大站点", building_count=100, floor_count=30)
+    )
+    sites = session.query(Site).filter(Site.name.in_(["小站点", "大站点"])).all()
+    try:
+        assert len(large) == len(small)
+        assert len(large) <= 30
+        large_site = [i for i in sites if i.name == "大站点"][0]
+        assert site_row_counts(large_site.uuid)["building"] == 100
+    finally:
+        for site in sites:
+            force_cleanup_site(site.uuid)
+
+
+def test_list_sites_page_and_stream(client):
+    """
+    keyset分页与流式返回的结果与一次性返回一致
+    """
+    for i in range(3):
+        create_site(
+            {
+                "business_types": [1],
+                "name": f"分页大厦{i}",
+                "address": "上海市南京路70号",
+                "has_building_connector": False,
+                "enabled": True,
+                "status": 1,
+                "location": "",
+                "meta_info": {
+                    "building_count": 1,
+                    "robot_count": 1,
+                    "building_info": [
+                        {
+                            "name": "",
+                            "floor_count": 1,
+                            "elevator_count": 1,
+                            "station_count": 1,
+                            "gate_count": 1,
+                            "auto_door_count": 1,
+                            "charger_count": 1,
+                        }
+                    ],
+                },
+            }
+        )
+    sites = client.get("/sites?name=分页大厦").get_json()
+    assert len(sites) == 3
+    expected = sorted(sites, key=lambda i: i["site_uid"])
+
+    items, after = [], None
+    while True:
+        url = "/sites?name=分页大厦&limit=2"
+        if after is not None:
+            url += f"&after={after}"
+        page = client.get(url).get_json()
+        items.extend(page["items"])
+        after = page["next_after"]
+        if after is None:
+            break
+    assert items == expected
+
+    rsp = client.get("/sites?name=分页大厦&stream=ndjson")
+    assert rsp.mimetype == "application/x-ndjson"
+    lines = rsp.get_data(as_text=True).splitlines()
+    assert [json.loads(i) for i in lines] == expected
+
+    rsp = client.get("/sites?name=分页大厦&stream=json")
+    assert rsp.get_json() == expected
+
+    assert client.get("/sites?stream=xml").get_json() == {"msg": "请求参数出错"}
+
+    # 负数limit按1条返回
+    for limit in (-1, -5):
+        page = client.get(f"/sites?name=分页大厦&limit={limit}").get_json()
+        assert page["items"] == expected[:1]
+        assert page["next_after"] == expected[0]["site_uid"]
+
+    for site in sites:
+        force_cleanup_site(site["uuid"])
+
+
+def test_search_sites(client):
+    """
+    按名称/地址相似度搜索  子串与拼写错误都能命中  相似度高的在前
+    """
+    for name, address in (
+        ("搜索大厦", "上海市南京路80号"),
+        ("搜索中心", "上海市浦东新区"),
+        ("search tower", "lujiazui"),
+    ):
+        session.add(
+            Site(
+                site_uid=Site.gen_site_uid(),
+                name=name,
+                address=address,
+                business_types=[1],
+            )
+        )
+    session.commit()
+
+    sites = client.get("/sites?search=搜索").get_json()
+    assert sorted(i["name"] for i in sites) == ["搜索中心", "搜索大厦"]
+
+    sites = client.get("/sites?search=搜索大").get_json()
+    assert [i["name"] for i in sites] == ["搜索大厦"]
+    assert sites[0]["score"] > 0
+
+    sites = client.get("/sites?search=南京路").get_json()
+    assert [i["name"] for i in sites] == ["搜索大厦"]
+
+    sites = client.get("/sites?search=serch tower").get_json()
+    assert [i["name"] for i in sites] == ["search tower"]
+
+    sites = client.get("/sites?search=搜索&limit=1").get_json()
+    assert len(sites) == 1
+    sites = client.get("/sites?search=搜索&limit=-5").get_json()
+    assert len(sites) == 1
+
+    for name in ("搜索大厦", "搜索中心", "search tower"):
+        site = session.query(Site).filter(Site.name == name).one()
+        force_cleanup_site(site.uuid)
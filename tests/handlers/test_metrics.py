@@ -0,0 +1,43 @@
+from app import CreateApp
+from app.metrics import pool_collector
+
+
+def metric_value(text: str, name: str) -> float:
+    # prometheus文本格式中某个sample的值  找不到时为0
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+def test_metrics(client):
+    """
+    /metrics按接口统计耗时、sql语句数和异常  并给出连接池状态
+    """
+    latency = 'site_api_request_seconds_count{method="GET",resource="sitesview"}'
+    queries = 'site_api_sql_queries_total{resource="sitesview"}'
+    # 路由阶段的异常没有endpoint
+    errors = 'site_api_errors_total{exception="MethodNotAllowed",resource="unknown"}'
+    before = client.get("/metrics").data.decode("utf-8")
+
+    client.get("/sites")
+    client.get("/sites?limit=1")
+    client.delete("/site")
+    rsp = client.get("/metrics")
+    assert rsp.content_type.startswith("text/plain")
+    text = rsp.data.decode("utf-8")
+    assert metric_value(text, latency) == metric_value(before, latency) + 2
+    assert metric_value(text, queries) >= metric_value(before, queries) + 2
+    assert metric_value(text, errors) == metric_value(before, errors) + 1
+    assert "site_api_db_pool_wait_seconds_count" in text
+    assert 'site_api_db_pool_size{database="site"}' in text
+
+    # 同一数据库再创建app  只上报一组连接池指标  不保留旧app
+    apps = len(pool_collector.apps)
+    CreateApp().create_app("test")
+    try:
+        text = client.get("/metrics").data.decode("utf-8")
+        assert text.count('site_api_db_pool_size{database="site"}') == 1
+        assert len(pool_collector.apps) == apps
+    finally:
+        pool_collector.register(client.application)
@@ -0,0 +1,63 @@
+import json
+from gevent import monkey
+from app.handlers.buildings import get_site_building
+from app.profiling import list_profiles, summarize_profile
+
+
+def test_profile_request(client, connect_site, fake_site, tmp_path):
+    """
+    带上token或匹配allowlist的请求保存cProfile结果和sql语句  响应头返回profile id
+    """
+    config = client.application.config
+    config.update(PROFILE_DIR=str(tmp_path), PROFILE_TOKEN="profile-token")
+    url = f"/building?site_uuid={fake_site.uuid}"
+    site_info = get_site_building(fake_site.uuid)
+    try:
+        rsp = client.put(
+            url,
+            data=json.dumps(site_info),
+            content_type="application/json",
+            headers={"X-Profile": "profile-token"},
+        )
+        profile_id = rsp.headers["X-Profile-Id"]
+        assert "X-Profile-Id" not in client.get(url, headers={"X-Profile": "x"}).headers
+
+        config["PROFILE_ALLOWLIST"] = [
+            {"endpoint": "buildingview", "site_uuid": str(fake_site.uuid)}
+        ]
+        assert "X-Profile-Id" in client.get(url).headers
+        assert "X-Profile-Id" not in client.get("/sites").headers
+    finally:
+        config.update(PROFILE_TOKEN=None, PROFILE_ALLOWLIST=[])
+
+    profiles = list_profiles(str(tmp_path))
+    assert len(profiles) == 2
+    assert profiles[-1]["id"] == profile_id
+    assert profiles[-1]["method"] == "PUT"
+    assert profiles[-1]["sql_count"] == int(rsp.headers["X-SQL-Count"])
+    summary = summarize_profile(str(tmp_path), profile_id)
+    assert "update_site_building" in summary
+    assert "slowest sql" in summary
+    assert summarize_profile(str(tmp_path), "unknown") is None
+
+
+def test_profile_under_gevent(client, connect_site, fake_site, tmp_path, monkeypatch):
+    """
+    gevent patch了threading时profile会混入其他协程  记录并在查看时提示
+    """
+    config = client.application.config
+    config.update(PROFILE_DIR=str(tmp_path), PROFILE_TOKEN="profile-token")
+    url = f"/building?site_uuid={fake_site.uuid}"
+    headers = {"X-Profile": "profile-token"}
+    try:
+        threaded_id = client.get(url, headers=headers).headers["X-Profile-Id"]
+        monkeypatch.setattr(monkey, "is_module_patched", lambda name: True)
+        gevent_id = client.get(url, headers=headers).headers["X-Profile-Id"]
+    finally:
+        config.update(PROFILE_TOKEN=None)
+
+    profiles = {i["id"]: i for i in list_profiles(str(tmp_path))}
+    assert profiles[threaded_id]["greenlets"] is False
+    assert profiles[gevent_id]["greenlets"] is True
+    assert "其他协程" not in summarize_profile(str(tmp_path), threaded_id)
+    assert "其他协程" in summarize_profile(str(tmp_path), gevent_id)
@@ -0,0 +1,158 @@
+import json
+import pytest
+
+grpc = pytest.importorskip("grpc")
+pytest.importorskip("grpc_tools")
+
+from google.protobuf import json_format
+from app.rpc import compile_proto
+from app.handlers.buildings import (
+    session,
+    Elevator,
+    Robot,
+    Unit,
+    get_elevator_floors,
+    get_site_building,
+)
+from app.handlers.facility_bind import get_unit_list, update_bind_facility
+
+assert compile_proto() == 0
+from app.rpc import topology_pb2, topology_pb2_grpc
+from app.rpc.server import serve
+
+
+@pytest.fixture(scope="module")
+def stub(client):
+    # 与测试中的session使用同一个app  否则server读不到测试数据
+    server, port = serve(session().app, 0, 4)
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        yield topology_pb2_grpc.TopologyStub(channel)
+    server.stop(0)
+
+
+def as_message(cls, data: dict):
+    return json_format.ParseDict(data, cls(), ignore_unknown_fields=True)
+
+
+def test_rpc_site_building(client, connect_site, fake_site, stub):
+    site_uuid = str(fake_site.uuid)
+    rsp = stub.GetSiteBuilding(topology_pb2.SiteBuildingRequest(site_uuid=site_uuid))
+    site_info = get_site_building(site_uuid)
+    assert rsp.version_id == site_info["version_id"]
+    assert len(rsp.buildings) == len(site_info["buildings"])
+    for building, expected in zip(rsp.buildings, site_info["buildings"]):
+        assert [i.uuid for i in building.elevators] == [
+            i["uuid"] for i in expected["elevators"]
+        ]
+        assert [[f.uuid for f in i.elevator_floors] for i in building.elevators] == [
+            [f["uuid"] for f in i["elevator_floors"]] for i in expected["elevators"]
+        ]
+        assert [[m.unit_uid for m in g.members] for g in building.charger_groups] == [
+            [m["unit_uid"] for m in g["members"]] for g in expected["charger_groups"]
+        ]
+    assert [g.name for g in rsp.robot_groups] == [
+        g["name"] for g in site_info["robot_groups"]
+    ]
+
+    # 与GET /building?fields=elevators&expand= 返回相同
+    building_uuid = site_info["buildings"][0]["uuid"]
+    rsp = stub.GetSiteBuilding(
+        topology_pb2.SiteBuildingRequest(
+            site_uuid=site_uuid,
+            fields=["elevators"],
+            collapse=["elevator_floors", "members"],
+            building_uuid=building_uuid,
+        )
+    )
+    expected = client.get(
+        f"/building?site_uuid={site_uuid}&fields=elevators&expand=&building_uuid={building_uuid}"
+    ).get_json()
+    assert [b.uuid for b in rsp.buildings] == [building_uuid]
+    assert [
+        {"uuid": i.uuid, "name": i.name, "brand": i.brand}
+        for i in rsp.buildings[0].elevators
+    ] == expected["buildings"][0]["elevators"]
+    assert not rsp.buildings[0].building_floors
+    assert not rsp.robot_groups
+
+    with pytest.raises(grpc.RpcError) as e:
+        stub.GetSiteBuilding(
+            topology_pb2.SiteBuildingRequest(site_uuid=site_uuid, fields=["unknown"])
+        )
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+    with pytest.raises(grpc.RpcError) as e:
+        stub.GetSiteBuilding(
+            topology_pb2.SiteBuildingRequest(
+                site_uuid="00000000-0000-0000-0000-000000000000"
+            )
+        )
+    assert e.value.code() == grpc.StatusCode.NOT_FOUND
+
+
+def test_rpc_elevator_floors(client, connect_site, fake_site, stub):
+    site_uuid = str(fake_site.uuid)
+    expected = get_elevator_floors(site_uuid)
+    assert len(expected) == 5
+    assert all(
+        [f["floor_index"] for f in i["elevator_floors"]]
+        == sorted(f["floor_index"] for f in i["elevator_floors"])
+        for i in expected
+    )
+    assert client.get(f"/elevator/floors?site_uuid={site_uuid}").get_json() == expected
+
+    rsp = stub.GetElevatorFloors(
+        topology_pb2.ElevatorFloorsRequest(site_uuid=site_uuid)
+    )
+    assert rsp == as_message(topology_pb2.ElevatorFloorsReply, {"elevators": expected})
+
+    elevator = session.query(Elevator).filter(Elevator.site_uuid == site_uuid).first()
+    rsp = stub.GetElevatorFloors(
+        topology_pb2.ElevatorFloorsRequest(
+            site_uuid=site_uuid, elevator_uuid=str(elevator.uuid)
+        )
+    )
+    assert [i.uuid for i in rsp.elevators] == [str(elevator.uuid)]
+    assert len(rsp.elevators[0].elevator_floors) == len(elevator.elevator_floors)
+
+
+def test_rpc_units(client, connect_site, fake_site, stub):
+    site_uuid = str(fake_site.uuid)
+    robots = get_unit_list(Unit.UNIT_TYPE_ROBOT, site_uuid)
+    rsp = stub.ListUnits(
+        topology_pb2.ListUnitsRequest(
+            site_uuid=site_uuid, unit_type=Unit.UNIT_TYPE_ROBOT
+        )
+    )
+    assert rsp == as_message(topology_pb2.ListUnitsReply, {"units": robots})
+
+    robot = session.query(Robot).filter(Robot.site_uuid == site_uuid).first()
+    bound, unbound = [i["unit_uuid"] for i in robots[:2]]
+    update_bind_facility(
+        site_uuid,
+        [
+            {
+                "facility_uuid": str(robot.uuid),
+                "unit_type": Unit.UNIT_TYPE_ROBOT,
+                "unit_uuid": bound,
+            }
+        ],
+        Unit.UNIT_TYPE_ROBOT,
+    )
+    unit_uuids = [bound, unbound]
+    expected = json.loads(
+        client.post(
+            "/units/resolve",
+            data=json.dumps(unit_uuids),
+            content_type="application/json",
+        ).data
+    )
+    rsp = stub.ResolveUnits(topology_pb2.ResolveUnitsRequest(unit_uuids=unit_uuids))
+    assert rsp == as_message(
+        topology_pb2.ResolveUnitsReply,
+        {"units": {k: v for k, v in expected.items() if v}},
+    )
+    assert list(rsp.units) == [bound]
+
+    with pytest.raises(grpc.RpcError) as e:
+        stub.ResolveUnits(topology_pb2.ResolveUnitsRequest(unit_uuids=["x"]))
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
@@ -0,0 +1,54 @@
+import json
+from sqlalchemy import func
+from app.handlers.buildings import session, Site
+from app.slowlog import (
+    ExplainLimiter,
+    explain_options,
+    slow_query_log,
+    summarize_slow_queries,
+)
+
+
+def test_slow_query_log(client, connect_site, fake_site, tmp_path):
+    """
+    超过阈值的语句连同调用函数和执行计划写入日志  EXPLAIN受限流控制
+    """
+    assert explain_options("SELECT 1") == "(ANALYZE, BUFFERS)"
+    assert explain_options("SELECT * FROM site FOR UPDATE") == ""
+    assert explain_options("UPDATE site SET name = 'a'") == ""
+    assert explain_options("SELECT nextval('public.site_uid_seq')") == ""
+    assert explain_options("SELECT pg_advisory_lock(1)") == ""
+    assert explain_options("SELECT 1", analyze=False) == ""
+
+    limiter = ExplainLimiter(per_minute=2, cooldown=600)
+    assert limiter.allow("a") and not limiter.allow("a")
+    assert limiter.allow("b") and not limiter.allow("c")
+
+    path = str(tmp_path / "slow.log")
+    saved = (slow_query_log.threshold, slow_query_log.path, slow_query_log.limiter)
+    slow_query_log.threshold = 1e-9
+    slow_query_log.path = path
+    slow_query_log.limiter = ExplainLimiter(per_minute=1000, cooldown=600)
+    try:
+        rsp = client.get(f"/building?site_uuid={fake_site.uuid}")
+        assert rsp.status_code == 200
+        slow_query_log.join()
+        # 有副作用或指定了不ANALYZE的语句只取计划  nextval不会多消耗一个序列值
+        site_uid = Site.gen_site_uid()
+        session.query(func.now()).execution_options(slow_query_analyze=False).scalar()
+        slow_query_log.join()
+    finally:
+        slow_query_log.threshold, slow_query_log.path, slow_query_log.limiter = saved
+    assert Site.gen_site_uid() == site_uid + 1
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records
+    assert all(i["caller"].startswith("app.") for i in records[:-2])
+    assert all(i["endpoint"] == "buildingview" for i in records[:-2])
+    assert [i["explain"] for i in records[-2:]] == ["plan", "plan"]
+    analyzed = [i for i in records if i["explain"] == "analyze"]
+    assert analyzed and "error" not in analyzed[0]
+    assert any("actual time" in line for line in analyzed[0]["plan"])
+    summary = summarize_slow_queries(path)
+    assert summary[0]["max_ms"] >= summary[-1]["max_ms"]
@@ -0,0 +1,28 @@
+from app.sqlstats import fingerprint
+
+
+def test_sql_stats(client, connect_site, fake_site, caplog):
+    """
+    响应头带上请求内的sql语句数  超出endpoint预算时记warning并给出重复最多的语句
+    """
+    url = f"/building?site_uuid={fake_site.uuid}"
+    rsp = client.get(url + "&fields=elevators")
+    # 版本号 + site + building + elevator + elevator_floor  与building数量无关
+    assert int(rsp.headers["X-SQL-Count"]) == 5
+    assert float(rsp.headers["X-SQL-Time"]) >= 0
+
+    config = client.application.config
+    config["SQL_QUERY_BUDGETS"] = {"buildingview": 1}
+    try:
+        with caplog.at_level("WARNING", logger="app.sqlstats"):
+            client.get(url + "&fields=elevators&expand=")
+    finally:
+        config["SQL_QUERY_BUDGETS"] = {}
+    record = next(i for i in caplog.records if i.name == "app.sqlstats")
+    assert record.endpoint == "buildingview"
+    assert record.sql_count > record.sql_budget == 1
+    assert "sql budget exceeded" in record.getMessage()
+
+    assert fingerprint(
+        "SELECT a FROM t WHERE b = %(b_1)s AND c IN (%(c_1)s, %(c_2)s) LIMIT 10"
+    ) == fingerprint("SELECT a FROM t WHERE b = %(b_1)s AND c IN (%(c_1)s) LIMIT 20")
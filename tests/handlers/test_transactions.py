@@ -0,0 +1,51 @@
+import threading
+import pytest
+from sqlalchemy.exc import InternalError
+from app import db
+from app.handlers.build_site import session, Site
+
+
+def test_session_per_request(client, connect_site):
+    """
+    请求结束时关闭并移除session  连接归还连接池  对象不在请求之间共享
+    """
+    app = client.application
+    pool = db.get_engine(app).pool
+    checked_out = pool.checkedout()
+    result = {"sites": []}
+
+    def worker():
+        # 新线程中没有app context  每个请求单独push和pop
+        worker_client = app.test_client()
+        for _ in range(3):
+            assert worker_client.get("/sites").status_code == 200
+            result["sites"].append(session.registry.has())
+        with app.app_context():
+            first = session.query(Site).first()
+        with app.app_context():
+            result["identity"] = session.query(Site).first() is first
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert result == {"sites": [False, False, False], "identity": False}
+    assert pool.checkedout() == checked_out
+
+
+def test_read_only_get(client):
+    """
+    GET请求中的事务为只读的REPEATABLE READ  请求结束后恢复
+    """
+    app = client.application
+    session.commit()
+    with app.test_request_context("/sites", method="GET"):
+        app.preprocess_request()
+        assert session.execute("SHOW transaction_read_only").scalar() == "on"
+        isolation = session.execute("SHOW transaction_isolation").scalar()
+        assert isolation == "repeatable read"
+        with pytest.raises(InternalError):
+            session.execute("UPDATE site SET name = name")
+        session.rollback()
+        app.process_response(app.make_response(({}, 200)))
+    assert session.execute("SHOW transaction_read_only").scalar() == "off"
+    session.commit()
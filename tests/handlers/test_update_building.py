@@ -1,6 +1,8 @@
 import json
 import random
 import uuid
+import pytest
+from sqlalchemy import event
 from app.handlers.buildings import (
     session,
     Site,
@@ -14,10 +16,15 @@ from app.handlers.buildings import (
     SiteGroup,
     SiteFacilityUnit,
     Unit,
+    BuildingScope,
+    SiteChangeLog,
     get_site_building,
+    get_site_building_changes,
     update_site_building,
 )
-from app.handlers.build_site import force_cleanup_site, update_site
+from app.handlers.build_site import force_cleanup_site, flush_group_index, update_site
+from app.handlers.facility_bind import get_unbind_unit, update_bind_facility
+from app.handlers.units import resolve_units
 
 
 class BuildingInfo(object):
@@ -633,3 +640,367 @@ def test_get_section_building(connect_site, fake_site):
     building_info = get_site_building(fake_site.uuid)
     building3 = building_info["buildings"][2]
     assert building3["name"] == "楼宇 3"
+
+
+def count_queries(func, *args):
+    # 统计func执行期间发出的sql条数
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = func(*args)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return result, len(statements)
+
+
+def test_get_site_building_batched(connect_site, fake_site):
+    """
+    批量加载的结果与model方法逐个查询的结果一致  且查询次数与building数量无关
+    """
+    site_info = get_site_building(fake_site.uuid)
+    building_1_floor_1 = site_info["buildings"][0]["building_floors"][0]
+    building_1_floor_1["connected_building_floor_uuid"] = site_info["buildings"][1][
+        "building_floors"
+    ][0]["uuid"]
+    update_site_building(fake_site.uuid, site_info)
+
+    site_info, query_count = count_queries(get_site_building, fake_site.uuid)
+
+    buildings = (
+        session.query(Building)
+        .filter(Building.site_uuid == fake_site.uuid)
+        .order_by(Building.create_time)
+        .all()
+    )
+    robot_groups = (
+        session.query(SiteGroup)
+        .filter(
+            SiteGroup.site_uuid == fake_site.uuid,
+            SiteGroup.unit_type == Unit.UNIT_TYPE_ROBOT,
+        )
+        .order_by(SiteGroup.create_time)
+        .all()
+    )
+    assert site_info["buildings"] == [i.get_building_info() for i in buildings]
+    assert site_info["robot_groups"] == [i.get_site_group_info() for i in robot_groups]
+    assert (
+        site_info["buildings"][0]["building_floors"][0]["connected_building_floor_uuid"]
+        == building_1_floor_1["connected_building_floor_uuid"]
+    )
+
+    meta_info = fake_site.meta_info
+    meta_info["building_info"].append(
+        {
+            "name": "楼宇 3",
+            "floor_count": 7,
+            "elevator_count": 2,
+            "gate_count": 1,
+            "charger_count": 2,
+            "station_count": 1,
+            "auto_door_count": 3,
+        }
+    )
+    meta_info["building_count"] = 3
+    update_site(
+        {
+            "uuid": fake_site.uuid,
+            "name": fake_site.name,
+            "address": fake_site.address,
+            "status": fake_site.status,
+            "has_building_connector": fake_site.has_building_connector,
+            "business_types": fake_site.business_types,
+            "location": fake_site.location,
+            "meta_info": meta_info,
+        }
+    )
+    site_info, query_count_after = count_queries(get_site_building, fake_site.uuid)
+    assert len(site_info["buildings"]) == 3
+    assert query_count_after == query_count
+
+
+def test_get_site_building_floors_mismatch(connect_site, fake_site):
+    """
+    building_floors与楼层数据不一致时  批量加载与model方法同样报SystemError
+    """
+    building = (
+        session.query(Building)
+        .filter(Building.site_uuid == fake_site.uuid)
+        .order_by(Building.create_time)
+        .first()
+    )
+    building.building_floors = building.building_floors + [str(uuid.uuid4())]
+    session.flush()
+    try:
+        with pytest.raises(SystemError):
+            get_site_building(fake_site.uuid)
+        with pytest.raises(SystemError):
+            building.get_building_info()
+    finally:
+        session.rollback()
+
+
+def test_get_building_etag(client, connect_site, fake_site):
+    """
+    GET /building 带ETag  数据未变化返回304  写操作后版本号变化重新返回数据
+    """
+    url = f"/building?site_uuid={fake_site.uuid}"
+    rsp = client.get(url)
+    etag = rsp.headers["ETag"]
+    site_info = rsp.get_json()
+    assert site_info == get_site_building(fake_site.uuid)
+
+    rsp = client.get(url, headers={"If-None-Match": etag})
+    assert rsp.status_code == 304
+    assert rsp.headers["ETag"] == etag
+
+    site_info["robot_groups"][0]["name"] = "ETAG ROBOT"
+    update_site_building(fake_site.uuid, site_info)
+
+    rsp = client.get(url, headers={"If-None-Match": etag})
+    assert rsp.status_code == 200
+    assert rsp.headers["ETag"] != etag
+    assert rsp.get_json()["robot_groups"][0]["name"] == "ETAG ROBOT"
+
+
+def test_get_building_scope(client, connect_site, fake_site):
+    """
+    fields/expand/building_uuid只返回请求的部分  与完整文档对应部分一致  查询更少
+    """
+    url = f"/building?site_uuid={fake_site.uuid}"
+    full = client.get(url).get_json()
+    building = full["buildings"][0]
+
+    rsp = client.get(url + "&fields=elevators,building_floors&expand=")
+    site_info = rsp.get_json()
+    assert "robot_groups" not in site_info
+    assert rsp.headers["ETag"] != client.get(url).headers["ETag"]
+    info = site_info["buildings"][0]
+    assert set(info) == {"uuid", "name", "address", "elevators", "building_floors"}
+    assert info["building_floors"] == building["building_floors"]
+    assert info["elevators"] == [
+        {k: v for k, v in i.items() if k != "elevator_floors"}
+        for i in building["elevators"]
+    ]
+
+    site_info = client.get(
+        url + f"&fields=charger_groups&building_uuid={building['uuid']}"
+    ).get_json()
+    assert site_info["buildings"] == [
+        {
+            "uuid": building["uuid"],
+            "name": building["name"],
+            "address": building["address"],
+            "charger_groups": building["charger_groups"],
+        }
+    ]
+
+    site_info = client.get(url + "&fields=robot_groups").get_json()
+    assert site_info["robot_groups"] == full["robot_groups"]
+
+    assert client.get(url + "&fields=floors").get_json() == {"msg": "请求参数出错"}
+    assert client.get(url + "&building_uuid=1").get_json() == {"msg": "请求参数出错"}
+
+    _, query_count = count_queries(get_site_building, fake_site.uuid)
+    _, scoped_count = count_queries(
+        get_site_building,
+        fake_site.uuid,
+        BuildingScope(fields=["charger_groups"], expand=[]),
+    )
+    assert scoped_count < query_count
+
+
+def test_baked_queries(connect_site, fake_site):
+    """
+    baked query按类区分缓存  IN列表长度不同时共用同一个查询
+    """
+    assert Site.get_by_uuid(fake_site.uuid).uuid == fake_site.uuid
+    assert Building.get_by_uuid(fake_site.uuid) is None
+    group = (
+        session.query(SiteGroup)
+        .filter(SiteGroup.site_uuid == fake_site.uuid)
+        .filter(SiteGroup.unit_type == Unit.UNIT_TYPE_GATE)
+        .first()
+    )
+    assert len(group.get_members_attr()) == len(group.members) > 1
+    assert SiteGroup(unit_type=Unit.UNIT_TYPE_GATE, members=[]).get_members_attr() == []
+    one = SiteGroup(unit_type=Unit.UNIT_TYPE_GATE, members=group.members[:1])
+    assert one.get_members_attr()[0]["uuid"] == group.members[0]
+
+
+def test_get_building_changes(client, connect_site, fake_site):
+    """
+    GET /building/changes返回某版本之后的变更  日志压缩后返回完整文档
+    """
+    url = f"/building/changes?site_uuid={fake_site.uuid}"
+    # 从头开始的日志包含创建site时新增的所有行
+    changes = client.get(url + "&since_version=0").get_json()["changes"]
+    created = {i["uuid"] for i in changes if i["op"] == "create"}
+    site_info = get_site_building(fake_site.uuid)
+    assert {i["uuid"] for i in site_info["buildings"]} <= created
+    assert {i["uuid"] for i in site_info["robot_groups"]} <= created
+
+    version_id = site_info["version_id"]
+    rsp = client.get(url + f"&since_version={version_id}").get_json()
+    assert rsp == {"version_id": version_id, "changes": []}
+
+    site_info["robot_groups"][0]["name"] = "CHANGES ROBOT"
+    update_site_building(fake_site.uuid, site_info)
+    rsp = client.get(url + f"&since_version={version_id}").get_json()
+    assert rsp == {
+        "version_id": version_id + 1,
+        "changes": [
+            {
+                "version_id": version_id + 1,
+                "table": "site_group",
+                "uuid": site_info["robot_groups"][0]["uuid"],
+                "op": "update",
+                "data": {"name": "CHANGES ROBOT"},
+            }
+        ],
+    }
+
+    # 压缩后早于压缩版本的请求返回完整文档
+    SiteChangeLog.compact(fake_site.uuid, version_id + 1)
+    session.commit()
+    rsp = client.get(url + f"&since_version={version_id}").get_json()
+    assert rsp["version_id"] == version_id + 1
+    assert rsp["snapshot"] == get_site_building(fake_site.uuid)
+    rsp = client.get(url + f"&since_version={version_id + 1}").get_json()
+    assert rsp == {"version_id": version_id + 1, "changes": []}
+    # 客户端版本比服务端新
+    assert "snapshot" in client.get(url + f"&since_version={version_id + 2}").get_json()
+    assert client.get(url).get_json() == {"msg": "请求参数出错"}
+
+
+def test_flush_group_index_incremental(connect_site, fake_site):
+    """
+    移动一个机器人到新组  只重新编号变动的组  组内按facility_sid编号
+    """
+    site_info = get_site_building(fake_site.uuid)
+    groups = site_info["robot_groups"]
+    old_group_uuid = groups[0]["uuid"]
+    new_group = new_robot_group()
+    new_group["members"].append(groups[0]["members"].pop(0))
+    groups.append(new_group)
+    update_site_building(fake_site.uuid, site_info)
+
+    sfus = (
+        session.query(SiteFacilityUnit)
+        .filter(SiteFacilityUnit.site_uuid == fake_site.uuid)
+        .order_by(SiteFacilityUnit.facility_sid)
+        .all()
+    )
+    group_index = {}
+    for sfu in sfus:
+        group_index.setdefault(sfu.group_uuid, []).append(sfu.facility_group_index)
+    for indexes in group_index.values():
+        assert indexes == list(range(1, len(indexes) + 1))
+
+    new_group_uuid = next(
+        i.uuid
+        for i in session.query(SiteGroup).filter(SiteGroup.name == new_group["name"])
+    )
+    assert group_index[new_group_uuid] == [1]
+    assert len(group_index[uuid.UUID(old_group_uuid)]) == 2
+    # 编号稳定  再次刷新不改写任何行
+    assert flush_group_index(fake_site.uuid) == 0
+    assert flush_group_index(fake_site.uuid, [new_group_uuid]) == 0
+    assert flush_group_index(fake_site.uuid, []) == 0
+
+
+def test_update_site_building_diff(connect_site, fake_site):
+    """
+    未修改的文档不产生任何写入  只修改一个字段时只写回这个字段
+    """
+    site_info = get_site_building(fake_site.uuid)
+    version_id = site_info["version_id"]
+    assert update_site_building(fake_site.uuid, site_info) == {}
+    assert get_site_building(fake_site.uuid)["version_id"] == version_id
+
+    building_floor = site_info["buildings"][0]["building_floors"][1]
+    building_floor["name"] = "diff floor"
+    report = update_site_building(fake_site.uuid, site_info)
+    assert report == {
+        "updated": {"building_floor": {building_floor["uuid"]: {"name": "diff floor"}}}
+    }
+
+    site_info = get_site_building(fake_site.uuid)
+    assert site_info["version_id"] == version_id + 1
+    assert site_info["buildings"][0]["building_floors"][1]["name"] == "diff floor"
+
+
+def test_put_building_changes(client, connect_site, fake_site):
+    """
+    PUT /building返回更新后的文档和变更报告  未修改的文档不升版本号
+    """
+    site_info = get_site_building(fake_site.uuid)
+    version_id = site_info["version_id"]
+    url = f"/building?site_uuid={fake_site.uuid}"
+
+    rsp = client.put(url, data=json.dumps(site_info), content_type="application/json")
+    body = rsp.get_json()
+    assert body.pop("changes") == {}
+    assert body == site_info
+    assert body["version_id"] == version_id
+
+    building = site_info["buildings"][0]
+    building["name"] = "changes building"
+    rsp = client.put(url, data=json.dumps(site_info), content_type="application/json")
+    body = rsp.get_json()
+    assert body["changes"] == {
+        "updated": {"building": {building["uuid"]: {"name": "changes building"}}}
+    }
+    assert body["version_id"] == version_id + 1
+    assert body["buildings"][0]["name"] == "changes building"
+
+
+def test_move_bound_unit_to_group(connect_site, fake_site):
+    """
+    已绑定的unit换到新组  组内编号不变时unit缓存同样失效
+    """
+    site_info = get_site_building(fake_site.uuid)
+    building = BuildingInfo(site_info["buildings"][0], Unit.UNIT_TYPE_GATE)
+    member_uuids = [i["uuid"] for i in building.groups[0]["members"]]
+    # 组内编号为1的成员
+    first = (
+        session.query(SiteFacilityUnit)
+        .filter(SiteFacilityUnit.facility_uuid.in_(member_uuids))
+        .order_by(SiteFacilityUnit.facility_sid)
+        .first()
+    )
+    unit_uuid = get_unbind_unit(Unit.UNIT_TYPE_GATE)[0]["unit_uuid"]
+    update_bind_facility(
+        fake_site.uuid,
+        [
+            {
+                "facility_uuid": str(first.facility_uuid),
+                "unit_type": Unit.UNIT_TYPE_GATE,
+                "unit_uuid": unit_uuid,
+            }
+        ],
+        Unit.UNIT_TYPE_GATE,
+    )
+    old_group_sid = resolve_units([unit_uuid])[unit_uuid]["unit_group_sid"]
+
+    site_info = get_site_building(fake_site.uuid)
+    building = BuildingInfo(site_info["buildings"][0], Unit.UNIT_TYPE_GATE)
+    new_group = building.new_group(building.groups[0]["building_floor_uuid"])
+    building.add_group(new_group)
+    member_index = member_uuids.index(str(first.facility_uuid))
+    building.move_group_member(0, len(building.groups) - 1, member_index)
+    update_site_building(fake_site.uuid, site_info)
+
+    new_group_sid = (
+        session.query(SiteGroup.facility_group_sid)
+        .filter(SiteGroup.name == new_group["name"])
+        .scalar()
+    )
+    info = resolve_units([unit_uuid])[unit_uuid]
+    assert new_group_sid != old_group_sid
+    assert info["unit_group_sid"] == new_group_sid
+    assert info["unit_group_index"] == 1
@@ -0,0 +1,73 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+生产环境入口  gevent WSGIServer
+
+启动前patch标准库和psycopg2  数据库io时切换greenlet  不阻塞其他请求
+    python wsgi.py --host 0.0.0.0 --port 5000 --concurrency 100
+
+同时处理的请求数不超过concurrency  每个请求最多占用一个数据库连接
+连接池大小与concurrency相同  另留SERVER_POOL_OVERFLOW个给慢sql的EXPLAIN等
+多进程部署时注意  进程数 x (concurrency + overflow) 不能超过postgres的max_connections
+
+也可以用gunicorn启动  并发数取SERVER_CONCURRENCY
+    gunicorn -k gevent --worker-connections 100 wsgi:application
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+
+patch_psycopg()
+
+import argparse
+import logging
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import create_app
+
+logger = logging.getLogger(__name__)
+
+
+def size_pool(app, concurrency: int):
+    # engine在第一次使用时创建  此前修改连接池参数即可
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    options.update(
+        pool_size=concurrency, max_overflow=app.config["SERVER_POOL_OVERFLOW"]
+    )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+application = create_app(os.getenv("FLASK_ENV", "prd"))
+application.debug = False
+size_pool(application, application.config["SERVER_CONCURRENCY"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生产环境入口  gevent WSGIServer")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--concurrency", type=int, default=application.config["SERVER_CONCURRENCY"]
+    )
+    parser.add_argument("--access-log", action="store_true", help="输出每个请求的访问日志")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    size_pool(application, args.concurrency)
+    server = WSGIServer(
+        (args.host, args.port),
+        application,
+        spawn=Pool(args.concurrency),
+        log="default" if args.access_log else None,
+    )
+    logger.info(f"serving on {args.host}:{args.port} concurrency={args.concurrency}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()